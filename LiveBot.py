@@ -1,10 +1,24 @@
 import logging
 import sys
 import os
+import asyncio
+import contextvars
+import cProfile
+import functools
+import gzip
+import hashlib
 import signal
 import json
+import html
+import marshal
+import math
+import random
+import re
 import sqlite3
-from contextlib import contextmanager
+import threading
+import zlib
+import time
+from collections import Counter, OrderedDict, deque
 from uuid import uuid4
 from typing import Dict, List, Optional
 from datetime import datetime
@@ -14,26 +28,73 @@ logger = logging.getLogger()
 logger.handlers = []
 logger.addHandler(logging.NullHandler())
 
-@contextmanager
-def suppress_stderr():
-    with open(os.devnull, 'w') as devnull:
-        old_stderr = sys.stderr
-        sys.stderr = devnull
-        try:
-            yield
-        finally:
-            sys.stderr = old_stderr
+handler_context: contextvars.ContextVar = contextvars.ContextVar("handler_context", default=None)
+error_log: deque = deque(maxlen=200)
+
+def describe_update(update: object) -> str:
+    if not isinstance(update, Update):
+        return type(update).__name__ if update is not None else "-"
+    parts = [f"user={update.effective_user.id}" if update.effective_user else "user=-"]
+    if update.callback_query:
+        parts.append(f"callback={update.callback_query.data}")
+    elif update.effective_message and update.effective_message.text:
+        parts.append(f"text={update.effective_message.text[:40]!r}")
+    return " ".join(parts)
+
+def record_error(error: BaseException = None):
+    error = error or sys.exc_info()[1]
+    if error is None or getattr(error, "_livebot_recorded", False):
+        return
+    try:
+        error._livebot_recorded = True
+    except AttributeError:
+        pass
+    handler, update = handler_context.get() or ("-", None)
+    tb = error.__traceback__
+    while tb is not None and tb.tb_next is not None:
+        tb = tb.tb_next
+    error_log.append({
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "handler": handler,
+        "update": describe_update(update),
+        "type": type(error).__name__,
+        "message": str(error)[:200],
+        "location": f"{tb.tb_frame.f_code.co_name}:{tb.tb_lineno}" if tb else "-"
+    })
+    metrics.increment("handler_errors", (("handler", handler), ("type", type(error).__name__)))
+
+class ErrorCapture:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, Exception):
+            record_error(exc)
+        return False
+
+capture_errors = ErrorCapture()
 
 import nest_asyncio
 nest_asyncio.apply()
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from telegram import (
     Update,
+    CallbackQuery,
+    Message,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
     KeyboardButton,
     InputMediaPhoto,
+    InputMediaVideo,
+    InputMediaDocument,
     InputFile,
     Document,
     Voice
@@ -45,28 +106,46 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
     ContextTypes,
+    ApplicationHandlerStop,
+    BaseHandler,
+    JobQueue,
+    BasePersistence,
+    PersistenceInput,
     filters
 )
 from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 
 (
     SELECTING_TOPIC, WRITING_MESSAGE, CONFIRM_ANONYMITY, ADMIN_RESPONSE,
     BROADCAST_MESSAGE, ADDING_ADMIN, CREATING_TOPIC, ADDING_FAQ,
     SEARCHING_FAQ, MANAGING_PRIORITY, ADDING_NOTE, REASSIGNING_DIALOG,
-    RATING_RESPONSE, RECEIVING_RATING_COMMENT
-) = range(14)
+    RATING_RESPONSE, RECEIVING_RATING_COMMENT, SEARCHING_DIALOGS, SUGGESTING_FAQ
+) = range(16)
 
 STATUS_NEW = "new"
 STATUS_IN_PROGRESS = "in_progress"
 STATUS_RESOLVED = "resolved"
 STATUS_CLOSED = "closed"
 
+OPEN_STATUSES = (STATUS_NEW, STATUS_IN_PROGRESS)
+
 PRIORITY_LOW = "low"
 PRIORITY_NORMAL = "normal"
 PRIORITY_HIGH = "high"
 PRIORITY_URGENT = "urgent"
 
+ROLE_USER = "user"
+ROLE_ADMIN = "admin"
+ROLE_SYSTEM = "system"
+
+EVENT_MESSAGE = "message"
+EVENT_REPLY = "reply"
+EVENT_ATTACHMENT = "attachment"
+EVENT_STATUS = "status"
+
 if not os.path.exists('config.json'):
     with open('config.json', 'w') as f:
         json.dump({
@@ -85,18 +164,641 @@ with open('config.json') as f:
 BOT_TOKEN = config['BOT_TOKEN']
 ADMIN_ID = config['ADMIN_ID']
 MAX_ATTACHMENTS = config.get('MAX_ATTACHMENTS', 5)
+MEDIA_GROUP_WINDOW = config.get('MEDIA_GROUP_WINDOW', 1.5)
 MAX_URGENT_PER_DAY = config.get('MAX_URGENT_PER_DAY', 3)
+QUOTAS = {"priority:urgent": MAX_URGENT_PER_DAY}
+QUOTAS.update(config.get('QUOTAS', {}))
+QUOTA_CACHE_SIZE = config.get('QUOTA_CACHE_SIZE', 10000)
 SUPPORTED_LANGUAGES = config.get('SUPPORTED_LANGUAGES', ["ru"])
 DEFAULT_LANGUAGE = config.get('DEFAULT_LANGUAGE', "ru")
+PERSISTENCE_INTERVAL = config.get('PERSISTENCE_INTERVAL', 30)
+FAQ_SEARCH_LIMIT = config.get('FAQ_SEARCH_LIMIT', 5)
+FAQ_SIMILARITY_THRESHOLD = config.get('FAQ_SIMILARITY_THRESHOLD', 0.5)
+FAQ_DEFLECTION_ENABLED = config.get('FAQ_DEFLECTION_ENABLED', True)
+FAQ_DEFLECTION_THRESHOLD = config.get('FAQ_DEFLECTION_THRESHOLD', 0.35)
+FAQ_DEFLECTION_LIMIT = config.get('FAQ_DEFLECTION_LIMIT', 3)
+FAQ_VECTOR_DIM = config.get('FAQ_VECTOR_DIM', 2048)
+DUPLICATE_WINDOW_SECONDS = config.get('DUPLICATE_WINDOW_SECONDS', 3600)
+DUPLICATE_WINDOW_SIZE = config.get('DUPLICATE_WINDOW_SIZE', 5000)
+DUPLICATE_THRESHOLD = config.get('DUPLICATE_THRESHOLD', 0.6)
+DUPLICATE_MIN_LENGTH = config.get('DUPLICATE_MIN_LENGTH', 12)
+MINHASH_PERMUTATIONS = config.get('MINHASH_PERMUTATIONS', 64)
+MINHASH_BANDS = config.get('MINHASH_BANDS', 16)
+DIALOG_SEARCH_PAGE_SIZE = config.get('DIALOG_SEARCH_PAGE_SIZE', 8)
+AUTO_CLOSE_AFTER = config.get('AUTO_CLOSE_AFTER', 7 * 24 * 3600)
+AUTO_CLOSE_INTERVAL = config.get('AUTO_CLOSE_INTERVAL', 600)
+AUTO_CLOSE_BATCH = config.get('AUTO_CLOSE_BATCH', 100)
+AUTO_CLOSE_NOTIFY = config.get('AUTO_CLOSE_NOTIFY', True)
+SLA_DEADLINES = {"urgent": 900, "high": 3600}
+SLA_DEADLINES.update(config.get('SLA_DEADLINES', {}))
+SLA_CHECK_INTERVAL = config.get('SLA_CHECK_INTERVAL', 30)
+ASSIGNMENT_ENABLED = config.get('ASSIGNMENT_ENABLED', True)
+ASSIGNMENT_STRATEGY = config.get('ASSIGNMENT_STRATEGY', "least_loaded")
+ADMIN_WEIGHTS = {int(k): v for k, v in config.get('ADMIN_WEIGHTS', {}).items()}
+ADMIN_TOPIC_SKILLS = {int(k): set(v) for k, v in config.get('ADMIN_TOPIC_SKILLS', {}).items()}
+RATE_LIMIT_ENABLED = config.get('RATE_LIMIT_ENABLED', True)
+RATE_LIMITS = {
+    "new_dialog": {"rate": 1 / 60, "burst": 3},
+    "follow_up": {"rate": 0.5, "burst": 10},
+    "default": {"rate": 1.0, "burst": 20}
+}
+RATE_LIMITS.update(config.get('RATE_LIMITS', {}))
+RATE_LIMIT_STRIKES = config.get('RATE_LIMIT_STRIKES', 5)
+RATE_LIMIT_STRIKE_WINDOW = config.get('RATE_LIMIT_STRIKE_WINDOW', 300)
+RATE_LIMIT_BAN_SECONDS = config.get('RATE_LIMIT_BAN_SECONDS', 3600)
+RATE_LIMIT_EXEMPT_TTL = config.get('RATE_LIMIT_EXEMPT_TTL', 300)
+CONVERSATION_TIMEOUT = config.get('CONVERSATION_TIMEOUT', 1800)
+SESSION_MAX_USERS = config.get('SESSION_MAX_USERS', 10000)
+SESSION_SWEEP_INTERVAL = config.get('SESSION_SWEEP_INTERVAL', 60)
+BOT_API_BASE_URL = config.get('BOT_API_BASE_URL', "https://api.telegram.org/bot")
+BOT_API_FILE_URL = config.get('BOT_API_FILE_URL', "https://api.telegram.org/file/bot")
+METRICS_HOST = config.get('METRICS_HOST', "127.0.0.1")
+SLOW_QUERY_THRESHOLD_MS = config.get('SLOW_QUERY_THRESHOLD_MS', 20)
+SLOW_QUERY_TOP = config.get('SLOW_QUERY_TOP', 25)
+METRICS_PORT = config.get('METRICS_PORT', 0)
+UPDATE_RECORD_PATH = config.get('UPDATE_RECORD_PATH')
+UPDATE_RECORD_SALT = config.get('UPDATE_RECORD_SALT')
+PROFILE_SAMPLE_INTERVAL = config.get('PROFILE_SAMPLE_INTERVAL', 0.005)
+PROFILE_DEFAULT_UPDATES = config.get('PROFILE_DEFAULT_UPDATES', 100)
+PROFILE_MAX_SECONDS = config.get('PROFILE_MAX_SECONDS', 600)
+API_CALL_BUDGET = config.get('API_CALL_BUDGET', 3)
+DIALOG_PAGE_SIZE = config.get('DIALOG_PAGE_SIZE', 10)
+SESSION_DEFAULT_TTL = config.get('SESSION_DEFAULT_TTL', 3600)
+SESSION_TTLS = {
+    "selected_topic": 3600,
+    "topic_name": 3600,
+    "is_anonymous": 3600,
+    "priority": 3600,
+    "dialog_message_id": 3600,
+    "replying_to": 3600,
+    "replying_user": 3600,
+    "faq_question": 1800,
+    "faq_answer": 1800,
+    "new_topic_name": 1800,
+    "note_user_id": 1800,
+    "reassign_message_id": 1800,
+    "rating_message_id": 1800,
+    "rating_value": 1800,
+    "rating_admin_id": 1800,
+    "dialog_search": 1800,
+    "pending_dialog": 1800,
+    "replying_cluster": 3600,
+    **config.get('SESSION_TTLS', {})
+}
 
 if not os.path.exists('attachments'):
     os.makedirs('attachments')
 
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        index = 0
+        while index < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else math.inf
+        return math.inf
+
+class Metrics:
+    def __init__(self):
+        self.histograms: Dict[tuple, Histogram] = {}
+        self.counters: Dict[tuple, int] = {}
+
+    def observe(self, name: str, label: str, seconds: float):
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[(name, label)] = Histogram()
+        histogram.observe(seconds)
+
+    def increment(self, name: str, labels: tuple, amount: int = 1):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + amount
+
+    def by_name(self, name: str) -> Dict[str, Histogram]:
+        return {label: histogram for (metric, label), histogram in self.histograms.items() if metric == name}
+
+    def render(self) -> str:
+        lines = []
+        label_names = {"handler_latency": "handler", "api_request": "method", "update": "part", "db_statement": "kind"}
+        for name in sorted({metric for metric, _ in self.histograms}):
+            lines.append(f"# TYPE livebot_{name}_seconds histogram")
+            for label, histogram in sorted(self.by_name(name).items()):
+                tag = f'{label_names.get(name, "label")}="{label}"'
+                cumulative = 0
+                for bound, count in zip((*LATENCY_BUCKETS, "+Inf"), histogram.counts):
+                    cumulative += count
+                    lines.append(f'livebot_{name}_seconds_bucket{{{tag},le="{bound}"}} {cumulative}')
+                lines.append(f"livebot_{name}_seconds_sum{{{tag}}} {histogram.total:.6f}")
+                lines.append(f"livebot_{name}_seconds_count{{{tag}}} {histogram.count}")
+        for name in sorted({metric for metric, _ in self.counters}):
+            lines.append(f"# TYPE livebot_{name}_total counter")
+            for (metric, labels), value in sorted(self.counters.items()):
+                if metric == name:
+                    tags = ",".join(f'{key}="{value_}"' for key, value_ in labels)
+                    lines.append(f"livebot_{name}_total{{{tags}}} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+update_timings: contextvars.ContextVar = contextvars.ContextVar("update_timings", default=None)
+
+class ApiCallBudget:
+    __slots__ = ("chat_id", "calls", "own_calls", "answered", "handler")
+
+    def __init__(self, chat_id: Optional[int]):
+        self.chat_id = chat_id
+        self.calls: Counter = Counter()
+        self.own_calls = 0
+        self.answered = set()
+        self.handler = "-"
+
+    def record(self, method: str, chat_id):
+        self.calls[method] += 1
+        if chat_id is None or chat_id == self.chat_id:
+            self.own_calls += 1
+
+    def exceeded(self) -> bool:
+        return self.own_calls > API_CALL_BUDGET
+
+api_budget: contextvars.ContextVar = contextvars.ContextVar("api_budget", default=None)
+
+def record_timing(kind: str, seconds: float):
+    timings = update_timings.get()
+    if timings is not None:
+        timings[kind] += seconds
+        timings[f"{kind}_calls"] += 1
+
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    normalized = SQL_LITERAL.sub("?", " ".join(sql.split()))
+    return SQL_IN_LIST.sub("(?, ...)", normalized)
+
+class QueryProfiler:
+    def __init__(self, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        self.statements: Dict[str, Dict] = {}
+
+    def record(self, cursor: "TimedCursor", elapsed: float):
+        if cursor.statement is None:
+            return
+        key = normalize_sql(cursor.statement)
+        entry = self.statements.get(key)
+        if entry is None:
+            entry = self.statements[key] = {"count": 0, "total": 0.0, "max": 0.0, "slow": 0, "plan": None, "scan": False}
+        if cursor.elapsed is None:
+            cursor.elapsed = 0.0
+            entry['count'] += 1
+        cursor.elapsed += elapsed
+        entry['total'] += elapsed
+        entry['max'] = max(entry['max'], cursor.elapsed)
+        if not cursor.slow and cursor.elapsed >= self.threshold:
+            cursor.slow = True
+            entry['slow'] += 1
+            if entry['plan'] is None and cursor.params is not None:
+                self.explain(cursor, entry)
+
+    def explain(self, cursor: "TimedCursor", entry: Dict):
+        if not cursor.statement.lstrip().upper().startswith(EXPLAINABLE):
+            entry['plan'] = []
+            return
+        try:
+            plain = sqlite3.Cursor(cursor.connection)
+            plain.execute("EXPLAIN QUERY PLAN " + cursor.statement, cursor.params)
+            entry['plan'] = [row[3] for row in plain.fetchall()]
+            plain.close()
+        except sqlite3.Error:
+            entry['plan'] = []
+        entry['scan'] = any(
+            detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail and "CONSTANT ROW" not in detail
+            for detail in entry['plan']
+        )
+
+    def report(self, top: int = SLOW_QUERY_TOP) -> str:
+        ranked = sorted(self.statements.items(), key=lambda item: -item[1]['total'])[:top]
+        lines = [
+            f"Slow-query report, {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            f"Statements tracked: {len(self.statements)}, threshold: {self.threshold * 1000:g} ms",
+            ""
+        ]
+        for rank, (sql, entry) in enumerate(ranked, 1):
+            lines.append(
+                f"#{rank} total {entry['total'] * 1000:.1f} ms | calls {entry['count']} | "
+                f"mean {entry['total'] / max(entry['count'], 1) * 1000:.2f} ms | max {entry['max'] * 1000:.2f} ms | "
+                f"slow {entry['slow']}{' | FULL SCAN' if entry['scan'] else ''}"
+            )
+            lines.append(f"    {sql}")
+            for detail in entry['plan'] or []:
+                lines.append(f"    plan: {detail}")
+            lines.append("")
+        return "\n".join(lines)
+
+query_profiler = QueryProfiler()
+
+class TimedCursor(sqlite3.Cursor):
+    statement = None
+    params = None
+    elapsed = None
+    slow = False
+
+    def timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            record_timing("db", elapsed)
+            metrics.observe("db_statement", method.__name__, elapsed)
+            query_profiler.record(self, elapsed)
+
+    def execute(self, sql: str, parameters=()):
+        self.statement, self.params, self.elapsed, self.slow = sql, parameters, None, False
+        return self.timed(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters):
+        self.statement, self.params, self.elapsed, self.slow = sql, None, None, False
+        return self.timed(sqlite3.Cursor.executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        return self.timed(sqlite3.Cursor.fetchone)
+
+    def fetchall(self):
+        return self.timed(sqlite3.Cursor.fetchall)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+def get_connection() -> sqlite3.Connection:
+    return sqlite3.connect('feedback.db', factory=TimedConnection)
+
+class ProfileSession:
+    def __init__(self, application: Application, admin_id: int, mode: str = "sample", updates: int = None,
+                 seconds: float = None, handler: str = None, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.application = application
+        self.admin_id = admin_id
+        self.mode = mode
+        self.limit = updates
+        self.handler = handler
+        self.interval = interval
+        self.started = time.monotonic()
+        self.deadline = self.started + min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        self.profile = cProfile.Profile() if mode == "cpu" else None
+        self.stacks = Counter()
+        self.samples = 0
+        self.profiled = 0
+        self.depth = 0
+        self.finished = False
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name="profile-sampler", daemon=True)
+        self.sampler.start()
+
+    def enter(self):
+        self.depth += 1
+        if self.depth == 1 and self.profile is not None:
+            self.profile.enable()
+
+    def exit(self):
+        self.depth -= 1
+        if self.depth == 0 and self.profile is not None:
+            self.profile.disable()
+        self.profiled += 1
+        if not self.finished and (self.limit and self.profiled >= self.limit or time.monotonic() >= self.deadline):
+            self.finished = True
+            self.application.create_task(finish_profile_session(self))
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            if self.depth == 0:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        if self.profile is not None:
+            if self.depth:
+                self.profile.disable()
+            self.profile.create_stats()
+
+    def summary(self) -> str:
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines = [
+            f"🔬 Профилирование завершено ({'cProfile' if self.profile else 'сэмплирование'})",
+            f"Фильтр: {self.handler or 'все обновления'}",
+            f"Обработано: {self.profiled}, длительность: {time.monotonic() - self.started:.1f} с, сэмплов: {self.samples}",
+            ""
+        ]
+        if self.samples:
+            lines.append("Самые частые кадры:")
+            for frame, count in leaves.most_common(10):
+                lines.append(f"{count / self.samples * 100:5.1f}% {frame}")
+        return "\n".join(lines)
+
+    def documents(self) -> List[InputFile]:
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        documents = []
+        if self.profile is not None:
+            documents.append(InputFile(marshal.dumps(self.profile.stats), filename=f"profile_{stamp}.pstats"))
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+        documents.append(InputFile(collapsed.encode(), filename=f"profile_{stamp}.collapsed"))
+        return documents
+
+profile_session: Optional[ProfileSession] = None
+
+async def finish_profile_session(session: ProfileSession):
+    global profile_session
+    with capture_errors:
+        try:
+            if profile_session is session:
+                profile_session = None
+            session.stop()
+            bot = session.application.bot
+            await bot.send_message(chat_id=session.admin_id, text=session.summary()[:4096])
+            for document in session.documents():
+                await bot.send_document(chat_id=session.admin_id, document=document)
+        except Exception as e:
+            record_error(e)
+
+async def profile_deadline(context: ContextTypes.DEFAULT_TYPE):
+    session = context.job.data
+    if not session.finished:
+        session.finished = True
+        await finish_profile_session(session)
+
+def instrument(callback, name: str = None):
+    if getattr(callback, "instrumented", False):
+        return callback
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        token = handler_context.set((name, args[0] if len(args) == 2 else None))
+        budget = api_budget.get()
+        if budget is not None:
+            budget.handler = name
+        session = profile_session
+        profiled = session is not None and session.handler == name
+        if profiled:
+            session.enter()
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise
+        except Exception as error:
+            record_error(error)
+            raise
+        finally:
+            metrics.observe("handler_latency", name, time.perf_counter() - started)
+            if profiled:
+                session.exit()
+            handler_context.reset(token)
+
+    wrapper.instrumented = True
+    return wrapper
+
+def instrument_handler(handler: BaseHandler):
+    if isinstance(handler, ConversationHandler):
+        children = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            children.extend(state_handlers)
+        for child in children:
+            instrument_handler(child)
+    else:
+        handler.callback = instrument(handler.callback)
+
+class UpdateRecorder:
+    NAME_FIELDS = {"first_name", "last_name", "username", "title"}
+    TEXT_FIELDS = {"text", "caption"}
+    FILE_FIELDS = {"file_id", "file_unique_id"}
+    DROPPED_FIELDS = {"contact", "location", "venue", "phone_number", "email"}
+
+    def __init__(self, path: str, salt: str = None):
+        self.path = path
+        self.key = hashlib.blake2b((salt or uuid4().hex).encode(), digest_size=32).digest()
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.recorded = 0
+
+    def digest(self, value: str, size: int = 8) -> bytes:
+        return hashlib.blake2b(value.encode(), key=self.key, digest_size=size).digest()
+
+    def pseudonym(self, user_id: int) -> int:
+        value = int.from_bytes(self.digest(str(user_id), 5), "big") % 10 ** 11 + 10 ** 11
+        return -value if user_id < 0 else value
+
+    def scramble_word(self, match: re.Match) -> str:
+        word = match.group(0)
+        digest = self.digest(word.lower(), 32)
+        scrambled = []
+        for char, byte in zip(word, digest * (len(word) // 32 + 1)):
+            if char.isdigit():
+                scrambled.append(str(byte % 10))
+            elif "а" <= char.lower() <= "я" or char.lower() == "ё":
+                scrambled.append(chr(ord("а") + byte % 32))
+            else:
+                scrambled.append(chr(ord("a") + byte % 26))
+            if char.isupper():
+                scrambled[-1] = scrambled[-1].upper()
+        return "".join(scrambled)
+
+    def scramble(self, text: str) -> str:
+        command, separator, rest = text.partition(" ") if text.startswith("/") else ("", "", text)
+        return command + separator + re.sub(r"\w+", self.scramble_word, rest)
+
+    def anonymize(self, value, key: str = None):
+        if isinstance(value, dict):
+            return {
+                field: self.anonymize(item, field)
+                for field, item in value.items() if field not in self.DROPPED_FIELDS
+            }
+        if isinstance(value, list):
+            return [self.anonymize(item, key) for item in value]
+        if key in ("id", "user_id", "chat_id") and isinstance(value, int):
+            return self.pseudonym(value)
+        if key in self.NAME_FIELDS and isinstance(value, str):
+            return f"u{self.digest(value, 4).hex()}"
+        if key in self.TEXT_FIELDS and isinstance(value, str):
+            return self.scramble(value)
+        if key in self.FILE_FIELDS and isinstance(value, str):
+            return self.digest(value, 12).hex()
+        return value
+
+    def write(self, record: Dict):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def start(self, admin_ids: List[int]):
+        self.write({"t": time.time(), "admins": [self.pseudonym(admin_id) for admin_id in admin_ids]})
+
+    def record(self, update: object):
+        if not isinstance(update, Update):
+            return
+        with capture_errors:
+            try:
+                self.write({"t": time.time(), "update": self.anonymize(update.to_dict())})
+                self.recorded += 1
+            except Exception as e:
+                record_error(e)
+
+    def close(self):
+        self.file.close()
+
+update_recorder: Optional[UpdateRecorder] = None
+
+class InstrumentedApplication(Application):
+    def add_handler(self, handler: BaseHandler, group: int = 0):
+        instrument_handler(handler)
+        super().add_handler(handler, group)
+
+    def evict_user_data(self, user_id: int):
+        # Unlike drop_user_data this keeps the persisted row: the session is written out
+        # and reloaded by refresh_user_data on the user's next update.
+        data = self._user_data.pop(user_id, None)
+        self._user_ids_to_be_updated_in_persistence.discard(user_id)
+        if self.persistence is not None:
+            self.persistence.evict_user(user_id, data)
+
+    async def process_update(self, update: object):
+        if update_recorder is not None:
+            update_recorder.record(update)
+        timings = {"db": 0.0, "db_calls": 0, "api": 0.0, "api_calls": 0}
+        token = update_timings.set(timings)
+        chat = update.effective_chat if isinstance(update, Update) else None
+        budget = ApiCallBudget(chat.id if chat else None)
+        budget_token = api_budget.set(budget)
+        session = profile_session
+        profiled = session is not None and session.handler is None
+        if profiled:
+            session.enter()
+        started = time.perf_counter()
+        try:
+            await super().process_update(update)
+            if isinstance(update, Update) and update.callback_query and update.callback_query.id not in budget.answered:
+                try:
+                    await answer_callback(update.callback_query)
+                except Exception as e:
+                    record_error(e)
+        finally:
+            if profiled:
+                session.exit()
+            update_timings.reset(token)
+            api_budget.reset(budget_token)
+            for method, count in budget.calls.items():
+                metrics.increment("api_calls_by_method", (("method", method),), count)
+            if budget.exceeded():
+                metrics.increment("api_budget_exceeded", (("handler", budget.handler),))
+            metrics.observe("update", "total", time.perf_counter() - started)
+            metrics.observe("update", "db", timings['db'])
+            metrics.observe("update", "api", timings['api'])
+            metrics.increment("updates", ())
+            metrics.increment("db_statements", (), timings['db_calls'])
+            metrics.increment("api_calls", (), timings['api_calls'])
+
+class InstrumentedJobQueue(JobQueue):
+    def run_once(self, callback, *args, **kwargs):
+        return super().run_once(instrument(callback, f"job:{callback.__name__}"), *args, **kwargs)
+
+    def run_repeating(self, callback, *args, **kwargs):
+        return super().run_repeating(instrument(callback, f"job:{callback.__name__}"), *args, **kwargs)
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        budget = api_budget.get()
+        if budget is not None:
+            budget.record(api_method, request_data.parameters.get("chat_id") if request_data else None)
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            record_timing("api", elapsed)
+            metrics.observe("api_request", api_method, elapsed)
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.render().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        record_error()
+    finally:
+        writer.close()
+
+async def start_metrics_server(application: Application):
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+
+async def start_services(application: Application):
+    global update_recorder
+    await start_metrics_server(application)
+    if UPDATE_RECORD_PATH:
+        update_recorder = UpdateRecorder(UPDATE_RECORD_PATH, UPDATE_RECORD_SALT)
+        update_recorder.start([admin['admin_id'] for admin in get_all_admins()])
+
+async def stop_services(application: Application):
+    global update_recorder
+    if update_recorder is not None:
+        update_recorder.close()
+        update_recorder = None
+
+def ensure_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> bool:
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in cursor.fetchall()]:
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+def append_dialog_event(cursor: sqlite3.Cursor, message_id: int, author_role: str, author_id: Optional[int],
+                        event_type: str, body: str = None, attachment_id: int = None):
+    append_dialog_events(cursor, message_id, [(author_role, author_id, event_type, body, attachment_id)])
+
+def append_dialog_events(cursor: sqlite3.Cursor, message_id: int, events: List[tuple]):
+    cursor.executemany('''
+        INSERT INTO dialog_events (message_id, seq, author_role, author_id, event_type, body, attachment_id)
+        SELECT ?, COALESCE(MAX(seq), -1) + 1, ?, ?, ?, ?, ? FROM dialog_events WHERE message_id = ?
+    ''', [(message_id, *event, message_id) for event in events])
+
 def init_db():
-    conn = sqlite3.connect('feedback.db')
+    conn = get_connection()
     cursor = conn.cursor()
 
     cursor.execute("DROP TABLE IF EXISTS faq")
+    cursor.execute("DROP TABLE IF EXISTS faq_fts")
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -138,6 +840,11 @@ def init_db():
         )
     ''')
 
+    ensure_column(cursor, "users", "banned_until", "TIMESTAMP")
+    ensure_column(cursor, "messages", "cluster_id", "INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_cluster ON messages(cluster_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_status_priority ON messages(status, priority)")
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS replies (
             reply_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -160,6 +867,7 @@ def init_db():
             FOREIGN KEY (added_by) REFERENCES users(user_id)
         )
     ''')
+    ensure_column(cursor, "admins", "is_online", "BOOLEAN DEFAULT TRUE")
 
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS attachments (
@@ -196,6 +904,45 @@ def init_db():
         )
     ''')
 
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS faq_fts USING fts5(
+            question,
+            answer,
+            keywords,
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS faq_fts_insert AFTER INSERT ON faq BEGIN
+            INSERT INTO faq_fts (rowid, question, answer, keywords) VALUES (
+                new.faq_id,
+                replace(replace(new.question, 'ё', 'е'), 'Ё', 'Е'),
+                replace(replace(new.answer, 'ё', 'е'), 'Ё', 'Е'),
+                replace(replace(new.keywords, 'ё', 'е'), 'Ё', 'Е')
+            );
+        END
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS faq_fts_delete AFTER DELETE ON faq BEGIN
+            DELETE FROM faq_fts WHERE rowid = old.faq_id;
+        END
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS faq_fts_update AFTER UPDATE ON faq BEGIN
+            DELETE FROM faq_fts WHERE rowid = old.faq_id;
+            INSERT INTO faq_fts (rowid, question, answer, keywords) VALUES (
+                new.faq_id,
+                replace(replace(new.question, 'ё', 'е'), 'Ё', 'Е'),
+                replace(replace(new.answer, 'ё', 'е'), 'Ё', 'Е'),
+                replace(replace(new.keywords, 'ё', 'е'), 'Ё', 'Е')
+            );
+        END
+    ''')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS notes (
             note_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -220,6 +967,143 @@ def init_db():
         )
     ''')
 
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            conversation_key TEXT NOT NULL,
+            state INTEGER,
+            PRIMARY KEY (name, conversation_key)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_replies_message ON replies(message_id)")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dialog_events (
+            message_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            author_role TEXT NOT NULL,
+            author_id INTEGER,
+            event_type TEXT NOT NULL,
+            body TEXT,
+            attachment_id INTEGER,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (message_id, seq),
+            FOREIGN KEY (message_id) REFERENCES messages(message_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("SELECT COUNT(*) FROM dialog_events")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f'''
+            INSERT INTO dialog_events (message_id, seq, author_role, author_id, event_type, body, attachment_id, timestamp)
+            SELECT message_id,
+                   ROW_NUMBER() OVER (PARTITION BY message_id ORDER BY timestamp, source, source_id) - 1,
+                   author_role, author_id, event_type, body, attachment_id, timestamp
+            FROM (
+                SELECT message_id, 0 AS source, message_id AS source_id, '{ROLE_USER}' AS author_role,
+                       user_id AS author_id, '{EVENT_MESSAGE}' AS event_type, message_text AS body,
+                       NULL AS attachment_id, timestamp
+                FROM messages
+                UNION ALL
+                SELECT a.message_id, 1, a.attachment_id, '{ROLE_USER}', m.user_id, '{EVENT_ATTACHMENT}',
+                       a.file_type, a.attachment_id, m.timestamp
+                FROM attachments a JOIN messages m ON a.message_id = m.message_id
+                UNION ALL
+                SELECT r.message_id, 2, r.reply_id,
+                       CASE WHEN r.admin_id = m.user_id THEN '{ROLE_USER}' ELSE '{ROLE_ADMIN}' END, r.admin_id,
+                       CASE WHEN r.admin_id = m.user_id THEN '{EVENT_MESSAGE}' ELSE '{EVENT_REPLY}' END,
+                       r.reply_text, NULL, r.timestamp
+                FROM replies r JOIN messages m ON r.message_id = m.message_id
+                UNION ALL
+                SELECT message_id, 3, history_id,
+                       CASE WHEN admin_id IS NULL THEN '{ROLE_SYSTEM}' ELSE '{ROLE_ADMIN}' END, admin_id,
+                       '{EVENT_STATUS}', status, NULL, timestamp
+                FROM message_status_history
+            )
+        ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attachments_message ON attachments(message_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_history_message ON message_status_history(message_id, timestamp)")
+
+    if ensure_column(cursor, "messages", "last_activity", "TIMESTAMP"):
+        cursor.execute('''
+            UPDATE messages SET last_activity = COALESCE(
+                (SELECT MAX(r.timestamp) FROM replies r WHERE r.message_id = messages.message_id), timestamp
+            )
+        ''')
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_messages_open_activity ON messages(last_activity)
+        WHERE status IN ('{STATUS_NEW}', '{STATUS_IN_PROGRESS}')
+    """)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS quota_usage (
+            user_id INTEGER,
+            quota_key TEXT,
+            day TEXT NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, quota_key)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("SELECT COUNT(*) FROM quota_usage")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute('''
+            INSERT INTO quota_usage (user_id, quota_key, day, used)
+            SELECT user_id, 'priority:urgent', last_urgent_date, urgent_messages_today
+            FROM users WHERE last_urgent_date IS NOT NULL AND urgent_messages_today > 0
+        ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_topic_subscriptions (
+            admin_id INTEGER,
+            topic_id INTEGER,
+            PRIMARY KEY (admin_id, topic_id),
+            FOREIGN KEY (admin_id) REFERENCES admins(admin_id),
+            FOREIGN KEY (topic_id) REFERENCES topics(topic_id)
+        ) WITHOUT ROWID
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS faq_deflections (
+            deflection_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            faq_id INTEGER,
+            outcome TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS dialog_fts USING fts5(
+            body,
+            message_id UNINDEXED,
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+
+    cursor.execute("SELECT 1 FROM dialog_fts LIMIT 1")
+    if not cursor.fetchone():
+        cursor.execute('''
+            INSERT INTO dialog_fts (body, message_id)
+            SELECT replace(replace(message_text, 'ё', 'е'), 'Ё', 'Е'), message_id FROM messages
+            WHERE message_text IS NOT NULL
+        ''')
+        cursor.execute('''
+            INSERT INTO dialog_fts (body, message_id)
+            SELECT replace(replace(reply_text, 'ё', 'е'), 'Ё', 'Е'), message_id FROM replies
+            WHERE reply_text IS NOT NULL
+        ''')
+
     default_topics = [
         ("Общие вопросы", "Вопросы общего характера", False),
         ("Техническая помощь", "Проблемы с использованием сервиса", False),
@@ -250,20 +1134,427 @@ def init_db():
 
 init_db()
 
-def save_attachment(message_id: int, file_id: str, file_type: str, file_path: str = None):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+def dump_user_data(user_id: int, data: Dict) -> Optional[str]:
+    if not data:
+        return None
+    try:
+        return json.dumps(data, ensure_ascii=False)
+    except (TypeError, ValueError) as error:
+        raise TypeError(f"user_data of {user_id} can't be persisted: {error}") from error
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._loaded_users = set()
+        self._pending_user_data: Dict[int, Optional[str]] = {}
+        self._pending_conversations: Dict[tuple, Optional[int]] = {}
+        self._flush_task = None
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        with capture_errors:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT conversation_key, state FROM conversations WHERE name = ?",
+                (name,)
+            )
+            conversations = {tuple(json.loads(row[0])): row[1] for row in cursor.fetchall()}
+            conn.close()
+            return conversations
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]):
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: Dict):
+        self._loaded_users.add(user_id)
+        self._pending_user_data[user_id] = dump_user_data(user_id, data)
+        self._schedule_flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        with capture_errors:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            conn.close()
+        if row:
+            for key, value in json.loads(row[0]).items():
+                user_data.setdefault(key, value)
+
+    async def drop_user_data(self, user_id: int):
+        self._loaded_users.discard(user_id)
+        self._pending_user_data[user_id] = None
+        self._schedule_flush()
+
+    def evict_user(self, user_id: int, data: Optional[Dict]):
+        if user_id in self._loaded_users and data is not None:
+            self._pending_user_data[user_id] = dump_user_data(user_id, data)
+            self._schedule_flush()
+        self._loaded_users.discard(user_id)
+
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        pass
+
+    async def update_bot_data(self, data: Dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict):
+        pass
+
+    async def flush(self):
+        self._write_pending()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        self._write_pending()
+
+    def _write_pending(self):
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not user_data and not conversations:
+            return
+        with capture_errors:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                [(user_id, data) for user_id, data in user_data.items() if data is not None]
+            )
+            cursor.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in user_data.items() if data is None]
+            )
+            cursor.executemany(
+                "INSERT OR REPLACE INTO conversations (name, conversation_key, state) VALUES (?, ?, ?)",
+                [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+            )
+            cursor.executemany(
+                "DELETE FROM conversations WHERE name = ? AND conversation_key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None]
+            )
+            conn.commit()
+            conn.close()
+
+class SessionData(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.touched: Dict[str, float] = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        self.touched[key] = time.monotonic()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.touched.pop(key, None)
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        self.touched.pop(key, None)
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.touched.clear()
+        super().clear()
+
+    def expired_keys(self, now: float) -> List[str]:
+        return [
+            key for key, touched in self.touched.items()
+            if now - touched > SESSION_TTLS.get(key, SESSION_DEFAULT_TTL)
+        ]
+
+def estimate_size(obj, seen: set = None) -> int:
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in obj)
+    return size
+
+class SessionManager:
+    def __init__(self, max_users: int = SESSION_MAX_USERS):
+        self.max_users = max_users
+        self.last_seen: OrderedDict = OrderedDict()
+        self.expired_total = 0
+        self.evicted_total = 0
+
+    def touch(self, user_id: int):
+        self.last_seen[user_id] = time.monotonic()
+        self.last_seen.move_to_end(user_id)
+
+    def sweep(self, application: Application) -> int:
+        now = time.monotonic()
+        changed = []
+        for user_id, user_data in list(application.user_data.items()):
+            if not isinstance(user_data, SessionData):
+                continue
+            expired = user_data.expired_keys(now)
+            for key in expired:
+                user_data.pop(key, None)
+            if expired:
+                self.expired_total += len(expired)
+                changed.append(user_id)
+        if changed:
+            application.mark_data_for_update_persistence(user_ids=changed)
+        evicted = 0
+        while len(self.last_seen) > self.max_users:
+            user_id, _ = self.last_seen.popitem(last=False)
+            application.evict_user_data(user_id)
+            evicted += 1
+        self.evicted_total += evicted
+        return evicted
+
+    def report(self, application: Application) -> Dict:
+        sessions = [data for data in application.user_data.values() if data]
+        key_counts: Dict[str, int] = {}
+        for data in sessions:
+            for key in data:
+                key_counts[key] = key_counts.get(key, 0) + 1
+        return {
+            "live_sessions": len(sessions),
+            "tracked_users": len(self.last_seen),
+            "max_users": self.max_users,
+            "bytes": sum(estimate_size(dict(data)) for data in sessions),
+            "expired_total": self.expired_total,
+            "evicted_total": self.evicted_total,
+            "keys": key_counts
+        }
+
+session_manager = SessionManager()
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+        self.notified = False
+
+    def take(self, rate: float, burst: float, now: float) -> bool:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.notified = False
+            return True
+        return False
+
+class RateLimiter:
+    def __init__(self, limits: Dict = RATE_LIMITS, max_buckets: int = SESSION_MAX_USERS * 3):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.buckets: OrderedDict = OrderedDict()
+        self.strikes: Dict[int, deque] = {}
+        self.banned: Dict[int, float] = {}
+        self.exempt: OrderedDict = OrderedDict()
+        self.albums: OrderedDict = OrderedDict()
+        self.allowed = {kind: 0 for kind in limits}
+        self.throttled = {kind: 0 for kind in limits}
+        self.bans_total = 0
+
+    def check(self, user_id: int, kind: str) -> bool:
+        now = time.monotonic()
+        key = (user_id, kind)
+        bucket = self.buckets.get(key)
+        limit = self.limits[kind]
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(limit['burst'], now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        if bucket.take(limit['rate'], limit['burst'], now):
+            self.allowed[kind] += 1
+            return True
+        self.throttled[kind] += 1
+        return False
+
+    def album_verdict(self, user_id: int, media_group_id: str) -> Optional[bool]:
+        return self.albums.get((user_id, media_group_id))
+
+    def record_album(self, user_id: int, media_group_id: str, allowed: bool):
+        self.albums[(user_id, media_group_id)] = allowed
+        if len(self.albums) > self.max_buckets:
+            self.albums.popitem(last=False)
+
+    def is_exempt(self, user_id: int) -> bool:
+        now = time.monotonic()
+        cached = self.exempt.get(user_id)
+        if cached is None or now - cached[1] > RATE_LIMIT_EXEMPT_TTL:
+            cached = self.exempt[user_id] = (is_admin(user_id), now)
+            if len(self.exempt) > self.max_buckets:
+                self.exempt.popitem(last=False)
+        self.exempt.move_to_end(user_id)
+        return cached[0]
+
+    def strike(self, user_id: int) -> bool:
+        now = time.monotonic()
+        strikes = self.strikes.setdefault(user_id, deque())
+        strikes.append(now)
+        while strikes and strikes[0] < now - RATE_LIMIT_STRIKE_WINDOW:
+            strikes.popleft()
+        if len(strikes) >= RATE_LIMIT_STRIKES:
+            del self.strikes[user_id]
+            return True
+        return False
+
+    def report(self) -> Dict:
+        return {
+            "allowed": dict(self.allowed),
+            "throttled": dict(self.throttled),
+            "buckets": len(self.buckets),
+            "offenders": len(self.strikes),
+            "banned": len(self.banned),
+            "bans_total": self.bans_total
+        }
+
+rate_limiter = RateLimiter()
+
+MINHASH_PRIME = (1 << 31) - 1
+
+class DuplicateDetector:
+    def __init__(self, permutations: int = MINHASH_PERMUTATIONS, bands: int = MINHASH_BANDS,
+                 window_seconds: float = DUPLICATE_WINDOW_SECONDS, window_size: int = DUPLICATE_WINDOW_SIZE,
+                 threshold: float = DUPLICATE_THRESHOLD):
+        rng = random.Random(20240601)
+        self.params = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME)) for _ in range(permutations)]
+        if np is not None:
+            self.a = np.array([a for a, _ in self.params], dtype=np.uint64)[:, None]
+            self.b = np.array([b for _, b in self.params], dtype=np.uint64)[:, None]
+        self.bands = bands
+        self.rows = permutations // bands
+        self.window_seconds = window_seconds
+        self.window_size = window_size
+        self.threshold = threshold
+        self.window: deque = deque()
+        self.entries: Dict[int, tuple] = {}
+        self.buckets: Dict[tuple, set] = {}
+
+    def signature(self, text: str) -> Optional[tuple]:
+        normalized = " ".join(re.findall(r"\w+", fts_text(text).lower()))
+        if len(normalized) < DUPLICATE_MIN_LENGTH:
+            return None
+        hashes = {zlib.crc32(normalized[i:i + 5].encode()) & MINHASH_PRIME for i in range(len(normalized) - 4)}
+        if np is not None:
+            values = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))[None, :]
+            return tuple(((self.a * values + self.b) % MINHASH_PRIME).min(axis=1).tolist())
+        return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in self.params)
+
+    def band_keys(self, signature: tuple) -> List[tuple]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def find_cluster(self, signature: Optional[tuple]) -> Optional[int]:
+        self.expire()
+        if signature is None:
+            return None
+        candidates = set()
+        for key in self.band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        best_cluster, best_score = None, self.threshold
+        for message_id in candidates:
+            other, cluster_id = self.entries[message_id]
+            score = sum(x == y for x, y in zip(signature, other)) / len(signature)
+            if score >= best_score:
+                best_cluster, best_score = cluster_id, score
+        return best_cluster
+
+    def add(self, message_id: int, cluster_id: int, signature: Optional[tuple]):
+        if signature is None:
+            return
+        self.entries[message_id] = (signature, cluster_id)
+        self.window.append((time.time(), message_id))
+        for key in self.band_keys(signature):
+            self.buckets.setdefault(key, set()).add(message_id)
+        self.expire()
+
+    def expire(self):
+        cutoff = time.time() - self.window_seconds
+        while self.window and (self.window[0][0] < cutoff or len(self.window) > self.window_size):
+            _, message_id = self.window.popleft()
+            signature, _ = self.entries.pop(message_id)
+            for key in self.band_keys(signature):
+                bucket = self.buckets.get(key)
+                bucket.discard(message_id)
+                if not bucket:
+                    del self.buckets[key]
+
+duplicate_detector = DuplicateDetector()
+cluster_alerts: OrderedDict = OrderedDict()
+media_groups: Dict[str, Dict] = {}
+
+def save_attachments(message_id: int, attachments: List[tuple]):
+    attachments = attachments[:MAX_ATTACHMENTS]
+    if not attachments:
+        return
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO attachments (message_id, file_id, file_type) VALUES (?, ?, ?)",
+            [(message_id, file_id, file_type) for file_id, file_type in attachments]
+        )
         cursor.execute(
-            "INSERT INTO attachments (message_id, file_id, file_type, file_path) VALUES (?, ?, ?, ?)",
-            (message_id, file_id, file_type, file_path)
+            "SELECT attachment_id, file_type FROM attachments WHERE message_id = ? ORDER BY attachment_id DESC LIMIT ?",
+            (message_id, len(attachments))
         )
+        saved = cursor.fetchall()[::-1]
+        cursor.execute("SELECT user_id FROM messages WHERE message_id = ?", (message_id,))
+        owner = cursor.fetchone()
+        append_dialog_events(cursor, message_id, [
+            (ROLE_USER, owner[0] if owner else None, EVENT_ATTACHMENT, file_type, attachment_id)
+            for attachment_id, file_type in saved
+        ])
         conn.commit()
         conn.close()
 
 def get_attachment(message_id: int) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute(
             "SELECT attachment_id, file_id, file_type, file_path FROM attachments WHERE message_id = ?",
@@ -281,8 +1572,8 @@ def get_attachment(message_id: int) -> List[Dict]:
         return attachments
 
 def add_rating(user_id: int, admin_id: int, rating: int, comments: str = None):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO ratings (user_id, admin_id, rating, comments) VALUES (?, ?, ?, ?)",
@@ -292,8 +1583,8 @@ def add_rating(user_id: int, admin_id: int, rating: int, comments: str = None):
         conn.close()
 
 def get_ratings(admin_id: int = None) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
 
         if admin_id:
@@ -331,8 +1622,8 @@ def get_ratings(admin_id: int = None) -> List[Dict]:
         return ratings
 
 def get_user_ratings(user_id: int) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT r.rating_id, r.rating, r.comments, r.timestamp,
@@ -356,48 +1647,314 @@ def get_user_ratings(user_id: int) -> List[Dict]:
         return ratings
 
 def add_faq(question: str, answer: str, topic_id: int = None):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO faq (question, answer, topic_id) VALUES (?, ?, ?)",
             (question, answer, topic_id)
         )
+        faq_id = cursor.lastrowid
         conn.commit()
         conn.close()
-
-def search_faq(query: str) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+        faq_matcher.add(faq_id, question)
+        if faq_vectors is not None:
+            faq_vectors.add(faq_id, f"{question} {question} {answer}")
+        return faq_id
+
+def delete_faq(faq_id: int):
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM faq WHERE faq_id = ?", (faq_id,))
+        conn.commit()
+        conn.close()
+        faq_matcher.remove(faq_id)
+        if faq_vectors is not None:
+            faq_vectors.remove(faq_id)
+
+RU_SUFFIXES = sorted((
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "иях", "ией",
+    "ть", "ешь", "ишь", "ет", "ит", "ут", "ют", "ат", "ят", "ия", "ие", "ий", "ой", "ей",
+    "ый", "ая", "яя", "ое", "ее", "ые", "ам", "ям", "ах", "ях", "ом", "ем", "ов", "ев",
+    "ла", "ло", "ли", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й"
+), key=len, reverse=True)
+EN_SUFFIXES = ("ing", "ed", "es", "s")
+
+def stem_token(token: str) -> str:
+    suffixes = RU_SUFFIXES if re.search("[а-я]", token) else EN_SUFFIXES
+    for _ in range(2):
+        suffix = next((s for s in suffixes if token.endswith(s) and len(token) - len(s) >= 4), None)
+        if not suffix:
+            break
+        token = token[:-len(suffix)]
+    return token
+
+def fts_text(text: str) -> str:
+    return (text or "").replace("ё", "е").replace("Ё", "Е")
+
+def fts_match_query(text: str) -> str:
+    tokens = re.findall(r"\w+", text.lower().replace("ё", "е"))
+    return " OR ".join(f'"{stem_token(token)}"*' for token in tokens)
+
+def highlight_snippet(snippet: str) -> str:
+    return html.escape(snippet).replace("\x02", "<b>").replace("\x03", "</b>")
+
+def search_faq(query: str, limit: int = None) -> List[Dict]:
+    match_query = fts_match_query(query)
+    if query.strip() and not match_query:
+        return []
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
 
-        cursor.execute('''
-            SELECT
-                f.faq_id,
-                f.question,
-                f.answer,
-                COALESCE(t.topic_name, 'Без темы') as topic_name
-            FROM faq f
-            LEFT JOIN topics t ON f.topic_id = t.topic_id
-            WHERE f.question LIKE ?
-               OR f.answer LIKE ?
-               OR (f.keywords IS NOT NULL AND f.keywords LIKE ?)
-        ''', (f"%{query}%", f"%{query}%", f"%{query}%"))
+        if not match_query:
+            cursor.execute('''
+                SELECT
+                    f.faq_id,
+                    f.question,
+                    f.answer,
+                    COALESCE(t.topic_name, 'Без темы') as topic_name,
+                    f.question,
+                    f.answer
+                FROM faq f
+                LEFT JOIN topics t ON f.topic_id = t.topic_id
+                ORDER BY f.faq_id
+                LIMIT ?
+            ''', (limit or -1,))
+        else:
+            cursor.execute('''
+                SELECT
+                    f.faq_id,
+                    f.question,
+                    f.answer,
+                    COALESCE(t.topic_name, 'Без темы') as topic_name,
+                    highlight(faq_fts, 0, char(2), char(3)),
+                    snippet(faq_fts, 1, char(2), char(3), '…', 40)
+                FROM faq_fts
+                JOIN faq f ON f.faq_id = faq_fts.rowid
+                LEFT JOIN topics t ON f.topic_id = t.topic_id
+                WHERE faq_fts MATCH ?
+                ORDER BY bm25(faq_fts, 10.0, 1.0, 5.0)
+                LIMIT ?
+            ''', (match_query, limit or -1))
 
         results = [
             {
                 "faq_id": row[0],
                 "question": row[1],
                 "answer": row[2],
-                "topic_name": row[3]
+                "topic_name": row[3],
+                "question_snippet": row[4],
+                "answer_snippet": row[5]
             } for row in cursor.fetchall()
         ]
         conn.close()
         return results
 
+def trigrams(text: str) -> set:
+    grams = set()
+    for word in re.findall(r"\w+", fts_text(text).lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class TrigramIndex:
+    def __init__(self):
+        self.postings: Dict[str, set] = {}
+        self.documents: Dict[int, frozenset] = {}
+
+    def add(self, doc_id: int, text: str):
+        self.remove(doc_id)
+        grams = frozenset(trigrams(text))
+        self.documents[doc_id] = grams
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(doc_id)
+
+    def remove(self, doc_id: int):
+        for gram in self.documents.pop(doc_id, ()):
+            postings = self.postings.get(gram)
+            postings.discard(doc_id)
+            if not postings:
+                del self.postings[gram]
+
+    def search(self, text: str, limit: int = FAQ_SEARCH_LIMIT,
+               threshold: float = FAQ_SIMILARITY_THRESHOLD) -> List[tuple]:
+        query = trigrams(text)
+        if not query:
+            return []
+        minimum = max(1, math.ceil(threshold * len(query)))
+        grams = sorted(query, key=lambda gram: len(self.postings.get(gram, ())))
+        candidates = set()
+        for gram in grams[:len(grams) - minimum + 1]:
+            candidates.update(self.postings.get(gram, ()))
+        scored = []
+        for doc_id in candidates:
+            count = len(query & self.documents[doc_id])
+            if count < minimum:
+                continue
+            jaccard = count / (len(query) + len(self.documents[doc_id]) - count)
+            scored.append((count / len(query), jaccard, doc_id))
+        scored.sort(reverse=True)
+        return [(doc_id, score) for score, _, doc_id in scored[:limit]]
+
+def load_faq_matcher():
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT faq_id, question, keywords FROM faq")
+        for faq_id, question, keywords in cursor.fetchall():
+            faq_matcher.add(faq_id, f"{question} {keywords or ''}")
+        conn.close()
+
+def match_faq(query: str, limit: int = FAQ_SEARCH_LIMIT) -> List[Dict]:
+    matches = faq_matcher.search(query, limit)
+    if not matches:
+        return []
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        ids = [faq_id for faq_id, _ in matches]
+        cursor.execute(f'''
+            SELECT f.faq_id, f.question, f.answer, COALESCE(t.topic_name, 'Без темы') as topic_name
+            FROM faq f
+            LEFT JOIN topics t ON f.topic_id = t.topic_id
+            WHERE f.faq_id IN ({", ".join("?" * len(ids))})
+        ''', ids)
+        rows = {row[0]: row for row in cursor.fetchall()}
+        conn.close()
+    return [
+        {
+            "faq_id": faq_id,
+            "question": rows[faq_id][1],
+            "answer": rows[faq_id][2],
+            "topic_name": rows[faq_id][3],
+            "question_snippet": rows[faq_id][1],
+            "answer_snippet": rows[faq_id][2],
+            "similarity": score
+        } for faq_id, score in matches if faq_id in rows
+    ]
+
+faq_matcher = TrigramIndex()
+load_faq_matcher()
+
+class TfidfIndex:
+    def __init__(self, dim: int = FAQ_VECTOR_DIM):
+        self.dim = dim
+        self.doc_ids: List[int] = []
+        self.rows: Dict[int, int] = {}
+        self.tf = np.zeros((16, dim), dtype=np.float32)
+        self.df = np.zeros(dim, dtype=np.float32)
+        self.matrix = None
+        self.idf = None
+
+    def vectorize(self, text: str):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", fts_text(text).lower()):
+            vector[zlib.crc32(stem_token(token).encode()) % self.dim] += 1
+        return vector
+
+    def add(self, doc_id: int, text: str):
+        self.remove(doc_id)
+        if len(self.doc_ids) == len(self.tf):
+            self.tf = np.vstack([self.tf, np.zeros_like(self.tf)])
+        row = len(self.doc_ids)
+        self.tf[row] = self.vectorize(text)
+        self.df += self.tf[row] > 0
+        self.doc_ids.append(doc_id)
+        self.rows[doc_id] = row
+        self.matrix = None
+
+    def remove(self, doc_id: int):
+        row = self.rows.pop(doc_id, None)
+        if row is None:
+            return
+        self.df -= self.tf[row] > 0
+        last = len(self.doc_ids) - 1
+        if row != last:
+            self.tf[row] = self.tf[last]
+            self.doc_ids[row] = self.doc_ids[last]
+            self.rows[self.doc_ids[row]] = row
+        self.tf[last] = 0
+        self.doc_ids.pop()
+        self.matrix = None
+
+    def search(self, text: str, limit: int = FAQ_DEFLECTION_LIMIT,
+               threshold: float = FAQ_DEFLECTION_THRESHOLD) -> List[tuple]:
+        if not self.doc_ids:
+            return []
+        if self.matrix is None:
+            count = len(self.doc_ids)
+            self.idf = np.log((1 + count) / (1 + self.df)) + 1
+            weighted = np.log1p(self.tf[:count]) * self.idf
+            norms = np.linalg.norm(weighted, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            self.matrix = weighted / norms
+        query = np.log1p(self.vectorize(text)) * self.idf
+        norm = np.linalg.norm(query)
+        if not norm:
+            return []
+        scores = self.matrix @ (query / norm)
+        top = np.argsort(-scores)[:limit]
+        return [(self.doc_ids[i], float(scores[i])) for i in top if scores[i] >= threshold]
+
+def load_faq_vectors():
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT faq_id, question, answer FROM faq")
+        for faq_id, question, answer in cursor.fetchall():
+            faq_vectors.add(faq_id, f"{question} {question} {answer}")
+        conn.close()
+
+def suggest_faq(text: str) -> List[Dict]:
+    if faq_vectors is None or not FAQ_DEFLECTION_ENABLED:
+        return []
+    matches = faq_vectors.search(text)
+    if not matches:
+        return []
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        ids = [faq_id for faq_id, _ in matches]
+        cursor.execute(
+            f"SELECT faq_id, question, answer FROM faq WHERE faq_id IN ({', '.join('?' * len(ids))})",
+            ids
+        )
+        rows = {row[0]: row for row in cursor.fetchall()}
+        conn.close()
+    return [
+        {"faq_id": faq_id, "question": rows[faq_id][1], "answer": rows[faq_id][2], "score": score}
+        for faq_id, score in matches if faq_id in rows
+    ]
+
+def record_deflection(user_id: int, faq_id: Optional[int], outcome: str):
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO faq_deflections (user_id, faq_id, outcome) VALUES (?, ?, ?)",
+            (user_id, faq_id, outcome)
+        )
+        conn.commit()
+        conn.close()
+
+def get_deflection_stats() -> Dict[str, int]:
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT outcome, COUNT(*) FROM faq_deflections GROUP BY outcome")
+        stats = {"deflected": 0, "sent": 0, **dict(cursor.fetchall())}
+        conn.close()
+        return stats
+
+faq_vectors = TfidfIndex() if np is not None else None
+if faq_vectors is not None:
+    load_faq_vectors()
+
 def add_note(user_id: int, admin_id: int, note_text: str):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO notes (user_id, admin_id, note_text) VALUES (?, ?, ?)",
@@ -407,8 +1964,8 @@ def add_note(user_id: int, admin_id: int, note_text: str):
         conn.close()
 
 def get_notes(user_id: int) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT n.note_id, n.note_text, n.timestamp, u.user_id, u.username, u.first_name, u.last_name
@@ -432,10 +1989,12 @@ def get_notes(user_id: int) -> List[Dict]:
         return notes
 
 def update_message_status(message_id: int, status: str, admin_id: int = None):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
 
+        cursor.execute("SELECT assigned_admin_id, status FROM messages WHERE message_id = ?", (message_id,))
+        previous = cursor.fetchone()
         cursor.execute(
             "UPDATE messages SET status = ? WHERE message_id = ?",
             (status, message_id)
@@ -445,25 +2004,30 @@ def update_message_status(message_id: int, status: str, admin_id: int = None):
             "INSERT INTO message_status_history (message_id, status, admin_id) VALUES (?, ?, ?)",
             (message_id, status, admin_id)
         )
+        append_dialog_event(cursor, message_id, ROLE_ADMIN if admin_id else ROLE_SYSTEM, admin_id, EVENT_STATUS, status)
 
         conn.commit()
         conn.close()
+        if previous and previous[0]:
+            workload.change_status(previous[0], previous[1], status)
+        if status not in OPEN_STATUSES:
+            sla_scheduler.cancel(message_id)
 
 def get_message_status_history(message_id: int) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT h.history_id, h.status, h.timestamp, u.user_id, u.username, u.first_name, u.last_name
-            FROM message_status_history h
-            LEFT JOIN users u ON h.admin_id = u.user_id
-            WHERE h.message_id = ?
-            ORDER BY h.timestamp DESC
-        ''', (message_id,))
+            SELECT e.seq, e.body, e.timestamp, u.user_id, u.username, u.first_name, u.last_name
+            FROM dialog_events e
+            LEFT JOIN users u ON e.author_id = u.user_id
+            WHERE e.message_id = ? AND e.event_type = ?
+            ORDER BY e.seq DESC
+        ''', (message_id, EVENT_STATUS))
 
         history = [
             {
-                "history_id": row[0],
+                "seq": row[0],
                 "status": row[1],
                 "timestamp": row[2],
                 "admin_id": row[3],
@@ -475,65 +2039,123 @@ def get_message_status_history(message_id: int) -> List[Dict]:
         return history
 
 def reassign_message(message_id: int, admin_id: int):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
+        cursor.execute("SELECT assigned_admin_id, status FROM messages WHERE message_id = ?", (message_id,))
+        previous = cursor.fetchone()
         cursor.execute(
             "UPDATE messages SET assigned_admin_id = ? WHERE message_id = ?",
             (admin_id, message_id)
         )
         conn.commit()
         conn.close()
-
-def can_send_urgent(user_id: int) -> bool:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+        if previous and previous[1] in OPEN_STATUSES:
+            workload.release(previous[0])
+            workload.assign(admin_id)
+        sla_scheduler.reassign(message_id, admin_id)
+
+def get_stale_dialogs(idle_seconds: int, limit: int) -> List[Dict]:
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
-
-        cursor.execute(
-            "SELECT urgent_messages_today, last_urgent_date FROM users WHERE user_id = ?",
-            (user_id,)
-        )
-        result = cursor.fetchone()
-
-        if not result:
-            return False
-
-        count, last_date = result
-        today = datetime.now().strftime("%Y-%m-%d")
-
-        if last_date != today:
-            cursor.execute(
-                "UPDATE users SET urgent_messages_today = 0, last_urgent_date = ? WHERE user_id = ?",
-                (today, user_id)
-            )
-            conn.commit()
-            count = 0
-
+        cursor.execute(f'''
+            SELECT m.message_id, m.user_id,
+                   EXISTS (SELECT 1 FROM replies r WHERE r.message_id = m.message_id AND r.admin_id != m.user_id)
+            FROM messages m INDEXED BY idx_messages_open_activity
+            WHERE m.status IN ('{STATUS_NEW}', '{STATUS_IN_PROGRESS}') AND m.last_activity < datetime('now', ?)
+            ORDER BY m.last_activity
+            LIMIT ?
+        ''', (f"-{int(idle_seconds)} seconds", limit))
+        dialogs = [{"message_id": row[0], "user_id": row[1], "answered": bool(row[2])} for row in cursor.fetchall()]
         conn.close()
-        return count < MAX_URGENT_PER_DAY
+        return dialogs
 
-def increment_urgent_count(user_id: int):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+def get_assigned_admin(message_id: int) -> Optional[int]:
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
-        today = datetime.now().strftime("%Y-%m-%d")
-
-        cursor.execute('''
-            UPDATE users
-            SET urgent_messages_today = urgent_messages_today + 1,
-                last_urgent_date = ?
-            WHERE user_id = ?
-        ''', (today, user_id))
-
-        conn.commit()
+        cursor.execute("SELECT assigned_admin_id FROM messages WHERE message_id = ?", (message_id,))
+        row = cursor.fetchone()
         conn.close()
+        return row[0] if row else None
+
+class QuotaService:
+    def __init__(self, quotas: Dict[str, int] = QUOTAS, cache_size: int = QUOTA_CACHE_SIZE):
+        self.quotas = quotas
+        self.cache_size = cache_size
+        self.counters: OrderedDict = OrderedDict()
+        self.denied_total = 0
+
+    @staticmethod
+    def today() -> str:
+        return datetime.now().strftime("%Y-%m-%d")
+
+    def counter(self, user_id: int, key: str, today: str) -> list:
+        counter = self.counters.get((user_id, key))
+        if counter is None:
+            with capture_errors:
+                conn = get_connection()
+                cursor = conn.cursor()
+                cursor.execute("SELECT day, used FROM quota_usage WHERE user_id = ? AND quota_key = ?", (user_id, key))
+                row = cursor.fetchone()
+                conn.close()
+            counter = list(row) if row else [today, 0]
+            self.counters[(user_id, key)] = counter
+            if len(self.counters) > self.cache_size:
+                self.counters.popitem(last=False)
+        else:
+            self.counters.move_to_end((user_id, key))
+        if counter[0] != today:
+            counter[0], counter[1] = today, 0
+        return counter
+
+    def usage(self, user_id: int, key: str) -> tuple:
+        return self.counter(user_id, key, self.today())[1], self.quotas.get(key)
+
+    def consume(self, user_id: int, keys: List[str]) -> Optional[str]:
+        today = self.today()
+        keys = [key for key in keys if key in self.quotas]
+        counters = {key: self.counter(user_id, key, today) for key in keys}
+        for key, counter in counters.items():
+            if counter[1] >= self.quotas[key]:
+                self.denied_total += 1
+                return key
+        for counter in counters.values():
+            counter[1] += 1
+        if not keys:
+            return None
+        with capture_errors:
+            conn = get_connection()
+            cursor = conn.cursor()
+            exhausted = None
+            for key in keys:
+                cursor.execute('''
+                    INSERT INTO quota_usage (user_id, quota_key, day, used) VALUES (?, ?, ?, 1)
+                    ON CONFLICT (user_id, quota_key) DO UPDATE SET
+                        used = CASE WHEN day = excluded.day THEN used + 1 ELSE 1 END,
+                        day = excluded.day
+                    WHERE day != excluded.day OR used < ?
+                ''', (user_id, key, today, self.quotas[key]))
+                if cursor.rowcount == 0:
+                    exhausted = key
+                    break
+            if exhausted:
+                conn.rollback()
+                for key, counter in counters.items():
+                    counter[1] = self.quotas[key] if key == exhausted else counter[1] - 1
+                self.denied_total += 1
+            else:
+                conn.commit()
+            conn.close()
+            return exhausted
 
+quota_service = QuotaService()
 
 def get_user(user_id: int, update_from_telegram: bool = True, context: ContextTypes.DEFAULT_TYPE = None) -> Optional[
     Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         user = cursor.fetchone()
@@ -555,6 +2177,7 @@ def get_user(user_id: int, update_from_telegram: bool = True, context: ContextTy
                         cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
                         user = cursor.fetchone()
             except Exception as e:
+                record_error(e)
                 logger.error(f"Error updating user data from Telegram: {e}")
 
         conn.close()
@@ -579,8 +2202,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     get_user(user.id, update_from_telegram=True, context=context)
 
 def update_user(user_id: int, username: str, first_name: str, last_name: str):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE users SET username = ?, first_name = ?, last_name = ? WHERE user_id = ?",
@@ -592,8 +2215,8 @@ def update_user(user_id: int, username: str, first_name: str, last_name: str):
 
 def add_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None,
              update_from_telegram: bool = True, context: ContextTypes.DEFAULT_TYPE = None):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
 
         if update_from_telegram and context:
@@ -604,6 +2227,7 @@ def add_user(user_id: int, username: str = None, first_name: str = None, last_na
                     first_name = tg_user.first_name
                     last_name = tg_user.last_name or ''
             except Exception as e:
+                record_error(e)
                 logger.error(f"Error getting user data from Telegram: {e}")
 
         cursor.execute(
@@ -617,8 +2241,8 @@ def add_user(user_id: int, username: str = None, first_name: str = None, last_na
 
 
 async def check_user_updates(context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT user_id FROM users")
         user_ids = [row[0] for row in cursor.fetchall()]
@@ -634,14 +2258,15 @@ async def check_user_updates(context: ContextTypes.DEFAULT_TYPE):
                         (tg_user.username, tg_user.first_name, tg_user.last_name or '', user_id)
                     )
             except Exception as e:
+                record_error(e)
                 logger.error(f"Error updating user {user_id}: {e}")
 
         conn.commit()
         conn.close()
 
 def get_topics() -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM topics")
         topics = [{"topic_id": row[0], "topic_name": row[1], "description": row[2], "is_quick_action": bool(row[3])} for row in cursor.fetchall()]
@@ -649,29 +2274,37 @@ def get_topics() -> List[Dict]:
         return topics
 
 def add_topic(topic_name: str, description: str):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("INSERT INTO topics (topic_name, description) VALUES (?, ?)", (topic_name, description))
         conn.commit()
         conn.close()
 
-def add_message(user_id: int, topic_id: int, message_text: str, is_anonymous: bool = False, priority: str = PRIORITY_NORMAL):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+def add_message(user_id: int, topic_id: int, message_text: str, is_anonymous: bool = False, priority: str = PRIORITY_NORMAL,
+                cluster_id: int = None, assigned_admin_id: int = None):
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute(
-            "INSERT INTO messages (user_id, topic_id, message_text, is_anonymous, priority, assigned_admin_id, status) VALUES (?, ?, ?, ?, ?, NULL, ?)",
-            (user_id, topic_id, message_text, is_anonymous, priority, STATUS_NEW)
+            "INSERT INTO messages (user_id, topic_id, message_text, is_anonymous, priority, assigned_admin_id, status, cluster_id, last_activity) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+            (user_id, topic_id, message_text, is_anonymous, priority, assigned_admin_id, STATUS_NEW, cluster_id)
         )
         message_id = cursor.lastrowid
+        if cluster_id is None:
+            cursor.execute("UPDATE messages SET cluster_id = message_id WHERE message_id = ?", (message_id,))
+        append_dialog_event(cursor, message_id, ROLE_USER, user_id, EVENT_MESSAGE, message_text)
+        cursor.execute(
+            "INSERT INTO dialog_fts (body, message_id) VALUES (?, ?)",
+            (fts_text(message_text), message_id)
+        )
         conn.commit()
         conn.close()
         return message_id
 
 def get_user_messages(user_id: int, page: int = 1, per_page: int = 5) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         offset = (page - 1) * per_page
         cursor.execute('''
@@ -701,8 +2334,8 @@ def get_user_messages(user_id: int, page: int = 1, per_page: int = 5) -> List[Di
         return messages
 
 def get_message_details(message_id: int) -> Optional[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT m.message_id, m.user_id, m.message_text, m.timestamp,
@@ -715,34 +2348,10 @@ def get_message_details(message_id: int) -> Optional[Dict]:
         ''', (message_id,))
 
         message = cursor.fetchone()
+        conn.close()
         if not message:
-            conn.close()
             return None
 
-        cursor.execute('''
-            SELECT r.reply_text, r.timestamp, u.username, u.first_name, u.last_name
-            FROM replies r
-            JOIN users u ON r.admin_id = u.user_id
-            WHERE r.message_id = ?
-            ORDER BY r.timestamp
-        ''', (message_id,))
-
-        replies = []
-        for reply in cursor.fetchall():
-            replies.append({
-                "text": reply[0],
-                "timestamp": reply[1],
-                "username": reply[2],
-                "first_name": reply[3],
-                "last_name": reply[4]
-            })
-
-        attachments = get_attachment(message_id)
-        notes = get_notes(message[1])
-        status_history = get_message_status_history(message_id)
-
-        conn.close()
-
         return {
             "message_id": message[0],
             "user_id": message[1],
@@ -755,28 +2364,113 @@ def get_message_details(message_id: int) -> Optional[Dict]:
             "is_anonymous": bool(message[8]),
             "status": message[9],
             "priority": message[10],
-            "assigned_admin_id": message[11],
-            "replies": replies,
-            "attachments": attachments,
-            "notes": notes,
-            "status_history": status_history
+            "assigned_admin_id": message[11]
         }
 
-def add_reply(message_id: int, admin_id: int, reply_text: str):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+def get_dialog_events(message_id: int, before: int = None, after: int = None, limit: int = DIALOG_PAGE_SIZE,
+                      event_types: tuple = (EVENT_MESSAGE, EVENT_REPLY, EVENT_ATTACHMENT)) -> List[Dict]:
+    # One range scan of the (message_id, seq) primary key: newest first below `before`, oldest first above `after`.
+    # seq 0 is the opening message, which the dialog header already shows.
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        if after is not None:
+            condition, order, bound = "e.seq > ?", "ASC", after
+        else:
+            condition, order, bound = "e.seq > 0 AND e.seq < ?", "DESC", before or sys.maxsize
+        cursor.execute(f'''
+            SELECT e.seq, e.author_role, e.author_id, e.event_type, e.body, e.attachment_id, e.timestamp, u.username
+            FROM dialog_events e
+            LEFT JOIN users u ON e.author_id = u.user_id
+            WHERE e.message_id = ? AND {condition} AND e.event_type IN ({", ".join("?" * len(event_types))})
+            ORDER BY e.seq {order}
+            LIMIT ?
+        ''', (message_id, bound, *event_types, limit))
+
+        events = [
+            {
+                "seq": row[0],
+                "author_role": row[1],
+                "author_id": row[2],
+                "event_type": row[3],
+                "body": row[4],
+                "attachment_id": row[5],
+                "timestamp": row[6],
+                "username": row[7]
+            } for row in cursor.fetchall()
+        ]
+        conn.close()
+        return events
+
+def add_reply(message_id: int, admin_id: int, reply_text: str, author_role: str = ROLE_ADMIN):
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO replies (message_id, admin_id, reply_text) VALUES (?, ?, ?)",
             (message_id, admin_id, reply_text)
         )
-        cursor.execute("UPDATE messages SET is_read = TRUE, status = ? WHERE message_id = ?", (STATUS_IN_PROGRESS, message_id))
+        append_dialog_event(
+            cursor, message_id, author_role, admin_id,
+            EVENT_REPLY if author_role == ROLE_ADMIN else EVENT_MESSAGE, reply_text
+        )
+        cursor.execute(
+            "INSERT INTO dialog_fts (body, message_id) VALUES (?, ?)",
+            (fts_text(reply_text), message_id)
+        )
+        cursor.execute(
+            "UPDATE messages SET is_read = TRUE, status = ?, last_activity = CURRENT_TIMESTAMP WHERE message_id = ?",
+            (STATUS_IN_PROGRESS, message_id)
+        )
+        conn.commit()
+        conn.close()
+        if admin_id in workload.online:
+            sla_scheduler.cancel(message_id)
+
+def add_cluster_reply(cluster_id: int, admin_id: int, reply_text: str) -> List[Dict]:
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT message_id, user_id FROM messages WHERE cluster_id = ? AND status IN (?, ?)",
+            (cluster_id, STATUS_NEW, STATUS_IN_PROGRESS)
+        )
+        members = [{"message_id": row[0], "user_id": row[1]} for row in cursor.fetchall()]
+        cursor.executemany(
+            "INSERT INTO replies (message_id, admin_id, reply_text) VALUES (?, ?, ?)",
+            [(member['message_id'], admin_id, reply_text) for member in members]
+        )
+        for member in members:
+            append_dialog_event(cursor, member['message_id'], ROLE_ADMIN, admin_id, EVENT_REPLY, reply_text)
+        cursor.executemany(
+            "INSERT INTO dialog_fts (body, message_id) VALUES (?, ?)",
+            [(fts_text(reply_text), member['message_id']) for member in members]
+        )
+        cursor.execute(
+            "UPDATE messages SET is_read = TRUE, status = ?, last_activity = CURRENT_TIMESTAMP WHERE cluster_id = ? AND status IN (?, ?)",
+            (STATUS_IN_PROGRESS, cluster_id, STATUS_NEW, STATUS_IN_PROGRESS)
+        )
         conn.commit()
         conn.close()
+        for member in members:
+            sla_scheduler.cancel(member['message_id'])
+        return members
+
+def get_cluster_size(cluster_id: int) -> int:
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM messages WHERE cluster_id = ? AND status IN (?, ?)",
+            (cluster_id, STATUS_NEW, STATUS_IN_PROGRESS)
+        )
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
 
 def get_all_messages(page: int = 1, per_page: int = 10) -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         offset = (page - 1) * per_page
         cursor.execute('''
@@ -813,42 +2507,151 @@ def get_all_messages(page: int = 1, per_page: int = 10) -> List[Dict]:
         return messages
 
 def get_total_messages_count() -> int:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM messages")
         count = cursor.fetchone()[0]
         conn.close()
         return count
 
+def parse_dialog_search(text: str) -> Dict:
+    search = {"query": [], "topic_id": None, "status": None, "priority": None, "date_from": None, "date_to": None}
+    for word in text.split():
+        key, _, value = word.partition(":")
+        key = key.lower()
+        if not value:
+            search["query"].append(word)
+        elif key == "topic":
+            if value.isdigit():
+                search["topic_id"] = int(value)
+            else:
+                topic = next((t for t in get_topics() if t['topic_name'].lower().startswith(value.lower())), None)
+                search["topic_id"] = topic['topic_id'] if topic else -1
+        elif key == "status" and value in (STATUS_NEW, STATUS_IN_PROGRESS, STATUS_RESOLVED, STATUS_CLOSED):
+            search["status"] = value
+        elif key == "priority" and value in (PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH, PRIORITY_URGENT):
+            search["priority"] = value
+        elif key in ("from", "to") and re.fullmatch(r"\d{4}-\d{2}-\d{2}", value):
+            search["date_from" if key == "from" else "date_to"] = value
+        else:
+            search["query"].append(word)
+    search["query"] = " ".join(search["query"])
+    return search
+
+def search_dialogs(query: str = "", topic_id: int = None, status: str = None, priority: str = None,
+                   date_from: str = None, date_to: str = None, before_id: int = None,
+                   limit: int = DIALOG_SEARCH_PAGE_SIZE) -> List[Dict]:
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+
+        conditions = []
+        params = []
+        match_query = fts_match_query(query)
+        if match_query:
+            conditions.append("m.message_id IN (SELECT message_id FROM dialog_fts WHERE dialog_fts MATCH ?)")
+            params.append(match_query)
+        if topic_id is not None:
+            conditions.append("m.topic_id = ?")
+            params.append(topic_id)
+        if status:
+            conditions.append("m.status = ?")
+            params.append(status)
+        if priority:
+            conditions.append("m.priority = ?")
+            params.append(priority)
+        if date_from:
+            conditions.append("m.timestamp >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("m.timestamp < date(?, '+1 day')")
+            params.append(date_to)
+        if before_id:
+            conditions.append("m.message_id < ?")
+            params.append(before_id)
+
+        cursor.execute(f'''
+            SELECT m.message_id, m.message_text, m.timestamp, m.status, m.priority,
+                   COALESCE(t.topic_name, 'Без темы')
+            FROM messages m
+            LEFT JOIN topics t ON m.topic_id = t.topic_id
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+            ORDER BY m.message_id DESC
+            LIMIT ?
+        ''', (*params, limit))
+
+        results = [
+            {
+                "message_id": row[0],
+                "snippet": html.escape((row[1] or "")[:100]),
+                "timestamp": row[2],
+                "status": row[3],
+                "priority": row[4],
+                "topic_name": row[5]
+            } for row in cursor.fetchall()
+        ]
+
+        if match_query and results:
+            ids = [result["message_id"] for result in results]
+            cursor.execute(f'''
+                SELECT message_id, snippet(dialog_fts, 0, char(2), char(3), '…', 12)
+                FROM dialog_fts
+                WHERE dialog_fts MATCH ? AND message_id IN ({", ".join("?" * len(ids))})
+                ORDER BY rank
+            ''', (match_query, *ids))
+            snippets = {}
+            for message_id, snippet in cursor.fetchall():
+                snippets.setdefault(message_id, highlight_snippet(snippet))
+            for result in results:
+                result["snippet"] = snippets.get(result["message_id"], result["snippet"])
+
+        conn.close()
+        return results
+
 def get_all_users() -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, username, first_name, last_name FROM users WHERE is_banned = FALSE")
         users = [{"user_id": row[0], "username": row[1], "first_name": row[2], "last_name": row[3]} for row in cursor.fetchall()]
         conn.close()
         return users
 
-def ban_user(user_id: int):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+def ban_user(user_id: int, until: float = None):
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute("UPDATE users SET is_banned = TRUE WHERE user_id = ?", (user_id,))
+        cursor.execute("UPDATE users SET is_banned = TRUE, banned_until = ? WHERE user_id = ?", (until, user_id))
         conn.commit()
         conn.close()
 
-def unban_user(user_id: int):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+def unban_user(user_id: int, banned_until: float = None):
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute("UPDATE users SET is_banned = FALSE WHERE user_id = ?", (user_id,))
+        if banned_until is None:
+            cursor.execute("UPDATE users SET is_banned = FALSE, banned_until = NULL WHERE user_id = ?", (user_id,))
+        else:
+            cursor.execute(
+                "UPDATE users SET is_banned = FALSE, banned_until = NULL WHERE user_id = ? AND banned_until = ?",
+                (user_id, banned_until)
+            )
         conn.commit()
         conn.close()
 
+def get_temporary_bans() -> List[Dict]:
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, banned_until FROM users WHERE is_banned = TRUE AND banned_until IS NOT NULL")
+        bans = [{"user_id": row[0], "banned_until": row[1]} for row in cursor.fetchall()]
+        conn.close()
+        return bans
+
 def is_admin(user_id: int) -> bool:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT 1 FROM admins WHERE admin_id = ?", (user_id,))
         result = bool(cursor.fetchone())
@@ -856,18 +2659,20 @@ def is_admin(user_id: int) -> bool:
         return result
 
 def add_admin(admin_id: int, added_by: int, username: str = None):
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (admin_id, username))
         cursor.execute("INSERT OR IGNORE INTO admins (admin_id, added_by, username) VALUES (?, ?, ?)",
                        (admin_id, added_by, username))
         conn.commit()
         conn.close()
+        rate_limiter.exempt.pop(admin_id, None)
+        workload.add_admin(admin_id)
 
 def get_all_admins() -> List[Dict]:
-    with suppress_stderr():
-        conn = sqlite3.connect('feedback.db')
+    with capture_errors:
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT a.admin_id, u.username, u.first_name, u.last_name, a.added_date
@@ -879,8 +2684,283 @@ def get_all_admins() -> List[Dict]:
         conn.close()
         return admins
 
+def set_admin_online(admin_id: int, is_online: bool):
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE admins SET is_online = ? WHERE admin_id = ?", (is_online, admin_id))
+        conn.commit()
+        conn.close()
+        workload.online[admin_id] = is_online
+
+class SubscriptionMap:
+    def __init__(self):
+        self.by_topic: Dict[int, set] = {}
+        self.sent_total = 0
+        self.baseline_total = 0
+
+    def load(self):
+        with capture_errors:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT admin_id, topic_id FROM admin_topic_subscriptions")
+            self.by_topic = {}
+            for admin_id, topic_id in cursor.fetchall():
+                self.by_topic.setdefault(topic_id, set()).add(admin_id)
+            conn.close()
+
+    def topics_for(self, admin_id: int) -> set:
+        return {topic_id for topic_id, admins in self.by_topic.items() if admin_id in admins}
+
+    def record(self, sent: int, baseline: int):
+        self.sent_total += sent
+        self.baseline_total += baseline
+
+def toggle_topic_subscription(admin_id: int, topic_id: int) -> bool:
+    with capture_errors:
+        conn = get_connection()
+        cursor = conn.cursor()
+        subscribers = topic_subscriptions.by_topic.setdefault(topic_id, set())
+        if admin_id in subscribers:
+            cursor.execute("DELETE FROM admin_topic_subscriptions WHERE admin_id = ? AND topic_id = ?", (admin_id, topic_id))
+            subscribers.discard(admin_id)
+        else:
+            cursor.execute("INSERT OR IGNORE INTO admin_topic_subscriptions (admin_id, topic_id) VALUES (?, ?)", (admin_id, topic_id))
+            subscribers.add(admin_id)
+        if not subscribers:
+            del topic_subscriptions.by_topic[topic_id]
+        conn.commit()
+        conn.close()
+        return admin_id in subscribers
+
+def notification_targets(topic_id: Optional[int]) -> List[int]:
+    subscribers = topic_subscriptions.by_topic.get(topic_id)
+    return list(subscribers) if subscribers else workload.online_admins() or list(workload.online)
+
+topic_subscriptions = SubscriptionMap()
+topic_subscriptions.load()
+
+class WorkloadIndex:
+    def __init__(self, strategy: str = ASSIGNMENT_STRATEGY, weights: Dict[int, float] = ADMIN_WEIGHTS,
+                 skills: Dict[int, set] = ADMIN_TOPIC_SKILLS):
+        self.strategy = strategy
+        self.weights = weights
+        self.skills = skills
+        self.open_counts: Dict[int, int] = {}
+        self.online: Dict[int, bool] = {}
+        self.current: Dict[int, float] = {}
+        self.assigned_total = 0
+        self.unassigned_total = 0
+
+    def load(self):
+        with capture_errors:
+            conn = get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT admin_id, is_online FROM admins")
+            self.online = {row[0]: row[1] is None or bool(row[1]) for row in cursor.fetchall()}
+            self.open_counts = {admin_id: 0 for admin_id in self.online}
+            cursor.execute(
+                "SELECT assigned_admin_id, COUNT(*) FROM messages WHERE status IN (?, ?) AND assigned_admin_id IS NOT NULL GROUP BY assigned_admin_id",
+                OPEN_STATUSES
+            )
+            for admin_id, count in cursor.fetchall():
+                if admin_id in self.open_counts:
+                    self.open_counts[admin_id] = count
+            conn.close()
+
+    def add_admin(self, admin_id: int):
+        self.online.setdefault(admin_id, True)
+        self.open_counts.setdefault(admin_id, 0)
+
+    def remove_admin(self, admin_id: int):
+        self.online.pop(admin_id, None)
+        self.open_counts.pop(admin_id, None)
+        self.current.pop(admin_id, None)
+
+    def weight(self, admin_id: int) -> float:
+        return self.weights.get(admin_id, 1)
+
+    def online_admins(self, exclude: tuple = ()) -> List[int]:
+        return [admin_id for admin_id, is_online in self.online.items() if is_online and admin_id not in exclude]
+
+    def candidates(self, topic_id: Optional[int], exclude: tuple = ()) -> List[int]:
+        online = self.online_admins(exclude)
+        subscribers = topic_subscriptions.by_topic.get(topic_id, ())
+        skilled = [admin_id for admin_id in online if admin_id not in self.skills or topic_id in self.skills[admin_id]]
+        subscribed = [admin_id for admin_id in online if admin_id in subscribers]
+        return [admin_id for admin_id in skilled if admin_id in subscribers] or skilled or subscribed or online
+
+    def pick(self, topic_id: Optional[int], exclude: tuple = ()) -> Optional[int]:
+        candidates = self.candidates(topic_id, exclude)
+        if not candidates:
+            self.unassigned_total += 1
+            return None
+        if self.strategy == "weighted_round_robin":
+            total = 0
+            for admin_id in candidates:
+                self.current[admin_id] = self.current.get(admin_id, 0) + self.weight(admin_id)
+                total += self.weight(admin_id)
+            chosen = max(candidates, key=lambda admin_id: self.current[admin_id])
+            self.current[chosen] -= total
+        else:
+            chosen = self.least_loaded(candidates)
+        self.assigned_total += 1
+        return chosen
+
+    def least_loaded(self, candidates: List[int]) -> int:
+        return min(candidates, key=lambda admin_id: (self.open_counts.get(admin_id, 0) / self.weight(admin_id), admin_id))
+
+    def assign(self, admin_id: Optional[int]):
+        if admin_id in self.open_counts:
+            self.open_counts[admin_id] += 1
+
+    def release(self, admin_id: Optional[int]):
+        if self.open_counts.get(admin_id):
+            self.open_counts[admin_id] -= 1
+
+    def change_status(self, admin_id: int, old_status: str, new_status: str):
+        if old_status in OPEN_STATUSES and new_status not in OPEN_STATUSES:
+            self.release(admin_id)
+        elif old_status not in OPEN_STATUSES and new_status in OPEN_STATUSES:
+            self.assign(admin_id)
+
+workload = WorkloadIndex()
+workload.load()
+
+class IndexedHeap:
+    def __init__(self):
+        self.heap: List[list] = []
+        self.position: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.position
+
+    def push(self, key: int, priority: float):
+        if key in self.position:
+            index = self.position[key]
+            old = self.heap[index][0]
+            self.heap[index][0] = priority
+            if priority < old:
+                self.sift_up(index)
+            else:
+                self.sift_down(index)
+            return
+        self.heap.append([priority, key])
+        self.position[key] = len(self.heap) - 1
+        self.sift_up(len(self.heap) - 1)
+
+    def peek(self) -> Optional[list]:
+        return self.heap[0] if self.heap else None
+
+    def pop(self) -> list:
+        return self.remove(self.heap[0][1])
+
+    def remove(self, key: int) -> Optional[list]:
+        index = self.position.pop(key, None)
+        if index is None:
+            return None
+        entry = self.heap[index]
+        last = self.heap.pop()
+        if index < len(self.heap):
+            self.heap[index] = last
+            self.position[last[1]] = index
+            self.sift_up(index)
+            self.sift_down(self.position[last[1]])
+        return entry
+
+    def swap(self, i: int, j: int):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.position[self.heap[i][1]] = i
+        self.position[self.heap[j][1]] = j
+
+    def sift_up(self, index: int):
+        while index > 0:
+            parent = (index - 1) // 2
+            if self.heap[index][0] >= self.heap[parent][0]:
+                break
+            self.swap(index, parent)
+            index = parent
+
+    def sift_down(self, index: int):
+        size = len(self.heap)
+        while True:
+            smallest = index
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size and self.heap[child][0] < self.heap[smallest][0]:
+                    smallest = child
+            if smallest == index:
+                break
+            self.swap(index, smallest)
+            index = smallest
+
+class SlaScheduler:
+    def __init__(self, deadlines: Dict[str, int] = SLA_DEADLINES):
+        self.deadlines = deadlines
+        self.heap = IndexedHeap()
+        self.dialogs: Dict[int, Dict] = {}
+        self.breaches_total = 0
+
+    def load(self):
+        with capture_errors:
+            conn = get_connection()
+            cursor = conn.cursor()
+            priorities = list(self.deadlines)
+            cursor.execute(f'''
+                SELECT m.message_id, m.priority, m.topic_id, m.assigned_admin_id, CAST(strftime('%s', m.timestamp) AS INTEGER)
+                FROM messages m
+                WHERE m.status IN (?, ?) AND m.priority IN ({",".join("?" * len(priorities))})
+                AND NOT EXISTS (
+                    SELECT 1 FROM replies r JOIN admins a ON a.admin_id = r.admin_id WHERE r.message_id = m.message_id
+                )
+            ''', (*OPEN_STATUSES, *priorities))
+            rows = cursor.fetchall()
+            conn.close()
+        self.heap = IndexedHeap()
+        self.dialogs = {}
+        for message_id, priority, topic_id, admin_id, created in rows:
+            self.schedule(message_id, priority, topic_id, admin_id, created)
+
+    def schedule(self, message_id: int, priority: str, topic_id: Optional[int], admin_id: Optional[int],
+                 created: float = None):
+        deadline = self.deadlines.get(priority)
+        if not deadline:
+            return
+        created = created or time.time()
+        self.dialogs[message_id] = {
+            "priority": priority, "topic_id": topic_id, "admin_id": admin_id, "created": created, "level": 0
+        }
+        self.heap.push(message_id, created + deadline)
+
+    def cancel(self, message_id: int):
+        if self.heap.remove(message_id) is not None:
+            del self.dialogs[message_id]
+
+    def reassign(self, message_id: int, admin_id: int):
+        if message_id in self.dialogs:
+            self.dialogs[message_id]['admin_id'] = admin_id
+
+    def due(self, now: float) -> List[tuple]:
+        breached = []
+        while self.heap and self.heap.peek()[0] <= now:
+            _, message_id = self.heap.pop()
+            dialog = self.dialogs[message_id]
+            breached.append((message_id, dict(dialog)))
+            dialog['level'] += 1
+            if dialog['level'] > 2:
+                del self.dialogs[message_id]
+            else:
+                self.heap.push(message_id, now + self.deadlines[dialog['priority']])
+        self.breaches_total += len(breached)
+        return breached
+
+sla_scheduler = SlaScheduler()
+sla_scheduler.load()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             user = update.effective_user
             add_user(user.id, user.username, user.first_name, user.last_name,
@@ -909,29 +2989,88 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+CALLBACK_VERSION = "2"
+CALLBACK_DATA_LIMIT = 64
+MESSAGE_TEXT_LIMIT = 4096
+DIALOG_PREVIEW_LENGTH = 300
+
+def encode_callback(action: str, *args: int) -> str:
+    data = ":".join((CALLBACK_VERSION, action, *map(str, args)))
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data exceeds {CALLBACK_DATA_LIMIT} bytes: {data}")
+    return data
+
+def callback_pattern(action: str, arity: int = 0) -> str:
+    return f"^{CALLBACK_VERSION}:{action}" + r"(?::\d+)" * arity + "$"
+
+@functools.lru_cache(maxsize=4096)
+def parse_callback_data(data: str) -> Optional[tuple]:
+    version, _, payload = data.partition(":")
+    if version != CALLBACK_VERSION or not payload.isascii():
+        return None
+    action, *args = payload.split(":")
+    if (action, len(args)) not in CALLBACK_ROUTES or not all(map(str.isdigit, args)):
+        return None
+    return action, tuple(map(int, args))
+
+def callback_action(query: CallbackQuery) -> Optional[str]:
+    parsed = parse_callback_data(query.data or "")
+    return parsed[0] if parsed else None
+
+def callback_args(query: CallbackQuery) -> tuple:
+    parsed = parse_callback_data(query.data or "")
+    return parsed[1] if parsed else ()
+
 def main_menu_keyboard(is_admin_user: bool):
     keyboard = [
-        [InlineKeyboardButton("📨 Написать сообщение", callback_data="write_message")],
-        [InlineKeyboardButton("🔍 Поиск в ЧаВо", callback_data="search_faq")],
-        [InlineKeyboardButton("📖 История диалогов", callback_data="message_history")],
-        [InlineKeyboardButton("👤 Мой профиль", callback_data="user_profile")]
+        [InlineKeyboardButton("📨 Написать сообщение", callback_data=encode_callback("write_message"))],
+        [InlineKeyboardButton("🔍 Поиск в ЧаВо", callback_data=encode_callback("search_faq"))],
+        [InlineKeyboardButton("📖 История диалогов", callback_data=encode_callback("message_history"))],
+        [InlineKeyboardButton("👤 Мой профиль", callback_data=encode_callback("user_profile"))]
     ]
     if is_admin_user:
-        keyboard.append([InlineKeyboardButton("🔐 Админ-панель", callback_data="admin_panel")])
+        keyboard.append([InlineKeyboardButton("🔐 Админ-панель", callback_data=encode_callback("admin_panel"))])
     return InlineKeyboardMarkup(keyboard)
 
 def admin_menu_keyboard():
     keyboard = [
-        [InlineKeyboardButton("📂 Все диалоги", callback_data="admin_all_dialogs")],
-        [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")],
-        [InlineKeyboardButton("👥 Управление админами", callback_data="admin_manage_admins")],
-        [InlineKeyboardButton("📝 Управление темами", callback_data="admin_manage_topics")],
-        [InlineKeyboardButton("❓ Управление ЧаВо", callback_data="admin_manage_faq")],
-        [InlineKeyboardButton("📊 Статистика оценок", callback_data="admin_view_ratings")],
-        [InlineKeyboardButton("🔙 В главное меню", callback_data="back_to_menu")]
+        [InlineKeyboardButton("📂 Все диалоги", callback_data=encode_callback("admin_all_dialogs"))],
+        [InlineKeyboardButton("🔎 Поиск по диалогам", callback_data=encode_callback("admin_search_dialogs"))],
+        [InlineKeyboardButton("📢 Рассылка", callback_data=encode_callback("admin_broadcast"))],
+        [InlineKeyboardButton("👥 Управление админами", callback_data=encode_callback("admin_manage_admins"))],
+        [InlineKeyboardButton("📝 Управление темами", callback_data=encode_callback("admin_manage_topics"))],
+        [InlineKeyboardButton("❓ Управление ЧаВо", callback_data=encode_callback("admin_manage_faq"))],
+        [InlineKeyboardButton("📊 Статистика оценок", callback_data=encode_callback("admin_view_ratings"))],
+        [InlineKeyboardButton("🐢 Медленные запросы", callback_data=encode_callback("admin_slow_queries"))],
+        [InlineKeyboardButton("🔙 В главное меню", callback_data=encode_callback("back_to_menu"))]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+async def answer_callback(query: CallbackQuery, text: str = None, show_alert: bool = False):
+    budget = api_budget.get()
+    if budget is not None:
+        if query.id in budget.answered:
+            return
+        budget.answered.add(query.id)
+    await query.answer(text, show_alert=show_alert)
+
+def message_unchanged(message, text: str, reply_markup, parse_mode: str = None) -> bool:
+    if not isinstance(message, Message) or message.text is None or message.reply_markup != reply_markup:
+        return False
+    text = text.strip()
+    return message.text_html == (text if parse_mode == 'HTML' else html.escape(text))
+
+async def edit_query_message(query: CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup = None,
+                             parse_mode: str = None, **kwargs):
+    if message_unchanged(query.message, text, reply_markup, parse_mode):
+        return query.message
+    try:
+        return await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+    except BadRequest as e:
+        if "message is not modified" in str(e).lower():
+            return query.message
+        raise
+
 async def send_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, menu_type: str):
     user = update.effective_user
     if menu_type == "main":
@@ -942,7 +3081,7 @@ async def send_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: st
         return
     if update.callback_query:
         try:
-            await update.callback_query.edit_message_text(text=text, reply_markup=keyboard, parse_mode='HTML')
+            await edit_query_message(update.callback_query, text, reply_markup=keyboard, parse_mode='HTML')
         except BadRequest:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -959,15 +3098,15 @@ async def send_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: st
         )
 
 async def back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             await send_menu(update, context, "Главное меню:", "main")
         except Exception:
-            pass
+            record_error()
         return ConversationHandler.END
 
 async def write_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             quick_actions = [t for t in get_topics() if t['is_quick_action']]
             topics = [t for t in get_topics() if not t['is_quick_action']]
@@ -977,22 +3116,23 @@ async def write_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             for action in quick_actions:
                 keyboard.append([InlineKeyboardButton(
                     f"⚡ {action['topic_name']}",
-                    callback_data=f"select_topic_{action['topic_id']}"
+                    callback_data=encode_callback("select_topic", action['topic_id'])
                 )])
 
             if quick_actions and topics:
-                keyboard.append([InlineKeyboardButton("──────────────", callback_data="none")])
+                keyboard.append([InlineKeyboardButton("──────────────", callback_data=encode_callback("none"))])
 
             for topic in topics:
                 keyboard.append([InlineKeyboardButton(
                     f"{topic['topic_name']} - {topic['description']}",
-                    callback_data=f"select_topic_{topic['topic_id']}"
+                    callback_data=encode_callback("select_topic", topic['topic_id'])
                 )])
 
-            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_conversation")])
+            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_conversation"))])
 
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     "📝 Выберите тему для вашего сообщения:",
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
@@ -1005,55 +3145,62 @@ async def write_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             return SELECTING_TOPIC
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при выборе темы.", "main")
             return ConversationHandler.END
 
 async def select_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
+            await answer_callback(query)
 
-            if query.data == "cancel_topic_selection":
-                await query.edit_message_text(
+            if callback_action(query) == "cancel_topic_selection":
+                await edit_query_message(
+                    query,
                     "Вы отменили создание сообщения.",
                     reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
                 )
                 return ConversationHandler.END
 
-            topic_id = int(query.data.split("_")[-1])
+            topic_id = callback_args(query)[0]
             context.user_data['selected_topic'] = topic_id
 
             topics = get_topics()
             topic = next((t for t in topics if t['topic_id'] == topic_id), None)
 
             if not topic:
-                await query.edit_message_text("Ошибка: тема не найдена.")
+                await edit_query_message(query, "Ошибка: тема не найдена.")
                 return ConversationHandler.END
 
             context.user_data['topic_name'] = topic['topic_name']
 
             if topic['topic_name'] == "Срочный запрос":
-                if not can_send_urgent(query.from_user.id):
-                    await query.edit_message_text(
-                        "Вы исчерпали лимит срочных запросов на сегодня.",
-                        reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
-                    )
-                    return ConversationHandler.END
-                increment_urgent_count(query.from_user.id)
-                context.user_data['priority'] = PRIORITY_URGENT
+                priority = PRIORITY_URGENT
             elif topic['is_quick_action']:
-                context.user_data['priority'] = PRIORITY_HIGH
+                priority = PRIORITY_HIGH
             else:
-                context.user_data['priority'] = PRIORITY_NORMAL
+                priority = PRIORITY_NORMAL
+            exhausted = quota_service.consume(query.from_user.id, [f"priority:{priority}", f"topic:{topic_id}"])
+            if exhausted:
+                await edit_query_message(
+                    query,
+                    "Вы исчерпали лимит срочных запросов на сегодня."
+                    if exhausted == f"priority:{PRIORITY_URGENT}" else
+                    "Вы исчерпали лимит обращений по этой теме на сегодня.",
+                    reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
+                )
+                return ConversationHandler.END
+            context.user_data['priority'] = priority
 
             keyboard = [
-                [InlineKeyboardButton("🔒 Анонимно", callback_data="anon_yes")],
-                [InlineKeyboardButton("👤 От моего имени", callback_data="anon_no")],
-                [InlineKeyboardButton("❌ Отмена", callback_data="cancel_anon_selection")]
+                [InlineKeyboardButton("🔒 Анонимно", callback_data=encode_callback("anon_yes"))],
+                [InlineKeyboardButton("👤 От моего имени", callback_data=encode_callback("anon_no"))],
+                [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_anon_selection"))]
             ]
 
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 f"Вы выбрали тему: <b>{topic['topic_name']}</b>\n\n"
                 "Хотите отправить сообщение анонимно?",
                 parse_mode='HTML',
@@ -1061,142 +3208,406 @@ async def select_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return CONFIRM_ANONYMITY
         except Exception:
-            await query.edit_message_text("Ошибка при выборе темы.", reply_markup=main_menu_keyboard(is_admin(query.from_user.id)))
-            return ConversationHandler.END
+            record_error()
+            await edit_query_message(query, "Ошибка при выборе темы.", reply_markup=main_menu_keyboard(is_admin(query.from_user.id)))
+            return ConversationHandler.END
+
+async def confirm_anonymity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+
+            if callback_action(query) == "cancel_anon_selection":
+                await edit_query_message(
+                    query,
+                    "Вы отменили создание сообщения.",
+                    reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
+                )
+                return ConversationHandler.END
+
+            context.user_data['is_anonymous'] = callback_action(query) == "anon_yes"
+
+            await edit_query_message(
+                query,
+                f"Вы выбрали тему: <b>{context.user_data['topic_name']}</b>\n"
+                f"Режим: {'🔒 Анонимно' if context.user_data['is_anonymous'] else '👤 От моего имени'}\n\n"
+                "Напишите ваше сообщение. Можно прикрепить фото, документ или голосовое:",
+                parse_mode='HTML'
+            )
+            return WRITING_MESSAGE
+        except Exception:
+            record_error()
+            await edit_query_message(query, "Ошибка при выборе анонимности.", reply_markup=main_menu_keyboard(is_admin(query.from_user.id)))
+            return ConversationHandler.END
+
+def dialog_sent_keyboard(message_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📨 Продолжить диалог", callback_data=encode_callback("continue_dialog", message_id))],
+        [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_menu"))]
+    ])
+
+async def receive_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            user_id = update.effective_user.id
+            attachment = get_message_attachment(update.message)
+            if attachment and update.message.media_group_id:
+                buffer_media_group(context, update.message, attachment)
+                return WRITING_MESSAGE
+            message_text = update.message.text or update.message.caption or "Вложение"
+            attachments = [attachment] if attachment else []
+            if 'dialog_message_id' in context.user_data:
+                message_id = context.user_data['dialog_message_id']
+                await append_to_dialog(context, message_id, user_id, message_text, attachments)
+                await update.message.reply_text("✅ Сообщение добавлено в диалог.", reply_markup=dialog_sent_keyboard(message_id))
+                return WRITING_MESSAGE
+            suggestions = suggest_faq(update.message.text) if update.message.text else []
+            if suggestions:
+                context.user_data['pending_dialog'] = {"text": message_text, "attachments": attachments}
+                response = "🤔 Возможно, ответ на ваш вопрос уже есть в ЧаВо:\n\n"
+                for i, item in enumerate(suggestions, 1):
+                    response += (
+                        f"{i}. <b>{html.escape(item['question'])}</b>\n"
+                        f"🔹 {html.escape(item['answer'])}\n\n"
+                    )
+                if len(suggestions) == 1:
+                    solved = [InlineKeyboardButton("✅ Это помогло", callback_data=encode_callback("deflect_solved", suggestions[0]['faq_id']))]
+                else:
+                    solved = [
+                        InlineKeyboardButton(f"✅ Помог {i}", callback_data=encode_callback("deflect_solved", item['faq_id']))
+                        for i, item in enumerate(suggestions, 1)
+                    ]
+                await update.message.reply_text(
+                    response,
+                    parse_mode='HTML',
+                    reply_markup=InlineKeyboardMarkup([
+                        solved,
+                        [InlineKeyboardButton("📨 Всё равно отправить", callback_data=encode_callback("deflect_send"))],
+                        [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_conversation"))]
+                    ])
+                )
+                return SUGGESTING_FAQ
+            message_id = await submit_dialog(context, user_id, message_text, attachments)
+            await update.message.reply_text("✅ Сообщение отправлено.", reply_markup=dialog_sent_keyboard(message_id))
+            return WRITING_MESSAGE
+        except Exception:
+            record_error()
+            await update.message.reply_text(
+                "Ошибка при обработке сообщения.",
+                reply_markup=main_menu_keyboard(is_admin(user_id))
+            )
+            return ConversationHandler.END
+
+def get_message_attachment(message) -> Optional[tuple]:
+    if message.photo:
+        return message.photo[-1].file_id, "photo"
+    if message.video:
+        return message.video.file_id, "video"
+    if message.document:
+        return message.document.file_id, "document"
+    if message.voice:
+        return message.voice.file_id, "voice"
+    return None
+
+def buffer_media_group(context: ContextTypes.DEFAULT_TYPE, message: Message, attachment: tuple):
+    group = media_groups.get(message.media_group_id)
+    if group is None:
+        group = media_groups[message.media_group_id] = {
+            "chat_id": message.chat_id,
+            "user_id": message.from_user.id,
+            "dialog_message_id": context.user_data.get('dialog_message_id'),
+            "caption": None,
+            "items": []
+        }
+        context.job_queue.run_once(
+            flush_media_group, MEDIA_GROUP_WINDOW, data=message.media_group_id,
+            chat_id=message.chat_id, user_id=message.from_user.id, name=f"media_group_{message.media_group_id}"
+        )
+    group['items'].append((message.message_id, attachment))
+    if message.caption and not group['caption']:
+        group['caption'] = message.caption
+
+async def flush_media_group(context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            group = media_groups.pop(context.job.data, None)
+            if not group:
+                return
+            items = [attachment for _, attachment in sorted(group['items'])]
+            attachments = items[:MAX_ATTACHMENTS]
+            message_text = group['caption'] or "Вложение"
+            if group['dialog_message_id']:
+                message_id = group['dialog_message_id']
+                await append_to_dialog(context, message_id, group['user_id'], message_text, attachments)
+                text = "✅ Сообщение добавлено в диалог."
+            else:
+                message_id = await submit_dialog(context, group['user_id'], message_text, attachments)
+                text = "✅ Сообщение отправлено."
+            if len(items) > MAX_ATTACHMENTS:
+                text += f"\n⚠️ Сохранено вложений: {MAX_ATTACHMENTS} из {len(items)}."
+            await context.bot.send_message(chat_id=group['chat_id'], text=text, reply_markup=dialog_sent_keyboard(message_id))
+        except Exception:
+            record_error()
+            await context.bot.send_message(chat_id=context.job.chat_id, text="Ошибка при обработке сообщения.")
+
+async def append_to_dialog(context: ContextTypes.DEFAULT_TYPE, message_id: int, user_id: int, message_text: str,
+                           attachments: List[tuple]):
+    add_reply(message_id, user_id, message_text, ROLE_USER)
+    save_attachments(message_id, attachments)
+    assigned_admin_id = get_assigned_admin(message_id)
+    await notify_admins_new_message(
+        context, message_id, user_id, message_text, False, PRIORITY_NORMAL,
+        [assigned_admin_id] if assigned_admin_id else None, attachments
+    )
+
+async def submit_dialog(context: ContextTypes.DEFAULT_TYPE, user_id: int, message_text: str,
+                        attachments: List[tuple] = ()) -> int:
+    topic_id = context.user_data.get('selected_topic')
+    is_anonymous = context.user_data.get('is_anonymous', False)
+    priority = context.user_data.get('priority', PRIORITY_NORMAL)
+    signature = duplicate_detector.signature(message_text)
+    cluster_id = duplicate_detector.find_cluster(signature)
+    if cluster_id and cluster_id in cluster_alerts:
+        admin_id = cluster_alerts[cluster_id]['admin_id']
+    elif ASSIGNMENT_ENABLED:
+        admin_id = workload.pick(topic_id)
+    else:
+        admin_id = None
+    message_id = add_message(user_id, topic_id, message_text, is_anonymous, priority, cluster_id, admin_id)
+    workload.assign(admin_id)
+    sla_scheduler.schedule(message_id, priority, topic_id, admin_id)
+    duplicate_detector.add(message_id, cluster_id or message_id, signature)
+    save_attachments(message_id, list(attachments))
+    if cluster_id:
+        await update_cluster_alert(context, cluster_id, admin_id)
+    else:
+        alerts = await notify_admins_new_message(
+            context, message_id, user_id, message_text, is_anonymous, priority, [admin_id] if admin_id else None,
+            attachments
+        )
+        cluster_alerts[message_id] = {
+            "count": 1,
+            "admin_id": admin_id,
+            "messages": [(alert.chat_id, alert.message_id, alert.text) for alert in alerts]
+        }
+        while len(cluster_alerts) > DUPLICATE_WINDOW_SIZE:
+            cluster_alerts.popitem(last=False)
+    return message_id
+
+def cluster_alert_keyboard(cluster_id: int, count: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✍ Ответить", callback_data=encode_callback("reply", cluster_id))],
+        [InlineKeyboardButton(f"📣 Ответить всем ({count})", callback_data=encode_callback("reply_cluster", cluster_id))],
+        [InlineKeyboardButton("⏫ Эскалировать", callback_data=encode_callback("escalate", cluster_id))]
+    ])
+
+async def update_cluster_alert(context: ContextTypes.DEFAULT_TYPE, cluster_id: int, admin_id: int = None):
+    with capture_errors:
+        try:
+            alert = cluster_alerts.get(cluster_id)
+            if not alert:
+                count = get_cluster_size(cluster_id)
+                sent = []
+                targets = [admin_id] if admin_id else notification_targets(context.user_data.get('selected_topic'))
+                topic_subscriptions.record(len(targets), len(workload.online))
+                for target in targets:
+                    message = await context.bot.send_message(
+                        chat_id=target,
+                        text=f"👥 Похожие обращения по диалогу #{cluster_id}: {count}",
+                        reply_markup=cluster_alert_keyboard(cluster_id, count)
+                    )
+                    sent.append((message.chat_id, message.message_id, message.text))
+                cluster_alerts[cluster_id] = {"count": count, "admin_id": admin_id, "messages": sent}
+                return
+            alert['count'] += 1
+            count = alert['count']
+            if count & (count - 1):
+                return
+            for chat_id, alert_message_id, text in alert['messages']:
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=alert_message_id,
+                    text=f"{text}\n\n👥 Похожих обращений: {count}",
+                    reply_markup=cluster_alert_keyboard(cluster_id, count)
+                )
+        except Exception:
+            record_error()
 
-async def confirm_anonymity(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+async def deflect_solved(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-
-            if query.data == "cancel_anon_selection":
-                await query.edit_message_text(
-                    "Вы отменили создание сообщения.",
-                    reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
-                )
-                return ConversationHandler.END
-
-            context.user_data['is_anonymous'] = query.data == "anon_yes"
-
-            await query.edit_message_text(
-                f"Вы выбрали тему: <b>{context.user_data['topic_name']}</b>\n"
-                f"Режим: {'🔒 Анонимно' if context.user_data['is_anonymous'] else '👤 От моего имени'}\n\n"
-                "Напишите ваше сообщение. Можно прикрепить фото, документ или голосовое:",
-                parse_mode='HTML'
+            await answer_callback(query)
+            faq_id = callback_args(query)[0]
+            context.user_data.pop('pending_dialog', None)
+            record_deflection(query.from_user.id, faq_id, "deflected")
+            await edit_query_message(
+                query,
+                "😊 Рады, что ответ нашёлся! Если появятся вопросы — пишите.",
+                reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
-            return WRITING_MESSAGE
+            return ConversationHandler.END
         except Exception:
-            await query.edit_message_text("Ошибка при выборе анонимности.", reply_markup=main_menu_keyboard(is_admin(query.from_user.id)))
+            record_error()
+            await edit_query_message(
+                query,
+                "Ошибка при обработке ответа.",
+                reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
+            )
             return ConversationHandler.END
 
-async def receive_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+async def deflect_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
         try:
-            user_id = update.effective_user.id
-            if 'dialog_message_id' in context.user_data:
-                message_id = context.user_data['dialog_message_id']
-                message_text = update.message.text if update.message.text else "Вложение"
-                add_reply(message_id, user_id, message_text)
-                await notify_admins_new_message(context, message_id, user_id, message_text, False, PRIORITY_NORMAL)
-                await update.message.reply_text(
-                    "✅ Сообщение добавлено в диалог.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("📨 Продолжить диалог", callback_data=f"continue_dialog_{message_id}")],
-                        [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-                    ])
+            query = update.callback_query
+            await answer_callback(query)
+            pending = context.user_data.pop('pending_dialog', None)
+            if not pending:
+                await edit_query_message(
+                    query,
+                    "Сообщение устарело, напишите его заново.",
+                    reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
                 )
-                return WRITING_MESSAGE
-            topic_id = context.user_data.get('selected_topic')
-            is_anonymous = context.user_data.get('is_anonymous', False)
-            priority = context.user_data.get('priority', PRIORITY_NORMAL)
-            message_text = update.message.text or "Вложение"
-            message_id = add_message(user_id, topic_id, message_text, is_anonymous, priority)
-            if update.message.photo:
-                file_id = update.message.photo[-1].file_id
-                file_type = "photo"
-                save_attachment(message_id, file_id, file_type)
-            elif update.message.document:
-                file_id = update.message.document.file_id
-                file_type = "document"
-                save_attachment(message_id, file_id, file_type)
-            elif update.message.voice:
-                file_id = update.message.voice.file_id
-                file_type = "voice"
-                save_attachment(message_id, file_id, file_type)
-            await notify_admins_new_message(context, message_id, user_id, message_text, is_anonymous, priority)
-            await update.message.reply_text(
-                "✅ Сообщение отправлено.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📨 Продолжить диалог", callback_data=f"continue_dialog_{message_id}")],
-                    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-                ])
-            )
+                return ConversationHandler.END
+            record_deflection(query.from_user.id, None, "sent")
+            if 'attachments' in pending:
+                attachments = [tuple(attachment) for attachment in pending['attachments']]
+            else:
+                attachments = [tuple(pending['attachment'])] if pending.get('attachment') else []
+            message_id = await submit_dialog(context, query.from_user.id, pending['text'], attachments)
+            await edit_query_message(query, "✅ Сообщение отправлено.", reply_markup=dialog_sent_keyboard(message_id))
             return WRITING_MESSAGE
         except Exception:
-            await update.message.reply_text(
-                "Ошибка при обработке сообщения.",
-                reply_markup=main_menu_keyboard(is_admin(user_id))
+            record_error()
+            await edit_query_message(
+                query,
+                "Ошибка при отправке сообщения.",
+                reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
 
 async def continue_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            message_id = callback_args(query)[0]
             message = get_message_details(message_id)
             if not message or message['user_id'] != query.from_user.id or message['status'] == STATUS_CLOSED:
-                await query.edit_message_text(
+                await edit_query_message(
+                    query,
                     "Диалог недоступен или закрыт.",
                     reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
                 )
                 return ConversationHandler.END
             context.user_data['dialog_message_id'] = message_id
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "Введите следующее сообщение в диалоге:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Завершить диалог", callback_data=f"end_dialog_{message_id}")],
-                    [InlineKeyboardButton("🔙 Отмена", callback_data="cancel_conversation")]
+                    [InlineKeyboardButton("❌ Завершить диалог", callback_data=encode_callback("end_dialog", message_id))],
+                    [InlineKeyboardButton("🔙 Отмена", callback_data=encode_callback("cancel_conversation"))]
                 ])
             )
             return WRITING_MESSAGE
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при продолжении диалога.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
 
 async def end_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            message_id = callback_args(query)[0]
             update_message_status(message_id, STATUS_CLOSED, query.from_user.id)
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "✅ Диалог завершен.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при завершении диалога.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
 
+async def escalate_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+            message_id = callback_args(query)[0]
+            message_details = get_message_details(message_id)
+            if not message_details:
+                await edit_query_message(query, "Сообщение не найдено.")
+                return
+            admin_id = query.from_user.id
+            admin = get_user(admin_id)
+            admin_name = f"{admin['first_name']} {admin['last_name']}" if admin else "Администратор"
+            text = (
+                f"⏫ Эскалация диалога #{message_id} от {admin_name}\n"
+                f"Тема: {message_details['topic_name']}\n"
+                f"Сообщение: {message_details['message_text'][:100]}...\n"
+            )
+            targets = workload.online_admins(exclude=(admin_id,))
+            for target in targets:
+                await context.bot.send_message(
+                    chat_id=target,
+                    text=text,
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("✍ Ответить", callback_data=encode_callback("reply", message_id))]
+                    ])
+                )
+            await query.edit_message_reply_markup(
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✍ Ответить", callback_data=encode_callback("reply", message_id))]
+                ])
+            )
+            await query.message.reply_text(f"⏫ Диалог #{message_id} передан администраторам ({len(targets)}).")
+        except Exception:
+            record_error()
+
+async def admin_toggle_online(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            admin_id = update.effective_user.id
+            if not is_admin(admin_id):
+                await update.message.reply_text("Нет доступа.")
+                return
+            is_online = not workload.online.get(admin_id, True)
+            set_admin_online(admin_id, is_online)
+            response = (
+                f"{'🟢 Вы в сети, новые диалоги будут назначаться вам.' if is_online else '⚪ Вы не в сети, новые диалоги вам не назначаются.'}\n\n"
+                "📊 Открытые диалоги:\n"
+            )
+            for admin in get_all_admins():
+                status = "🟢" if workload.online.get(admin['admin_id']) else "⚪"
+                response += f"{status} @{admin['username'] or admin['admin_id']}: {workload.open_counts.get(admin['admin_id'], 0)}\n"
+            await update.message.reply_text(response)
+        except Exception:
+            record_error()
+            await update.message.reply_text("Ошибка при смене статуса.")
+
 async def admin_reply_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[1])
+            await answer_callback(query)
+            message_id = callback_args(query)[0]
             message_details = get_message_details(message_id)
             if not message_details:
-                await query.edit_message_text("Сообщение не найдено.")
+                await edit_query_message(query, "Сообщение не найдено.")
                 return ConversationHandler.END
             context.user_data['replying_to'] = message_id
             context.user_data['replying_user'] = message_details['user_id']
@@ -1211,20 +3622,75 @@ async def admin_reply_callback(update: Update, context: ContextTypes.DEFAULT_TYP
                     f"👤 От: {message_details['first_name']} {message_details['last_name']} "
                     f"(@{message_details['username'] or 'нет'})\n"
                 )
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 response + "\nВведите ваш ответ:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reply")]
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_reply"))]
+                ])
+            )
+            return ADMIN_RESPONSE
+        except Exception:
+            record_error()
+            await edit_query_message(query, "Ошибка при подготовке ответа.")
+            return ConversationHandler.END
+
+async def admin_reply_cluster_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+            cluster_id = callback_args(query)[0]
+            count = get_cluster_size(cluster_id)
+            if not count:
+                await edit_query_message(query, "Открытых обращений в этой группе нет.")
+                return ConversationHandler.END
+            context.user_data['replying_cluster'] = cluster_id
+            await query.message.reply_text(
+                f"📣 Ответ всем по группе #{cluster_id} ({count} обращений)\n\nВведите ваш ответ:",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_reply"))]
                 ])
             )
             return ADMIN_RESPONSE
         except Exception:
-            await query.edit_message_text("Ошибка при подготовке ответа.")
+            record_error()
+            await edit_query_message(query, "Ошибка при подготовке ответа.")
             return ConversationHandler.END
 
+async def admin_receive_cluster_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply_text = update.message.text
+    cluster_id = context.user_data.pop('replying_cluster')
+    admin_id = update.effective_user.id
+    members = add_cluster_reply(cluster_id, admin_id, reply_text)
+    admin = get_user(admin_id)
+    admin_name = f"{admin['first_name']} {admin['last_name']}" if admin else "Администратор"
+    for member in members:
+        try:
+            await context.bot.send_message(
+                chat_id=member['user_id'],
+                text=f"📨 Ответ от {admin_name}:\n\n{reply_text}",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("📨 Продолжить диалог", callback_data=encode_callback("continue_dialog", member['message_id']))],
+                    [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_menu"))]
+                ])
+            )
+        except Exception:
+            record_error()
+    cluster_alerts.pop(cluster_id, None)
+    await update.message.reply_text(
+        f"✅ Ответ отправлен в {len(members)} обращений.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))]
+        ])
+    )
+    return ConversationHandler.END
+
 async def admin_receive_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
+            if context.user_data.get('replying_cluster'):
+                return await admin_receive_cluster_reply(update, context)
             reply_text = update.message.text
             message_id = context.user_data['replying_to']
             user_id = context.user_data['replying_user']
@@ -1236,56 +3702,363 @@ async def admin_receive_reply(update: Update, context: ContextTypes.DEFAULT_TYPE
                 chat_id=user_id,
                 text=f"📨 Ответ от {admin_name}:\n\n{reply_text}",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📨 Продолжить диалог", callback_data=f"continue_dialog_{message_id}")],
-                    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
+                    [InlineKeyboardButton("📨 Продолжить диалог", callback_data=encode_callback("continue_dialog", message_id))],
+                    [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_menu"))]
                 ])
             )
             await update.message.reply_text(
                 "✅ Ответ отправлен.",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📨 Продолжить диалог", callback_data=f"reply_{message_id}")],
-                    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_admin_menu")]
+                    [InlineKeyboardButton("📨 Продолжить диалог", callback_data=encode_callback("reply", message_id))],
+                    [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))]
                 ])
             )
             return ADMIN_RESPONSE
         except Exception:
+            record_error()
             await update.message.reply_text("Ошибка при отправке ответа.")
             return ConversationHandler.END
 
 async def back_to_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             await send_menu(update, context, "🔑 Админ-панель:", "admin")
         except Exception:
-            pass
+            record_error()
         return ConversationHandler.END
 
 async def admin_cancel_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
+            await answer_callback(query)
+            context.user_data.pop('replying_cluster', None)
             await send_menu(update, context, "Ответ отменен.", "admin")
             return ConversationHandler.END
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при отмене ответа.", "admin")
             return ConversationHandler.END
 
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             await send_menu(update, context, "Действие отменено.", "main")
         except Exception:
-            pass
+            record_error()
         return ConversationHandler.END
 
+async def track_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        session_manager.touch(update.effective_user.id)
+
+def conversation_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[object]:
+    # PTB has no public accessor for the current state; the guard runs before the
+    # ConversationHandler, so this is the state the update is about to be handled in.
+    for handler in context.application.handlers.get(0, ()):
+        if isinstance(handler, ConversationHandler) and handler.name == "main_conversation":
+            return handler._conversations.get(handler._get_key(update))
+    return None
+
+def rate_limit_kind(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    if update.message and not (update.message.text or "").startswith("/"):
+        if conversation_state(update, context) == WRITING_MESSAGE:
+            return "follow_up" if 'dialog_message_id' in context.user_data else "new_dialog"
+    return "default"
+
+async def rate_limit_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not RATE_LIMIT_ENABLED or not user:
+        return
+    if user.id in rate_limiter.banned:
+        raise ApplicationHandlerStop
+    # Every item of an album is its own update; the album is charged once, on its first item.
+    media_group_id = update.message.media_group_id if update.message else None
+    if media_group_id is not None:
+        verdict = rate_limiter.album_verdict(user.id, media_group_id)
+        if verdict is not None:
+            if verdict:
+                return
+            raise ApplicationHandlerStop
+    kind = rate_limit_kind(update, context)
+    allowed = rate_limiter.check(user.id, kind) or rate_limiter.is_exempt(user.id)
+    if media_group_id is not None:
+        rate_limiter.record_album(user.id, media_group_id, allowed)
+    if allowed:
+        return
+    bucket = rate_limiter.buckets[(user.id, kind)]
+    with capture_errors:
+        try:
+            if rate_limiter.strike(user.id):
+                until = time.time() + RATE_LIMIT_BAN_SECONDS
+                ban_user(user.id, until)
+                rate_limiter.banned[user.id] = until
+                rate_limiter.bans_total += 1
+                context.job_queue.run_once(
+                    lift_rate_limit_ban, RATE_LIMIT_BAN_SECONDS, data=(user.id, until), name=f"rate_ban_{user.id}"
+                )
+                await context.bot.send_message(
+                    chat_id=user.id,
+                    text=f"🚫 Слишком много запросов. Доступ ограничен на {RATE_LIMIT_BAN_SECONDS // 60} мин."
+                )
+            elif not bucket.notified:
+                bucket.notified = True
+                if update.callback_query:
+                    await answer_callback(update.callback_query, "⏳ Слишком часто, подождите немного.")
+                else:
+                    await context.bot.send_message(chat_id=user.id, text="⏳ Слишком часто, подождите немного.")
+        except Exception:
+            record_error()
+    raise ApplicationHandlerStop
+
+async def lift_rate_limit_ban(context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        user_id, until = context.job.data
+        if rate_limiter.banned.get(user_id) == until:
+            del rate_limiter.banned[user_id]
+        # Only the ban this job was scheduled for: a later admin ban has a different banned_until.
+        unban_user(user_id, until)
+
+def restore_rate_limit_bans(application: Application):
+    now = time.time()
+    for ban in get_temporary_bans():
+        rate_limiter.banned[ban['user_id']] = ban['banned_until']
+        application.job_queue.run_once(
+            lift_rate_limit_ban, max(0, ban['banned_until'] - now), data=(ban['user_id'], ban['banned_until']),
+            name=f"rate_ban_{ban['user_id']}"
+        )
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            if not is_admin(update.effective_user.id):
+                await update.message.reply_text("Нет доступа.")
+                return
+            handlers = sorted(metrics.by_name("handler_latency").items(), key=lambda item: -item[1].total)
+            response = "📈 Обработчики (вызовы, p50/p95, мс):\n"
+            for name, histogram in handlers[:15]:
+                response += (
+                    f"- {name}: {histogram.count}, "
+                    f"{histogram.quantile(0.5) * 1000:g}/{histogram.quantile(0.95) * 1000:g}\n"
+                )
+            updates = metrics.by_name("update")
+            total = updates.get("total")
+            if total and total.count:
+                response += (
+                    f"\n🔄 Обновлений: {total.count}\n"
+                    f"🗄 БД на обновление: {updates['db'].total / total.count * 1000:.1f} мс\n"
+                    f"📡 API на обновление: {updates['api'].total / total.count * 1000:.1f} мс, "
+                    f"{metrics.counters.get(('api_calls', ()), 0) / total.count:.2f} вызова\n"
+                )
+            over_budget = [(labels, count) for (name, labels), count in metrics.counters.items() if name == "api_budget_exceeded"]
+            if over_budget:
+                response += f"\n📨 Больше {API_CALL_BUDGET} вызовов API на обновление:\n"
+                for labels, count in sorted(over_budget, key=lambda item: -item[1])[:10]:
+                    response += f"- {dict(labels)['handler']}: {count}\n"
+            errors = [(labels, count) for (name, labels), count in metrics.counters.items() if name == "handler_errors"]
+            if errors:
+                response += "\n❗ Ошибки:\n"
+                for labels, count in sorted(errors, key=lambda item: -item[1])[:10]:
+                    response += f"- {dict(labels)['handler']}: {dict(labels)['type']} × {count}\n"
+            await update.message.reply_text(response)
+        except Exception:
+            record_error()
+            await update.message.reply_text("Ошибка при формировании статистики.")
+
+async def admin_errors(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            if not is_admin(update.effective_user.id):
+                await update.message.reply_text("Нет доступа.")
+                return
+            limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+            if not error_log:
+                await update.message.reply_text("✅ Ошибок не зафиксировано.")
+                return
+            response = f"❗ Последние ошибки ({min(limit, len(error_log))} из {len(error_log)}):\n\n"
+            for entry in list(error_log)[-limit:][::-1]:
+                response += (
+                    f"🕒 {entry['timestamp']} · {entry['handler']}\n"
+                    f"👤 {entry['update']}\n"
+                    f"💥 {entry['type']}: {entry['message']}\n"
+                    f"📍 {entry['location']}\n\n"
+                )
+            await update.message.reply_text(response[:4096])
+        except Exception:
+            record_error()
+            await update.message.reply_text("Ошибка при формировании отчета.")
+
+async def admin_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global profile_session
+    with capture_errors:
+        try:
+            if not is_admin(update.effective_user.id):
+                await update.message.reply_text("Нет доступа.")
+                return
+            args = context.args or []
+            if args[:1] == ["stop"]:
+                session = profile_session
+                if session is None:
+                    await update.message.reply_text("Профилирование не запущено.")
+                elif not session.finished:
+                    session.finished = True
+                    await finish_profile_session(session)
+                return
+            if profile_session is not None:
+                session = profile_session
+                await update.message.reply_text(
+                    f"⏱ Профилирование уже идет: {session.profiled}/{session.limit or '∞'}, "
+                    f"осталось {max(0, session.deadline - time.monotonic()):.0f} с.\n"
+                    "/profile stop — завершить досрочно."
+                )
+                return
+            mode, updates, seconds, handler = "sample", None, None, None
+            for arg in args:
+                if arg in ("cpu", "sample"):
+                    mode = arg
+                elif arg.isdigit():
+                    updates = int(arg)
+                elif arg.endswith("s") and arg[:-1].isdigit():
+                    seconds = int(arg[:-1])
+                else:
+                    handler = arg
+            if updates is None and seconds is None:
+                updates = PROFILE_DEFAULT_UPDATES
+            session = ProfileSession(context.application, update.effective_user.id, mode, updates, seconds, handler)
+            profile_session = session
+            context.job_queue.run_once(profile_deadline, when=session.deadline - time.monotonic(), data=session)
+            target = []
+            if updates:
+                target.append(f"{updates} {'вызовов' if handler else 'обновлений'}")
+            if seconds:
+                target.append(f"{seconds} с")
+            await update.message.reply_text(
+                f"🔬 Профилирование запущено ({'cProfile' if mode == 'cpu' else 'сэмплирование'}): "
+                f"{' или '.join(target)}, фильтр: {handler or 'все обновления'}.\n"
+                "Результат придет документом. Использование: /profile [cpu|sample] [N] [Ns] [обработчик] | stop"
+            )
+        except Exception:
+            record_error()
+            await update.message.reply_text("Ошибка при запуске профилирования.")
+
+async def admin_rate_limit_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            if not is_admin(update.effective_user.id):
+                await update.message.reply_text("Нет доступа.")
+                return
+            report = rate_limiter.report()
+            response = "🚦 Ограничение частоты:\n\n"
+            for kind, limit in RATE_LIMITS.items():
+                response += (
+                    f"- {kind}: пропущено {report['allowed'][kind]}, отклонено {report['throttled'][kind]} "
+                    f"(лимит {limit['burst']}, {limit['rate'] * 60:g}/мин)\n"
+                )
+            response += (
+                f"\n🪣 Корзин: {report['buckets']}\n"
+                f"⚠️ Нарушителей: {report['offenders']}\n"
+                f"🚫 Временно забанено: {report['banned']} (всего {report['bans_total']})\n"
+            )
+            await update.message.reply_text(response)
+        except Exception:
+            record_error()
+            await update.message.reply_text("Ошибка при формировании отчета.")
+
+async def auto_close_stale_dialogs(context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        for dialog in get_stale_dialogs(AUTO_CLOSE_AFTER, AUTO_CLOSE_BATCH):
+            update_message_status(dialog['message_id'], STATUS_CLOSED)
+            if not AUTO_CLOSE_NOTIFY:
+                continue
+            keyboard = [[InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_menu"))]]
+            if dialog['answered']:
+                keyboard.insert(0, [InlineKeyboardButton("⭐ Оценить ответ", callback_data=encode_callback("rate_dialog", dialog['message_id']))])
+            try:
+                await context.bot.send_message(
+                    chat_id=dialog['user_id'],
+                    text=f"🔒 Диалог #{dialog['message_id']} закрыт из-за отсутствия активности.",
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+            except Exception:
+                record_error()
+
+async def check_sla(context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        for message_id, dialog in sla_scheduler.due(time.time()):
+            try:
+                admin_id = dialog['admin_id']
+                if dialog['level'] == 0 and admin_id:
+                    targets = [admin_id]
+                elif dialog['level'] <= 1 and admin_id:
+                    # Only a notification target: pick() would advance round-robin state and assignment metrics.
+                    candidates = workload.candidates(dialog['topic_id'], exclude=(admin_id,))
+                    targets = [workload.least_loaded(candidates)] if candidates else workload.online_admins() or list(workload.online)
+                else:
+                    targets = workload.online_admins() or list(workload.online)
+                minutes = int((time.time() - dialog['created']) // 60)
+                emoji = "🚨" if dialog['priority'] == PRIORITY_URGENT else "🔺"
+                for target in targets:
+                    await context.bot.send_message(
+                        chat_id=target,
+                        text=f"⏰ {emoji} Диалог #{message_id} без ответа уже {minutes} мин.",
+                        reply_markup=InlineKeyboardMarkup([
+                            [InlineKeyboardButton("✍ Ответить", callback_data=encode_callback("reply", message_id))]
+                        ])
+                    )
+            except Exception:
+                record_error()
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        session_manager.sweep(context.application)
+
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            for key in SESSION_TTLS:
+                context.user_data.pop(key, None)
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="⌛ Время ожидания истекло. Главное меню:",
+                reply_markup=main_menu_keyboard(is_admin(update.effective_user.id))
+            )
+        except Exception:
+            record_error()
+
+async def admin_memory_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            if not is_admin(update.effective_user.id):
+                await update.message.reply_text("Нет доступа.")
+                return
+            report = session_manager.report(context.application)
+            response = (
+                "🧠 Память сессий:\n\n"
+                f"👥 Активных сессий: {report['live_sessions']}\n"
+                f"🕒 Отслеживается пользователей: {report['tracked_users']}/{report['max_users']}\n"
+                f"💾 Занято: {report['bytes'] / 1024:.1f} KB\n"
+                f"⌛ Истекло ключей: {report['expired_total']}\n"
+                f"🧹 Вытеснено сессий: {report['evicted_total']}\n"
+            )
+            if report['keys']:
+                response += "\n🔑 Ключи:\n"
+                for key, count in sorted(report['keys'].items(), key=lambda item: -item[1]):
+                    response += f"- {key}: {count}\n"
+            await update.message.reply_text(response)
+        except Exception:
+            record_error()
+            await update.message.reply_text("Ошибка при формировании отчета.")
+
 async def notify_admins_new_message(context: ContextTypes.DEFAULT_TYPE, message_id: int, user_id: int,
-                                   message_text: str, is_anonymous: bool, priority: str):
-    with suppress_stderr():
+                                   message_text: str, is_anonymous: bool, priority: str,
+                                   admin_ids: List[int] = None, attachments: List[tuple] = ()) -> List:
+    sent = []
+    with capture_errors:
         try:
-            admins = get_all_admins()
             user = get_user(user_id)
             topic_id = context.user_data.get('selected_topic')
+            admin_ids = admin_ids or notification_targets(topic_id)
+            topic_subscriptions.record(len(admin_ids), len(workload.online))
             topics = get_topics()
             topic = next((t for t in topics if t['topic_id'] == topic_id), None)
             topic_name = topic['topic_name'] if topic else "Без темы"
@@ -1306,19 +4079,44 @@ async def notify_admins_new_message(context: ContextTypes.DEFAULT_TYPE, message_
             if not is_anonymous and user:
                 message += f"От: {user['first_name']} {user['last_name']} (@{user['username'] or 'нет'})"
 
-            for admin in admins:
-                await context.bot.send_message(
-                    chat_id=admin['admin_id'],
+            keyboard = [[InlineKeyboardButton("✍ Ответить", callback_data=encode_callback("reply", message_id))]]
+            if len(admin_ids) == 1 and len(workload.online_admins()) > 1:
+                keyboard.append([InlineKeyboardButton("⏫ Эскалировать", callback_data=encode_callback("escalate", message_id))])
+            for admin_id in admin_ids:
+                try:
+                    forwarded = await send_attachments(context, admin_id, attachments)
+                except Exception:
+                    record_error()
+                    forwarded = []
+                sent.append(await context.bot.send_message(
+                    chat_id=admin_id,
                     text=message,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✍ Ответить", callback_data=f"reply_{message_id}")]
-                    ])
-                )
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    reply_to_message_id=forwarded[0].message_id if forwarded else None
+                ))
         except Exception:
-            pass
+            record_error()
+        return sent
+
+MEDIA_GROUP_TYPES = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+
+async def send_attachments(context: ContextTypes.DEFAULT_TYPE, chat_id: int, attachments: List[tuple]) -> List[Message]:
+    if not attachments:
+        return []
+    if len(attachments) == 1:
+        file_id, file_type = attachments[0]
+        send = {
+            "photo": context.bot.send_photo,
+            "video": context.bot.send_video,
+            "document": context.bot.send_document,
+            "voice": context.bot.send_voice
+        }[file_type]
+        return [await send(chat_id, file_id)]
+    media = [MEDIA_GROUP_TYPES[file_type](file_id) for file_id, file_type in attachments]
+    return list(await context.bot.send_media_group(chat_id=chat_id, media=media))
 
 async def message_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             user_id = update.effective_user.id
             messages = get_user_messages(user_id)
@@ -1349,11 +4147,12 @@ async def message_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
             for msg in messages:
                 keyboard.append([InlineKeyboardButton(
                     f"#{msg['message_id']} - {msg['topic_name']}",
-                    callback_data=f"view_dialog_{msg['message_id']}"
+                    callback_data=encode_callback("view_dialog", msg['message_id'])
                 )])
-            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")])
+            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_menu"))])
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     response,
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
@@ -1365,47 +4164,108 @@ async def message_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML'
                 )
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при загрузке истории.", "main")
 
+def text_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def clip_text(text: str, limit: int) -> str:
+    if text_length(text) <= limit:
+        return text
+    return text.encode("utf-16-le")[:(limit - 1) * 2].decode("utf-16-le", errors="ignore") + "…"
+
+def dialog_page_cursor(query: CallbackQuery) -> tuple:
+    action, args = callback_action(query), callback_args(query)
+    if action.endswith("_older"):
+        return args[0], args[1], None
+    if action.endswith("_newer"):
+        return args[0], None, args[1]
+    return args[0], None, None
+
+def dialog_event_block(event: Dict, viewer: str) -> str:
+    if event['event_type'] == EVENT_ATTACHMENT:
+        return f"📎 Вложение: {event['body']} ({event['timestamp']})\n\n"
+    if event['author_role'] == ROLE_USER:
+        author = "Вы" if viewer == ROLE_USER else "Пользователь"
+        return f"✉ {author} ({event['timestamp']}):\n{event['body']}\n\n"
+    fallback = "Администратор" if viewer == ROLE_USER else "Админ"
+    return f"↩ Ответ от @{event['username'] or fallback} ({event['timestamp']}):\n{event['body']}\n\n"
+
+def render_dialog_page(message: Dict, header: str, message_label: str, viewer: str,
+                       before: int = None, after: int = None) -> tuple:
+    events = get_dialog_events(message['message_id'], before, after, DIALOG_PAGE_SIZE + 1)
+    full = f"{message_label}\n{clip_text(message['message_text'] or '', MESSAGE_TEXT_LIMIT // 2)}\n\n"
+    budget = MESSAGE_TEXT_LIMIT - text_length(header) - text_length(full)
+    shown = []
+    for event in events[:DIALOG_PAGE_SIZE]:
+        block = dialog_event_block(event, viewer)
+        if text_length(block) > budget:
+            if shown:
+                break
+            block = clip_text(block, budget)
+        budget -= text_length(block)
+        shown.append((event['seq'], block))
+    more = len(shown) < len(events)
+    has_older = more if after is None else True
+    has_newer = before is not None if after is None else more
+    if after is None:
+        shown.reverse()
+    if has_older and shown:
+        preview = clip_text(message['message_text'] or '', DIALOG_PREVIEW_LENGTH)
+        full = f"{message_label}\n{preview}\n\n⬆️ Ранние ответы — кнопкой «Ранее».\n\n"
+    text = header + full + "".join(block for _, block in shown)
+    older = shown[0][0] if has_older and shown else None
+    newer = shown[-1][0] if has_newer and shown else None
+    return text, older, newer
+
+def dialog_navigation(older_action: str, newer_action: str, message_id: int, older: int, newer: int) -> List:
+    row = []
+    if older is not None:
+        row.append(InlineKeyboardButton("⬅️ Ранее", callback_data=encode_callback(older_action, message_id, older)))
+    if newer is not None:
+        row.append(InlineKeyboardButton("Позже ➡️", callback_data=encode_callback(newer_action, message_id, newer)))
+    return [row] if row else []
+
 async def view_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            message_id, before, after = dialog_page_cursor(query)
             message = get_message_details(message_id)
             if not message or message['user_id'] != query.from_user.id:
-                await query.edit_message_text(
+                await edit_query_message(
+                    query,
                     "Диалог не найден или недоступен.",
                     reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
                 )
                 return
-            response = (
+            header = (
                 f"💬 Диалог #{message['message_id']} - {message['topic_name']}\n"
                 f"📅 {message['timestamp']}\n"
                 f"📌 Приоритет: {message['priority']}\n"
                 f"📌 Статус: {message['status']}\n\n"
-                f"✉ Ваше сообщение:\n{message['message_text']}\n\n"
             )
-            for reply in message['replies']:
-                response += (
-                    f"↩ Ответ от @{reply['username'] or 'Администратор'} ({reply['timestamp']}):\n"
-                    f"{reply['text']}\n\n"
-                )
-            keyboard = [
-                [InlineKeyboardButton("📨 Продолжить диалог", callback_data=f"continue_dialog_{message_id}")],
-                [InlineKeyboardButton("❌ Завершить диалог", callback_data=f"end_dialog_{message_id}")],
-                [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
+            response, older, newer = render_dialog_page(
+                message, header, "✉ Ваше сообщение:", ROLE_USER, before, after
+            )
+            keyboard = dialog_navigation("dialog_older", "dialog_newer", message_id, older, newer) + [
+                [InlineKeyboardButton("📨 Продолжить диалог", callback_data=encode_callback("continue_dialog", message_id))],
+                [InlineKeyboardButton("❌ Завершить диалог", callback_data=encode_callback("end_dialog", message_id))],
+                [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_menu"))]
             ]
-            await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
+            await edit_query_message(query, response, reply_markup=InlineKeyboardMarkup(keyboard))
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при просмотре диалога.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
 
 async def user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             user = update.effective_user
             user_data = get_user(user.id)
@@ -1422,7 +4282,7 @@ async def user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"📅 Регистрация: {user_data['registration_date']}\n"
                 f"🚫 Бан: {'Да' if user_data['is_banned'] else 'Нет'}\n"
                 f"🌐 Язык: {user_data['language']}\n"
-                f"🔥 Срочных сообщений сегодня: {user_data['urgent_messages_today']}/{MAX_URGENT_PER_DAY}\n\n"
+                f"🔥 Срочных сообщений сегодня: {quota_service.usage(user.id, f'priority:{PRIORITY_URGENT}')[0]}/{QUOTAS.get(f'priority:{PRIORITY_URGENT}', '∞')}\n\n"
             )
             if ratings:
                 response += "⭐ Ваши оценки:\n"
@@ -1441,14 +4301,15 @@ async def user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         f"📜 {note['note_text']}\n\n"
                     )
             keyboard = [
-                [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
+                [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_menu"))]
             ]
             if user_data['is_banned']:
-                keyboard.insert(0, [InlineKeyboardButton("🔓 Разбанить себя", callback_data=f"unban_me_{user.id}")])
+                keyboard.insert(0, [InlineKeyboardButton("🔓 Разбанить себя", callback_data=encode_callback("unban_me", user.id))])
             else:
-                keyboard.insert(0, [InlineKeyboardButton("🚫 Забанить себя", callback_data=f"ban_me_{user.id}")])
+                keyboard.insert(0, [InlineKeyboardButton("🚫 Забанить себя", callback_data=encode_callback("ban_me", user.id))])
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     response,
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
@@ -1460,54 +4321,79 @@ async def user_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML'
                 )
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при загрузке профиля.", "main")
 
 async def ban_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            user_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            user_id = callback_args(query)[0]
             ban_user(user_id)
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "🚫 Вы забанили себя.",
                 reply_markup=main_menu_keyboard(is_admin(user_id))
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при бане.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
 
 async def unban_me(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            user_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            user_id = callback_args(query)[0]
             unban_user(user_id)
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "🔓 Вы разбанили себя.",
                 reply_markup=main_menu_keyboard(is_admin(user_id))
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при разбане.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if not is_admin(update.effective_user.id):
                 await send_menu(update, context, "Нет доступа.", "main")
                 return
             await send_menu(update, context, "🔑 Админ-панель:", "admin")
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при открытии админ-панели.", "main")
 
+async def admin_slow_queries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+            if not is_admin(query.from_user.id):
+                return
+            report = query_profiler.report()
+            await context.bot.send_document(
+                chat_id=query.from_user.id,
+                document=InputFile(report.encode(), filename=f"slow_queries_{datetime.now().strftime('%Y%m%d_%H%M')}.txt"),
+                caption=f"🐢 Топ-{SLOW_QUERY_TOP} запросов по суммарному времени"
+            )
+        except Exception:
+            record_error()
+            await send_menu(update, context, "Ошибка при формировании отчета.", "admin")
+
 async def admin_all_dialogs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if not is_admin(update.effective_user.id):
                 await send_menu(update, context, "Нет доступа.", "main")
@@ -1532,13 +4418,14 @@ async def admin_all_dialogs(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 user_info = "Аноним" if msg['is_anonymous'] else f"{msg['first_name']} {msg['last_name']} (@{msg['username'] or 'нет'})"
                 keyboard.append([InlineKeyboardButton(
                     f"{status_emoji}{priority_emoji} #{msg['message_id']} - {user_info} - {msg['topic_name']}",
-                    callback_data=f"admin_view_dialog_{msg['message_id']}"
+                    callback_data=encode_callback("admin_view_dialog", msg['message_id'])
                 )])
             if total_pages > 1:
-                keyboard.append([InlineKeyboardButton("Вперед ➡️", callback_data="page_2")])
-            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data="back_to_admin_menu")])
+                keyboard.append([InlineKeyboardButton("Вперед ➡️", callback_data=encode_callback("page", 2))])
+            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))])
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     f"📂 Все диалоги (Страница 1/{total_pages}):",
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
@@ -1550,19 +4437,20 @@ async def admin_all_dialogs(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML'
                 )
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при загрузке диалогов.", "admin")
 
 async def admin_view_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            message_id, before, after = dialog_page_cursor(query)
             message = get_message_details(message_id)
             if not message:
-                await query.edit_message_text("Диалог не найден.")
+                await edit_query_message(query, "Диалог не найден.")
                 return
-            response = (
+            header = (
                 f"💬 Диалог #{message['message_id']}\n"
                 f"📌 Тема: {message['topic_name']}\n"
                 f"📅 Дата: {message['timestamp']}\n"
@@ -1570,54 +4458,107 @@ async def admin_view_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"📌 Статус: {message['status']}\n\n"
             )
             if not message['is_anonymous']:
-                response += (
+                header += (
                     f"👤 Пользователь: {message['first_name']} {message['last_name']} "
                     f"(@{message['username'] or 'нет'})\n\n"
                 )
-            response += f"✉ Сообщение:\n{message['message_text']}\n\n"
-            for reply in message['replies']:
-                response += (
-                    f"↩ Ответ от @{reply['username'] or 'Админ'} ({reply['timestamp']}):\n"
-                    f"{reply['text']}\n\n"
-                )
-            if message['attachments']:
-                response += "📎 Вложения:\n"
-                for att in message['attachments']:
-                    response += f"- {att['file_type']} (ID: {att['file_id']})\n"
-            if message['notes']:
-                response += "\n📝 Заметки о пользователе:\n"
-                for note in message['notes']:
-                    response += f"- {note['note_text']} (@{note['admin_username']} {note['timestamp']})\n"
-            if message['status_history']:
-                response += "\n📜 История статусов:\n"
-                for status in message['status_history']:
-                    response += f"- {status['status']} ({status['timestamp']})\n"
-            keyboard = [
-                [InlineKeyboardButton("✍ Ответить", callback_data=f"reply_{message_id}")],
-                [InlineKeyboardButton("🔄 Назначить", callback_data=f"reassign_{message_id}")],
-                [InlineKeyboardButton("📝 Добавить заметку", callback_data=f"add_note_{message['user_id']}")],
-                [InlineKeyboardButton("🔒 Закрыть диалог", callback_data=f"close_dialog_{message_id}")],
-                [InlineKeyboardButton("🔙 В меню", callback_data="back_to_admin_menu")]
+            response, older, newer = render_dialog_page(message, header, "✉ Сообщение:", ROLE_ADMIN, before, after)
+            keyboard = dialog_navigation("admin_dialog_older", "admin_dialog_newer", message_id, older, newer) + [
+                [InlineKeyboardButton("✍ Ответить", callback_data=encode_callback("reply", message_id))],
+                [
+                    InlineKeyboardButton("📝 Заметки", callback_data=encode_callback("dialog_notes", message_id)),
+                    InlineKeyboardButton("📜 История статусов", callback_data=encode_callback("dialog_history", message_id))
+                ],
+                [InlineKeyboardButton("🔄 Назначить", callback_data=encode_callback("reassign", message_id))],
+                [InlineKeyboardButton("📝 Добавить заметку", callback_data=encode_callback("add_note", message['user_id']))],
+                [InlineKeyboardButton("🔒 Закрыть диалог", callback_data=encode_callback("close_dialog", message_id))],
+                [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))]
             ]
-            await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
+            await edit_query_message(query, response, reply_markup=InlineKeyboardMarkup(keyboard))
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при просмотре диалога.",
                 reply_markup=admin_menu_keyboard()
             )
 
+async def admin_dialog_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+            if not is_admin(query.from_user.id):
+                return
+            message_id = callback_args(query)[0]
+            message = get_message_details(message_id)
+            if not message:
+                await edit_query_message(query, "Диалог не найден.")
+                return
+            notes = get_notes(message['user_id'])
+            response = f"📝 Заметки о пользователе (диалог #{message_id}):\n\n"
+            if not notes:
+                response += "Заметок пока нет."
+            for index, note in enumerate(notes):
+                line = f"- {note['note_text']} (@{note['admin_username']} {note['timestamp']})\n"
+                if text_length(response + line) > MESSAGE_TEXT_LIMIT - 40:
+                    response += f"…и ещё {len(notes) - index}"
+                    break
+                response += line
+            keyboard = [
+                [InlineKeyboardButton("📝 Добавить заметку", callback_data=encode_callback("add_note", message['user_id']))],
+                [InlineKeyboardButton("🔙 К диалогу", callback_data=encode_callback("admin_view_dialog", message_id))]
+            ]
+            await edit_query_message(query, response, reply_markup=InlineKeyboardMarkup(keyboard))
+        except Exception:
+            record_error()
+            await edit_query_message(
+                query,
+                "Ошибка при загрузке заметок.",
+                reply_markup=admin_menu_keyboard()
+            )
+
+async def admin_dialog_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+            if not is_admin(query.from_user.id):
+                return
+            message_id = callback_args(query)[0]
+            history = get_message_status_history(message_id)
+            response = f"📜 История статусов диалога #{message_id}:\n\n"
+            if not history:
+                response += "Изменений статуса не было."
+            for index, status in enumerate(history):
+                line = f"- {status['status']} ({status['timestamp']}, {status['admin_name']})\n"
+                if text_length(response + line) > MESSAGE_TEXT_LIMIT - 40:
+                    response += f"…и ещё {len(history) - index}"
+                    break
+                response += line
+            keyboard = [[InlineKeyboardButton("🔙 К диалогу", callback_data=encode_callback("admin_view_dialog", message_id))]]
+            await edit_query_message(query, response, reply_markup=InlineKeyboardMarkup(keyboard))
+        except Exception:
+            record_error()
+            await edit_query_message(
+                query,
+                "Ошибка при загрузке истории статусов.",
+                reply_markup=admin_menu_keyboard()
+            )
+
 async def admin_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            if query.data == "back_to_admin_menu":
-                await query.edit_message_text(
+            await answer_callback(query)
+            if callback_action(query) == "back_to_admin_menu":
+                await edit_query_message(
+                    query,
                     "Админ-меню:",
                     reply_markup=admin_menu_keyboard()
                 )
                 return
-            page = int(query.data.split("_")[1])
+            page = callback_args(query)[0]
             messages = get_all_messages(page)
             total_messages = get_total_messages_count()
             total_pages = (total_messages + 9) // 10
@@ -1638,54 +4579,166 @@ async def admin_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
                 user_info = "Аноним" if msg['is_anonymous'] else f"{msg['first_name']} {msg['last_name']} (@{msg['username'] or 'нет'})"
                 keyboard.append([InlineKeyboardButton(
                     f"{status_emoji}{priority_emoji} #{msg['message_id']} - {user_info} - {msg['topic_name']}",
-                    callback_data=f"admin_view_dialog_{msg['message_id']}"
+                    callback_data=encode_callback("admin_view_dialog", msg['message_id'])
                 )])
             row = []
             if page > 1:
-                row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"page_{page - 1}"))
+                row.append(InlineKeyboardButton("⬅️ Назад", callback_data=encode_callback("page", page - 1)))
             if page < total_pages:
-                row.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"page_{page + 1}"))
+                row.append(InlineKeyboardButton("Вперед ➡️", callback_data=encode_callback("page", page + 1)))
             if row:
                 keyboard.append(row)
-            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data="back_to_admin_menu")])
-            await query.edit_message_text(
+            keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))])
+            await edit_query_message(
+                query,
                 f"📂 Все диалоги (Страница {page}/{total_pages}):",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при загрузке диалогов.",
                 reply_markup=admin_menu_keyboard()
             )
 
+async def admin_search_dialogs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            if not is_admin(update.effective_user.id):
+                await send_menu(update, context, "Нет доступа.", "main")
+                return ConversationHandler.END
+            text = (
+                "🔎 Введите текст для поиска по сообщениям и ответам.\n\n"
+                "Фильтры (необязательно):\n"
+                "topic:ID или topic:название\n"
+                f"status:{STATUS_NEW}|{STATUS_IN_PROGRESS}|{STATUS_RESOLVED}|{STATUS_CLOSED}\n"
+                f"priority:{PRIORITY_LOW}|{PRIORITY_NORMAL}|{PRIORITY_HIGH}|{PRIORITY_URGENT}\n"
+                "from:ГГГГ-ММ-ДД to:ГГГГ-ММ-ДД\n\n"
+                "Пример: ошибка оплаты status:new from:2024-01-01"
+            )
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("back_to_admin_menu"))]
+            ])
+            if update.callback_query:
+                await edit_query_message(update.callback_query, text, reply_markup=keyboard)
+            else:
+                await update.message.reply_text(text, reply_markup=keyboard)
+            return SEARCHING_DIALOGS
+        except Exception:
+            record_error()
+            await send_menu(update, context, "Ошибка при поиске диалогов.", "admin")
+            return ConversationHandler.END
+
+def render_dialog_search(search: Dict, before_id: int = None):
+    results = search_dialogs(before_id=before_id, **search)
+    if not results:
+        return "🔎 Ничего не найдено.", InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔎 Новый поиск", callback_data=encode_callback("admin_search_dialogs"))],
+            [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))]
+        ])
+    response = f"🔎 Результаты поиска: <b>{html.escape(search['query'] or '*')}</b>\n\n"
+    keyboard = []
+    for result in results:
+        status_emoji = {
+            STATUS_NEW: "🆕",
+            STATUS_IN_PROGRESS: "🔄",
+            STATUS_RESOLVED: "✅",
+            STATUS_CLOSED: "🔒"
+        }.get(result['status'], "❓")
+        priority_emoji = {
+            PRIORITY_LOW: "🔹",
+            PRIORITY_NORMAL: "🔸",
+            PRIORITY_HIGH: "🔺",
+            PRIORITY_URGENT: "🚨"
+        }.get(result['priority'], "🔹")
+        response += (
+            f"{status_emoji}{priority_emoji} #{result['message_id']} - {html.escape(result['topic_name'])} "
+            f"({result['timestamp']})\n"
+            f"💬 {result['snippet']}\n\n"
+        )
+        keyboard.append([InlineKeyboardButton(
+            f"{status_emoji}{priority_emoji} #{result['message_id']} - {result['topic_name']}",
+            callback_data=encode_callback("admin_view_dialog", result['message_id'])
+        )])
+    if len(results) == DIALOG_SEARCH_PAGE_SIZE:
+        keyboard.append([InlineKeyboardButton("Дальше ➡️", callback_data=encode_callback("dsearch", results[-1]['message_id']))])
+    keyboard.append([InlineKeyboardButton("🔎 Новый поиск", callback_data=encode_callback("admin_search_dialogs"))])
+    keyboard.append([InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))])
+    return response, InlineKeyboardMarkup(keyboard)
+
+async def receive_dialog_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            search = parse_dialog_search(update.message.text)
+            context.user_data['dialog_search'] = search
+            response, keyboard = render_dialog_search(search)
+            await update.message.reply_text(response, reply_markup=keyboard, parse_mode='HTML')
+            return SEARCHING_DIALOGS
+        except Exception:
+            record_error()
+            await update.message.reply_text(
+                "Ошибка при поиске диалогов.",
+                reply_markup=admin_menu_keyboard()
+            )
+            return ConversationHandler.END
+
+async def dialog_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+            search = context.user_data.get('dialog_search')
+            if not search or not is_admin(query.from_user.id):
+                await edit_query_message(
+                    query,
+                    "Поиск устарел, начните заново.",
+                    reply_markup=admin_menu_keyboard()
+                )
+                return
+            before_id = callback_args(query)[0]
+            response, keyboard = render_dialog_search(search, before_id)
+            await edit_query_message(query, response, reply_markup=keyboard, parse_mode='HTML')
+        except Exception:
+            record_error()
+            await edit_query_message(
+                query,
+                "Ошибка при поиске диалогов.",
+                reply_markup=admin_menu_keyboard()
+            )
+
 async def admin_close_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            message_id = callback_args(query)[0]
             update_message_status(message_id, STATUS_CLOSED, query.from_user.id)
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "✅ Диалог закрыт.",
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при закрытии диалога.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if not is_admin(update.effective_user.id):
                 await send_menu(update, context, "Нет доступа.", "main")
                 return
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     "📢 Введите сообщение для рассылки всем пользователям:",
                     reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Отмена", callback_data="cancel_broadcast")]
+                        [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_broadcast"))]
                     ]),
                     parse_mode='HTML'
                 )
@@ -1693,17 +4746,18 @@ async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(
                     "📢 Введите сообщение для рассылки всем пользователям:",
                     reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Отмена", callback_data="cancel_broadcast")]
+                        [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_broadcast"))]
                     ]),
                     parse_mode='HTML'
                 )
             return BROADCAST_MESSAGE
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при начале рассылки.", "admin")
             return ConversationHandler.END
 
 async def admin_receive_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             broadcast_message = update.message.text
             users = get_all_users()
@@ -1714,13 +4768,14 @@ async def admin_receive_broadcast(update: Update, context: ContextTypes.DEFAULT_
                         text=broadcast_message
                     )
                 except Exception:
-                    pass
+                    record_error()
             await update.message.reply_text(
                 "✅ Рассылка завершена.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при отправке рассылки.",
                 reply_markup=admin_menu_keyboard()
@@ -1728,35 +4783,39 @@ async def admin_receive_broadcast(update: Update, context: ContextTypes.DEFAULT_
             return ConversationHandler.END
 
 async def admin_cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Рассылка отменена.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене рассылки.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if not is_admin(update.effective_user.id):
                 await send_menu(update, context, "Нет доступа.", "main")
                 return
             keyboard = [
-                [InlineKeyboardButton("➕ Добавить админа", callback_data="add_admin")],
-                [InlineKeyboardButton("➖ Удалить админа", callback_data="remove_admin")],
-                [InlineKeyboardButton("🔙 В меню", callback_data="back_to_admin_menu")]
+                [InlineKeyboardButton("➕ Добавить админа", callback_data=encode_callback("add_admin"))],
+                [InlineKeyboardButton("➖ Удалить админа", callback_data=encode_callback("remove_admin"))],
+                [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))]
             ]
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     "👥 Управление администраторами:",
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
@@ -1768,29 +4827,33 @@ async def admin_manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE
                     parse_mode='HTML'
                 )
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при открытии управления админами.", "admin")
 
 async def admin_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Введите ID нового администратора:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_admin")]
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_add_admin"))]
                 ])
             )
             return ADDING_ADMIN
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при добавлении админа.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_receive_new_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             admin_id = int(update.message.text.strip())
             user = get_user(admin_id)
@@ -1801,6 +4864,7 @@ async def admin_receive_new_admin(update: Update, context: ContextTypes.DEFAULT_
             )
             return ConversationHandler.END
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при добавлении админа.",
                 reply_markup=admin_menu_keyboard()
@@ -1808,78 +4872,93 @@ async def admin_receive_new_admin(update: Update, context: ContextTypes.DEFAULT_
             return ConversationHandler.END
 
 async def admin_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
+            await answer_callback(query)
             admins = get_all_admins()
             keyboard = []
             for admin in admins:
                 if admin['admin_id'] != query.from_user.id:
                     keyboard.append([InlineKeyboardButton(
                         f"@{admin['username'] or 'нет'} ({admin['first_name']} {admin['last_name']})",
-                        callback_data=f"remove_admin_{admin['admin_id']}"
+                        callback_data=encode_callback("remove_admin", admin['admin_id'])
                     )])
-            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_remove_admin")])
-            await query.edit_message_text(
+            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_remove_admin"))])
+            await edit_query_message(
+                query,
                 "Выберите администратора для удаления:",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при удалении админа.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_confirm_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            admin_id = int(query.data.split("_")[-1])
-            conn = sqlite3.connect('feedback.db')
+            await answer_callback(query)
+            admin_id = callback_args(query)[0]
+            conn = get_connection()
             cursor = conn.cursor()
             cursor.execute("DELETE FROM admins WHERE admin_id = ?", (admin_id,))
+            cursor.execute("DELETE FROM admin_topic_subscriptions WHERE admin_id = ?", (admin_id,))
             conn.commit()
             conn.close()
-            await query.edit_message_text(
+            topic_subscriptions.load()
+            rate_limiter.exempt.pop(admin_id, None)
+            workload.remove_admin(admin_id)
+            await edit_query_message(
+                query,
                 "✅ Админ удален.",
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при удалении админа.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_cancel_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Удаление админа отменено.",
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене удаления.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_manage_topics(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if not is_admin(update.effective_user.id):
                 await send_menu(update, context, "Нет доступа.", "main")
                 return
             keyboard = [
-                [InlineKeyboardButton("➕ Добавить тему", callback_data="add_topic")],
-                [InlineKeyboardButton("➖ Удалить тему", callback_data="remove_topic")],
-                [InlineKeyboardButton("🔙 В меню", callback_data="back_to_admin_menu")]
+                [InlineKeyboardButton("➕ Добавить тему", callback_data=encode_callback("add_topic"))],
+                [InlineKeyboardButton("➖ Удалить тему", callback_data=encode_callback("remove_topic"))],
+                [InlineKeyboardButton("🔔 Мои подписки", callback_data=encode_callback("topic_subscriptions"))],
+                [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))]
             ]
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     "📝 Управление темами:",
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
@@ -1891,39 +4970,83 @@ async def admin_manage_topics(update: Update, context: ContextTypes.DEFAULT_TYPE
                     parse_mode='HTML'
                 )
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при открытии управления темами.", "admin")
 
+async def admin_topic_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with capture_errors:
+        try:
+            query = update.callback_query
+            await answer_callback(query)
+            admin_id = query.from_user.id
+            if not is_admin(admin_id):
+                return
+            if callback_action(query) == "toggle_sub":
+                toggle_topic_subscription(admin_id, callback_args(query)[0])
+            subscribed = topic_subscriptions.topics_for(admin_id)
+            keyboard = [
+                [InlineKeyboardButton(
+                    f"{'✅' if topic['topic_id'] in subscribed else '⬜'} {topic['topic_name']}",
+                    callback_data=encode_callback("toggle_sub", topic['topic_id'])
+                )] for topic in get_topics()
+            ]
+            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=encode_callback("admin_manage_topics"))])
+            text = (
+                "🔔 Подписки на темы\n\n"
+                "Уведомления по теме получают только подписчики. "
+                "Если на тему никто не подписан, уведомления получают все администраторы."
+            )
+            if topic_subscriptions.baseline_total:
+                sent = topic_subscriptions.sent_total
+                baseline = topic_subscriptions.baseline_total
+                text += (
+                    f"\n\n📉 Уведомлений отправлено: {sent} из {baseline} "
+                    f"(−{100 * (1 - sent / baseline):.0f}%)"
+                )
+            await edit_query_message(query, text, reply_markup=InlineKeyboardMarkup(keyboard))
+        except Exception:
+            record_error()
+            await edit_query_message(
+                query,
+                "Ошибка при загрузке подписок.",
+                reply_markup=admin_menu_keyboard()
+            )
+
 async def admin_add_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Введите название новой темы:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_topic")]
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_add_topic"))]
                 ])
             )
             return CREATING_TOPIC
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при добавлении темы.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_receive_topic_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             context.user_data['new_topic_name'] = update.message.text
             await update.message.reply_text(
                 "Введите описание темы:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_topic")]
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_add_topic"))]
                 ])
             )
             return CREATING_TOPIC
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при добавлении темы.",
                 reply_markup=admin_menu_keyboard()
@@ -1931,7 +5054,7 @@ async def admin_receive_topic_name(update: Update, context: ContextTypes.DEFAULT
             return ConversationHandler.END
 
 async def admin_receive_topic_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             topic_name = context.user_data['new_topic_name']
             description = update.message.text
@@ -1942,6 +5065,7 @@ async def admin_receive_topic_description(update: Update, context: ContextTypes.
             )
             return ConversationHandler.END
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при добавлении темы.",
                 reply_markup=admin_menu_keyboard()
@@ -1949,138 +5073,168 @@ async def admin_receive_topic_description(update: Update, context: ContextTypes.
             return ConversationHandler.END
 
 async def admin_cancel_add_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Добавление темы отменено.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_remove_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
+            await answer_callback(query)
             topics = get_topics()
             keyboard = []
             for topic in topics:
                 keyboard.append([InlineKeyboardButton(
                     f"{topic['topic_name']} - {topic['description']}",
-                    callback_data=f"remove_topic_{topic['topic_id']}"
+                    callback_data=encode_callback("remove_topic", topic['topic_id'])
                 )])
-            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_remove_topic")])
-            await query.edit_message_text(
+            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_remove_topic"))])
+            await edit_query_message(
+                query,
                 "Выберите тему для удаления:",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при удалении темы.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_confirm_remove_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            topic_id = int(query.data.split("_")[-1])
-            conn = sqlite3.connect('feedback.db')
+            await answer_callback(query)
+            topic_id = callback_args(query)[0]
+            conn = get_connection()
             cursor = conn.cursor()
             cursor.execute("DELETE FROM topics WHERE topic_id = ?", (topic_id,))
+            cursor.execute("DELETE FROM admin_topic_subscriptions WHERE topic_id = ?", (topic_id,))
             conn.commit()
             conn.close()
-            await query.edit_message_text(
+            topic_subscriptions.by_topic.pop(topic_id, None)
+            await edit_query_message(
+                query,
                 "✅ Тема удалена.",
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при удалении темы.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_cancel_remove_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Удаление темы отменено.",
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_manage_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if not is_admin(update.effective_user.id):
                 await send_menu(update, context, "Нет доступа.", "main")
                 return
             keyboard = [
-                [InlineKeyboardButton("➕ Добавить вопрос", callback_data="add_faq")],
-                [InlineKeyboardButton("➖ Удалить вопрос", callback_data="remove_faq")],
-                [InlineKeyboardButton("🔙 В меню", callback_data="back_to_admin_menu")]
+                [InlineKeyboardButton("➕ Добавить вопрос", callback_data=encode_callback("add_faq"))],
+                [InlineKeyboardButton("➖ Удалить вопрос", callback_data=encode_callback("remove_faq"))],
+                [InlineKeyboardButton("🔙 В меню", callback_data=encode_callback("back_to_admin_menu"))]
             ]
+            stats = get_deflection_stats()
+            total = stats['deflected'] + stats['sent']
+            text = "❓ Управление ЧаВо:"
+            if total:
+                text += (
+                    "\n\n"
+                    f"🛡 Решено подсказками ЧаВо: {stats['deflected']}\n"
+                    f"📨 Отправлено после подсказки: {stats['sent']}\n"
+                    f"📊 Доля решённых: {stats['deflected'] / total:.0%}"
+                )
             if update.callback_query:
-                await update.callback_query.edit_message_text(
-                    "❓ Управление ЧаВо:",
+                await edit_query_message(
+                    update.callback_query,
+                    text,
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
                 )
             else:
                 await update.message.reply_text(
-                    "❓ Управление ЧаВо:",
+                    text,
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode='HTML'
                 )
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при открытии управления FAQ.", "admin")
 
 async def admin_add_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Введите вопрос для FAQ:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_faq")]
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_add_faq"))]
                 ])
             )
             return ADDING_FAQ
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при добавлении FAQ.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_receive_faq_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             context.user_data['faq_question'] = update.message.text
             await update.message.reply_text(
                 "Введите ответ для FAQ:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_faq")]
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_add_faq"))]
                 ])
             )
             return ADDING_FAQ
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при добавлении FAQ.",
                 reply_markup=admin_menu_keyboard()
@@ -2088,7 +5242,7 @@ async def admin_receive_faq_question(update: Update, context: ContextTypes.DEFAU
             return ConversationHandler.END
 
 async def admin_receive_faq_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             context.user_data['faq_answer'] = update.message.text
             topics = get_topics()
@@ -2096,16 +5250,17 @@ async def admin_receive_faq_answer(update: Update, context: ContextTypes.DEFAULT
             for topic in topics:
                 keyboard.append([InlineKeyboardButton(
                     topic['topic_name'],
-                    callback_data=f"faq_topic_{topic['topic_id']}"
+                    callback_data=encode_callback("faq_topic", topic['topic_id'])
                 )])
-            keyboard.append([InlineKeyboardButton("Без темы", callback_data="faq_no_topic")])
-            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_faq")])
+            keyboard.append([InlineKeyboardButton("Без темы", callback_data=encode_callback("faq_no_topic"))])
+            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_add_faq"))])
             await update.message.reply_text(
                 "Выберите тему для FAQ:",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
             return ADDING_FAQ
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при добавлении FAQ.",
                 reply_markup=admin_menu_keyboard()
@@ -2113,105 +5268,116 @@ async def admin_receive_faq_answer(update: Update, context: ContextTypes.DEFAULT
             return ConversationHandler.END
 
 async def admin_save_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            if query.data == "cancel_add_faq":
-                await query.edit_message_text(
+            await answer_callback(query)
+            if callback_action(query) == "cancel_add_faq":
+                await edit_query_message(
+                    query,
                     "Добавление FAQ отменено.",
                     reply_markup=admin_menu_keyboard()
                 )
                 return ConversationHandler.END
             question = context.user_data.get('faq_question')
             answer = context.user_data.get('faq_answer')
-            topic_id = None if query.data == "faq_no_topic" else int(query.data.split("_")[-1])
+            topic_id = None if callback_action(query) == "faq_no_topic" else callback_args(query)[0]
             add_faq(question, answer, topic_id)
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "✅ Вопрос добавлен в FAQ.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при сохранении FAQ.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_remove_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
+            await answer_callback(query)
             faq_items = search_faq("")
             keyboard = []
             for item in faq_items:
                 keyboard.append([InlineKeyboardButton(
                     f"{item['question']} (ID: {item['faq_id']})",
-                    callback_data=f"remove_faq_{item['faq_id']}"
+                    callback_data=encode_callback("remove_faq", item['faq_id'])
                 )])
             if not keyboard:
-                await query.edit_message_text(
+                await edit_query_message(
+                    query,
                     "Нет вопросов для удаления.",
                     reply_markup=admin_menu_keyboard()
                 )
                 return
-            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_remove_faq")])
-            await query.edit_message_text(
+            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_remove_faq"))])
+            await edit_query_message(
+                query,
                 "Выберите вопрос для удаления:",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при удалении FAQ.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_confirm_remove_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            faq_id = int(query.data.split("_")[-1])
-            conn = sqlite3.connect('feedback.db')
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM faq WHERE faq_id = ?", (faq_id,))
-            conn.commit()
-            conn.close()
-            await query.edit_message_text(
+            await answer_callback(query)
+            faq_id = callback_args(query)[0]
+            delete_faq(faq_id)
+            await edit_query_message(
+                query,
                 "✅ Вопрос удален из FAQ.",
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при удалении FAQ.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def admin_cancel_remove_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Удаление FAQ отменено.",
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def search_faq_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if update.callback_query:
-                await update.callback_query.edit_message_text(
+                await edit_query_message(
+                    update.callback_query,
                     "🔍 Введите запрос для поиска в FAQ:",
                     reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Отмена", callback_data="cancel_faq_search")]
+                        [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_faq_search"))]
                     ]),
                     parse_mode='HTML'
                 )
@@ -2219,20 +5385,27 @@ async def search_faq_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 await update.message.reply_text(
                     "🔍 Введите запрос для поиска в FAQ:",
                     reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("❌ Отмена", callback_data="cancel_faq_search")]
+                        [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_faq_search"))]
                     ]),
                     parse_mode='HTML'
                 )
             return SEARCHING_FAQ
         except Exception:
+            record_error()
             await send_menu(update, context, "Ошибка при поиске FAQ.", "main")
             return ConversationHandler.END
 
 async def receive_faq_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.message.text
-            faq_items = search_faq(query)
+            faq_items = search_faq(query, limit=FAQ_SEARCH_LIMIT)
+            if len(faq_items) < FAQ_SEARCH_LIMIT:
+                found = {item['faq_id'] for item in faq_items}
+                faq_items += [
+                    item for item in match_faq(query, FAQ_SEARCH_LIMIT)
+                    if item['faq_id'] not in found
+                ][:FAQ_SEARCH_LIMIT - len(faq_items)]
             if not faq_items:
                 await update.message.reply_text(
                     "😔 По вашему запросу ничего не найдено.",
@@ -2240,11 +5413,11 @@ async def receive_faq_search(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 )
                 return ConversationHandler.END
             response = "❓ Результаты поиска:\n\n"
-            for i, item in enumerate(faq_items[:5], 1):
+            for i, item in enumerate(faq_items, 1):
                 response += (
-                    f"{i}. <b>{item['question']}</b>\n"
-                    f"🔹 Ответ: {item['answer']}\n"
-                    f"📌 Тема: {item['topic_name']}\n\n"
+                    f"{i}. ❔ {highlight_snippet(item['question_snippet'])}\n"
+                    f"🔹 Ответ: {highlight_snippet(item['answer_snippet'])}\n"
+                    f"📌 Тема: {html.escape(item['topic_name'])}\n\n"
                 )
             await update.message.reply_text(
                 response,
@@ -2253,6 +5426,7 @@ async def receive_faq_search(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return ConversationHandler.END
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при поиске FAQ.",
                 reply_markup=main_menu_keyboard(is_admin(update.effective_user.id))
@@ -2260,45 +5434,51 @@ async def receive_faq_search(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return ConversationHandler.END
 
 async def cancel_faq_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Поиск отменен.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене поиска.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
 
 async def admin_add_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            user_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            user_id = callback_args(query)[0]
             context.user_data['note_user_id'] = user_id
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "Введите текст заметки о пользователе:",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_add_note")]
+                    [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_add_note"))]
                 ])
             )
             return ADDING_NOTE
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при добавлении заметки.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def receive_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             note_text = update.message.text
             user_id = context.user_data['note_user_id']
@@ -2310,6 +5490,7 @@ async def receive_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return ConversationHandler.END
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при добавлении заметки.",
                 reply_markup=admin_menu_keyboard()
@@ -2317,60 +5498,67 @@ async def receive_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return ConversationHandler.END
 
 async def cancel_add_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Добавление заметки отменено.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_reassign_dialog(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            message_id = callback_args(query)[0]
             context.user_data['reassign_message_id'] = message_id
             admins = get_all_admins()
             keyboard = []
             for admin in admins:
                 keyboard.append([InlineKeyboardButton(
                     f"{admin['first_name']} {admin['last_name']} (@{admin['username'] or 'нет'})",
-                    callback_data=f"reassign_to_{admin['admin_id']}"
+                    callback_data=encode_callback("reassign_to", admin['admin_id'])
                 )])
-            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_reassign")])
-            await query.edit_message_text(
+            keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_reassign"))])
+            await edit_query_message(
+                query,
                 "Выберите администратора для назначения:",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
             return REASSIGNING_DIALOG
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при переназначении диалога.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def confirm_reassign(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            admin_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            admin_id = callback_args(query)[0]
             message_id = context.user_data['reassign_message_id']
             reassign_message(message_id, admin_id)
             admin = get_user(admin_id)
             admin_name = f"{admin['first_name']} {admin['last_name']}" if admin else f"ID: {admin_id}"
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 f"✅ Диалог #{message_id} назначен администратору {admin_name}.",
                 reply_markup=admin_menu_keyboard()
             )
@@ -2378,36 +5566,41 @@ async def confirm_reassign(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 chat_id=admin_id,
                 text=f"Вам назначен диалог #{message_id}.",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✍ Ответить", callback_data=f"reply_{message_id}")]
+                    [InlineKeyboardButton("✍ Ответить", callback_data=encode_callback("reply", message_id))]
                 ])
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при переназначении.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def cancel_reassign(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            await query.edit_message_text(
+            await answer_callback(query)
+            await edit_query_message(
+                query,
                 "Назначение отменено.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при отмене.",
                 reply_markup=admin_menu_keyboard()
             )
             return ConversationHandler.END
 
 async def admin_view_ratings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             if not is_admin(update.effective_user.id):
                 await update.message.reply_text("Нет доступа.")
@@ -2436,66 +5629,74 @@ async def admin_view_ratings(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 reply_markup=admin_menu_keyboard()
             )
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при загрузке оценок.",
                 reply_markup=admin_menu_keyboard()
             )
 
 async def rate_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            message_id = int(query.data.split("_")[-1])
+            await answer_callback(query)
+            message_id = callback_args(query)[0]
             context.user_data['rating_message_id'] = message_id
             keyboard = [
-                [InlineKeyboardButton(f"{i} ⭐", callback_data=f"rate_{i}") for i in range(1, 6)],
-                [InlineKeyboardButton("❌ Отмена", callback_data="cancel_rating")]
+                [InlineKeyboardButton(f"{i} ⭐", callback_data=encode_callback("rate", i)) for i in range(1, 6)],
+                [InlineKeyboardButton("❌ Отмена", callback_data=encode_callback("cancel_rating"))]
             ]
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "⭐ Пожалуйста, оцените качество ответа:",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
             return RATING_RESPONSE
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при оценке.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
 
 async def receive_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
-            if query.data == "cancel_rating":
-                await query.edit_message_text(
+            await answer_callback(query)
+            if callback_action(query) == "cancel_rating":
+                await edit_query_message(
+                    query,
                     "Оценка отменена.",
                     reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
                 )
                 return ConversationHandler.END
-            rating = int(query.data.split("_")[-1])
+            rating = callback_args(query)[0]
             message_id = context.user_data['rating_message_id']
             message = get_message_details(message_id)
             context.user_data['rating_value'] = rating
             context.user_data['rating_admin_id'] = message['assigned_admin_id'] or ADMIN_ID
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "📝 Хотите оставить комментарий к оценке? Напишите его или нажмите 'Пропустить':",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➖ Пропустить", callback_data="skip_comment")]
+                    [InlineKeyboardButton("➖ Пропустить", callback_data=encode_callback("skip_comment"))]
                 ])
             )
             return RECEIVING_RATING_COMMENT
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при обработке оценки.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
 
 async def receive_rating_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             comment = update.message.text
             rating = context.user_data['rating_value']
@@ -2508,6 +5709,7 @@ async def receive_rating_comment(update: Update, context: ContextTypes.DEFAULT_T
             )
             return ConversationHandler.END
         except Exception:
+            record_error()
             await update.message.reply_text(
                 "Ошибка при сохранении комментария.",
                 reply_markup=main_menu_keyboard(is_admin(update.effective_user.id))
@@ -2515,139 +5717,257 @@ async def receive_rating_comment(update: Update, context: ContextTypes.DEFAULT_T
             return ConversationHandler.END
 
 async def skip_rating_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
-            await query.answer()
+            await answer_callback(query)
             rating = context.user_data['rating_value']
             user_id = query.from_user.id
             admin_id = context.user_data['rating_admin_id']
             add_rating(user_id, admin_id, rating)
-            await query.edit_message_text(
+            await edit_query_message(
+                query,
                 "✅ Спасибо за вашу оценку!",
                 reply_markup=main_menu_keyboard(is_admin(user_id))
             )
             return ConversationHandler.END
         except Exception:
-            await query.edit_message_text(
+            record_error()
+            await edit_query_message(
+                query,
                 "Ошибка при сохранении оценки.",
                 reply_markup=main_menu_keyboard(is_admin(query.from_user.id))
             )
             return ConversationHandler.END
 
+async def ignore_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return None
+
+CALLBACK_ROUTES = {
+    (action, arity): instrument(handler) for (action, arity), handler in {
+        ("back_to_menu", 0): back_to_menu,
+        ("back_to_admin_menu", 0): back_to_admin_menu,
+        ("cancel_conversation", 0): cancel_conversation,
+        ("none", 0): ignore_callback,
+        ("write_message", 0): write_message,
+        ("message_history", 0): message_history,
+        ("user_profile", 0): user_profile,
+        ("search_faq", 0): search_faq_handler,
+        ("cancel_faq_search", 0): cancel_faq_search,
+        ("select_topic", 1): select_topic,
+        ("anon_yes", 0): confirm_anonymity,
+        ("anon_no", 0): confirm_anonymity,
+        ("cancel_anon_selection", 0): confirm_anonymity,
+        ("deflect_solved", 1): deflect_solved,
+        ("deflect_send", 0): deflect_send,
+        ("continue_dialog", 1): continue_dialog,
+        ("end_dialog", 1): end_dialog,
+        ("view_dialog", 1): view_dialog,
+        ("dialog_older", 2): view_dialog,
+        ("dialog_newer", 2): view_dialog,
+        ("ban_me", 1): ban_me,
+        ("unban_me", 1): unban_me,
+        ("rate_dialog", 1): rate_response,
+        ("rate", 1): receive_rating,
+        ("cancel_rating", 0): receive_rating,
+        ("skip_comment", 0): skip_rating_comment,
+        ("admin_panel", 0): admin_panel,
+        ("admin_all_dialogs", 0): admin_all_dialogs,
+        ("admin_view_dialog", 1): admin_view_dialog,
+        ("admin_dialog_older", 2): admin_view_dialog,
+        ("admin_dialog_newer", 2): admin_view_dialog,
+        ("dialog_notes", 1): admin_dialog_notes,
+        ("dialog_history", 1): admin_dialog_history,
+        ("page", 1): admin_page_callback,
+        ("admin_search_dialogs", 0): admin_search_dialogs,
+        ("dsearch", 1): dialog_search_page,
+        ("escalate", 1): escalate_dialog,
+        ("reply", 1): admin_reply_callback,
+        ("reply_cluster", 1): admin_reply_cluster_callback,
+        ("cancel_reply", 0): admin_cancel_reply,
+        ("close_dialog", 1): admin_close_dialog,
+        ("add_note", 1): admin_add_note,
+        ("cancel_add_note", 0): cancel_add_note,
+        ("reassign", 1): admin_reassign_dialog,
+        ("reassign_to", 1): confirm_reassign,
+        ("cancel_reassign", 0): cancel_reassign,
+        ("admin_broadcast", 0): admin_broadcast,
+        ("cancel_broadcast", 0): admin_cancel_broadcast,
+        ("admin_manage_admins", 0): admin_manage_admins,
+        ("add_admin", 0): admin_add_admin,
+        ("cancel_add_admin", 0): back_to_admin_menu,
+        ("remove_admin", 0): admin_remove_admin,
+        ("remove_admin", 1): admin_confirm_remove_admin,
+        ("cancel_remove_admin", 0): admin_cancel_remove_admin,
+        ("topic_subscriptions", 0): admin_topic_subscriptions,
+        ("toggle_sub", 1): admin_topic_subscriptions,
+        ("admin_manage_topics", 0): admin_manage_topics,
+        ("add_topic", 0): admin_add_topic,
+        ("cancel_add_topic", 0): admin_cancel_add_topic,
+        ("remove_topic", 0): admin_remove_topic,
+        ("remove_topic", 1): admin_confirm_remove_topic,
+        ("cancel_remove_topic", 0): admin_cancel_remove_topic,
+        ("admin_manage_faq", 0): admin_manage_faq,
+        ("add_faq", 0): admin_add_faq,
+        ("faq_topic", 1): admin_save_faq,
+        ("faq_no_topic", 0): admin_save_faq,
+        ("cancel_add_faq", 0): admin_save_faq,
+        ("remove_faq", 0): admin_remove_faq,
+        ("remove_faq", 1): admin_confirm_remove_faq,
+        ("cancel_remove_faq", 0): admin_cancel_remove_faq,
+        ("admin_view_ratings", 0): admin_view_ratings,
+        ("admin_slow_queries", 0): admin_slow_queries
+    }.items()
+}
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with suppress_stderr():
+    with capture_errors:
         try:
             query = update.callback_query
             if query:
-                await query.answer()
-                if query.data == "back_to_menu":
-                    return await back_to_menu(update, context)
-                elif query.data == "back_to_admin_menu":
-                    return await back_to_admin_menu(update, context)
-                elif query.data == "cancel_conversation":
-                    return await cancel_conversation(update, context)
-                elif query.data.startswith("select_topic_"):
-                    return await select_topic(update, context)
-                elif query.data.startswith("anon_"):
-                    return await confirm_anonymity(update, context)
-                elif query.data.startswith("continue_dialog_"):
-                    return await continue_dialog(update, context)
-                elif query.data.startswith("end_dialog_"):
-                    return await end_dialog(update, context)
-                elif query.data.startswith("view_dialog_"):
-                    return await view_dialog(update, context)
-                elif query.data.startswith("ban_me_"):
-                    return await ban_me(update, context)
-                elif query.data.startswith("unban_me_"):
-                    return await unban_me(update, context)
-                elif query.data.startswith("admin_view_dialog_"):
-                    return await admin_view_dialog(update, context)
-                elif query.data.startswith("page_"):
-                    return await admin_page_callback(update, context)
-                elif query.data.startswith("reply_"):
-                    return await admin_reply_callback(update, context)
-                elif query.data.startswith("close_dialog_"):
-                    return await admin_close_dialog(update, context)
-                elif query.data == "admin_panel":
-                    return await admin_panel(update, context)
-                elif query.data == "write_message":
-                    return await write_message(update, context)
-                elif query.data == "message_history":
-                    return await message_history(update, context)
-                elif query.data == "user_profile":
-                    return await user_profile(update, context)
-                elif query.data == "search_faq":
-                    return await search_faq_handler(update, context)
-                elif query.data == "admin_all_dialogs":
-                    return await admin_all_dialogs(update, context)
-                elif query.data == "admin_broadcast":
-                    return await admin_broadcast(update, context)
-                elif query.data == "admin_manage_admins":
-                    return await admin_manage_admins(update, context)
-                elif query.data == "admin_manage_topics":
-                    return await admin_manage_topics(update, context)
-                elif query.data == "admin_manage_faq":
-                    return await admin_manage_faq(update, context)
-                elif query.data == "admin_view_ratings":
-                    return await admin_view_ratings(update, context)
-                elif query.data == "add_admin":
-                    return await admin_add_admin(update, context)
-                elif query.data == "remove_admin":
-                    return await admin_remove_admin(update, context)
-                elif query.data.startswith("remove_admin_"):
-                    return await admin_confirm_remove_admin(update, context)
-                elif query.data == "cancel_remove_admin":
-                    return await admin_cancel_remove_admin(update, context)
-                elif query.data == "add_topic":
-                    return await admin_add_topic(update, context)
-                elif query.data == "remove_topic":
-                    return await admin_remove_topic(update, context)
-                elif query.data.startswith("remove_topic_"):
-                    return await admin_confirm_remove_topic(update, context)
-                elif query.data == "cancel_remove_topic":
-                    return await admin_cancel_remove_topic(update, context)
-                elif query.data == "add_faq":
-                    return await admin_add_faq(update, context)
-                elif query.data.startswith("faq_topic_") or query.data == "faq_no_topic":
-                    return await admin_save_faq(update, context)
-                elif query.data == "cancel_add_faq":
-                    return await admin_save_faq(update, context)
-                elif query.data == "remove_faq":
-                    return await admin_remove_faq(update, context)
-                elif query.data.startswith("remove_faq_"):
-                    return await admin_confirm_remove_faq(update, context)
-                elif query.data == "cancel_faq_search":
-                    return await cancel_faq_search(update, context)
-                elif query.data.startswith("add_note_"):
-                    return await admin_add_note(update, context)
-                elif query.data == "cancel_add_note":
-                    return await cancel_add_note(update, context)
-                elif query.data.startswith("reassign_"):
-                    return await admin_reassign_dialog(update, context)
-                elif query.data.startswith("reassign_to_"):
-                    return await confirm_reassign(update, context)
-                elif query.data == "cancel_reassign":
-                    return await cancel_reassign(update, context)
-                elif query.data == "cancel_broadcast":
-                    return await admin_cancel_broadcast(update, context)
-                elif query.data.startswith("rate_") or query.data == "cancel_rating":
-                    return await receive_rating(update, context)
-                elif query.data == "skip_comment":
-                    return await skip_rating_comment(update, context)
+                await answer_callback(query)
+                parsed = parse_callback_data(query.data or "")
+                if parsed is None:
+                    metrics.increment("callbacks_rejected", ())
+                    await send_menu(update, context, "⌛ Эта кнопка устарела. Выберите действие в меню:", "main")
+                    return ConversationHandler.END
+                action, args = parsed
+                return await CALLBACK_ROUTES[(action, len(args))](update, context)
             else:
                 await send_menu(update, context, "Ошибка: нет данных callback.", "main")
         except Exception as e:
-            print(f"Exception in button_callback: {e}")
+            record_error(e)
             if update.callback_query:
                 try:
-                    await send_menu(update, context, "错误 при обработке команды.", "main")
+                    await send_menu(update, context, "Ошибка при обработке команды.", "main")
                 except Exception as e2:
-                    print(f"Failed to edit message: {e2}")
+                    record_error(e2)
             else:
-                await send_menu(update, context, "错误 при обработке команды.", "main")
+                await send_menu(update, context, "Ошибка при обработке команды.", "main")
         return ConversationHandler.END
 
+def build_application(token: str) -> Application:
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .base_url(BOT_API_BASE_URL)
+        .base_file_url(BOT_API_FILE_URL)
+        .application_class(InstrumentedApplication)
+        .job_queue(InstrumentedJobQueue())
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .persistence(SQLitePersistence())
+        .context_types(ContextTypes(user_data=SessionData))
+        .post_init(start_services)
+        .post_shutdown(stop_services)
+        .build()
+    )
+
+    application.job_queue.run_repeating(check_user_updates, interval=3600, first=10)
+    restore_rate_limit_bans(application)
+    if AUTO_CLOSE_AFTER:
+        application.job_queue.run_repeating(auto_close_stale_dialogs, interval=AUTO_CLOSE_INTERVAL, first=AUTO_CLOSE_INTERVAL)
+    application.job_queue.run_repeating(check_sla, interval=SLA_CHECK_INTERVAL, first=SLA_CHECK_INTERVAL)
+    application.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL)
+
+    conv_handler = ConversationHandler(
+        name="main_conversation",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        entry_points=[
+            CommandHandler("start", start),
+            CallbackQueryHandler(write_message, pattern=callback_pattern("write_message")),
+            CallbackQueryHandler(message_history, pattern=callback_pattern("message_history")),
+            CallbackQueryHandler(user_profile, pattern=callback_pattern("user_profile")),
+            CallbackQueryHandler(search_faq_handler, pattern=callback_pattern("search_faq")),
+            CallbackQueryHandler(admin_panel, pattern=callback_pattern("admin_panel")),
+            CallbackQueryHandler(admin_all_dialogs, pattern=callback_pattern("admin_all_dialogs")),
+            CallbackQueryHandler(admin_search_dialogs, pattern=callback_pattern("admin_search_dialogs")),
+            CallbackQueryHandler(admin_broadcast, pattern=callback_pattern("admin_broadcast")),
+            CallbackQueryHandler(admin_manage_admins, pattern=callback_pattern("admin_manage_admins")),
+            CallbackQueryHandler(admin_manage_topics, pattern=callback_pattern("admin_manage_topics")),
+            CallbackQueryHandler(admin_manage_faq, pattern=callback_pattern("admin_manage_faq")),
+            CallbackQueryHandler(admin_view_ratings, pattern=callback_pattern("admin_view_ratings")),
+            CallbackQueryHandler(admin_reply_callback, pattern=callback_pattern("reply", 1)),
+            CallbackQueryHandler(rate_response, pattern=callback_pattern("rate_dialog", 1)),
+            CallbackQueryHandler(admin_reply_cluster_callback, pattern=callback_pattern("reply_cluster", 1)),
+            CallbackQueryHandler(back_to_menu, pattern=callback_pattern("back_to_menu"))
+        ],
+        states={
+            SELECTING_TOPIC: [CallbackQueryHandler(button_callback)],
+            WRITING_MESSAGE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_message),
+                MessageHandler(filters.PHOTO, receive_message),
+                MessageHandler(filters.VIDEO, receive_message),
+                MessageHandler(filters.Document.ALL, receive_message),
+                MessageHandler(filters.VOICE, receive_message),
+                CallbackQueryHandler(button_callback)
+            ],
+            CONFIRM_ANONYMITY: [CallbackQueryHandler(button_callback)],
+            SUGGESTING_FAQ: [CallbackQueryHandler(button_callback)],
+            ADMIN_RESPONSE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_reply),
+                CallbackQueryHandler(button_callback)
+            ],
+            BROADCAST_MESSAGE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_broadcast),
+                CallbackQueryHandler(button_callback)
+            ],
+            ADDING_ADMIN: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_new_admin),
+                CallbackQueryHandler(button_callback)
+            ],
+            CREATING_TOPIC: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_topic_name),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_topic_description),
+                CallbackQueryHandler(button_callback)
+            ],
+            ADDING_FAQ: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_faq_question),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_faq_answer),
+                CallbackQueryHandler(button_callback)
+            ],
+            SEARCHING_FAQ: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_faq_search),
+                CallbackQueryHandler(button_callback)
+            ],
+            ADDING_NOTE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_note),
+                CallbackQueryHandler(button_callback)
+            ],
+            REASSIGNING_DIALOG: [
+                CallbackQueryHandler(button_callback)
+            ],
+            RATING_RESPONSE: [
+                CallbackQueryHandler(button_callback)
+            ],
+            RECEIVING_RATING_COMMENT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_rating_comment),
+                CallbackQueryHandler(button_callback)
+            ],
+            SEARCHING_DIALOGS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_dialog_search),
+                CallbackQueryHandler(button_callback)
+            ],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)]
+        },
+        fallbacks=[
+            CommandHandler("cancel", cancel_conversation),
+            CallbackQueryHandler(cancel_conversation, pattern=callback_pattern("cancel_conversation"))
+        ]
+    )
+
+    application.add_handler(TypeHandler(Update, rate_limit_guard), group=-2)
+    application.add_handler(TypeHandler(Update, track_session), group=-1)
+    application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CommandHandler("memory", admin_memory_report))
+    application.add_handler(CommandHandler("ratelimit", admin_rate_limit_report))
+    application.add_handler(CommandHandler("online", admin_toggle_online))
+    application.add_handler(CommandHandler("stats", admin_stats))
+    application.add_handler(CommandHandler("errors", admin_errors))
+    application.add_handler(CommandHandler("profile", admin_profile))
+    return application
+
 def main():
     with open('config.json', 'r') as config_file:
         config = json.load(config_file)
@@ -2660,93 +5980,16 @@ def main():
     signal.signal(signal.SIGINT, shutdown_handler)
     signal.signal(signal.SIGTERM, shutdown_handler)
 
-    with suppress_stderr():
-        try:
-            application = ApplicationBuilder().token(BOT_TOKEN).build()
-
-            application.job_queue.run_repeating(check_user_updates, interval=3600, first=10)
-
-            conv_handler = ConversationHandler(
-                entry_points=[
-                    CommandHandler("start", start),
-                    CallbackQueryHandler(write_message, pattern="^write_message$"),
-                    CallbackQueryHandler(message_history, pattern="^message_history$"),
-                    CallbackQueryHandler(user_profile, pattern="^user_profile$"),
-                    CallbackQueryHandler(search_faq_handler, pattern="^search_faq$"),
-                    CallbackQueryHandler(admin_panel, pattern="^admin_panel$"),
-                    CallbackQueryHandler(admin_all_dialogs, pattern="^admin_all_dialogs$"),
-                    CallbackQueryHandler(admin_broadcast, pattern="^admin_broadcast$"),
-                    CallbackQueryHandler(admin_manage_admins, pattern="^admin_manage_admins$"),
-                    CallbackQueryHandler(admin_manage_topics, pattern="^admin_manage_topics$"),
-                    CallbackQueryHandler(admin_manage_faq, pattern="^admin_manage_faq$"),
-                    CallbackQueryHandler(admin_view_ratings, pattern="^admin_view_ratings$"),
-                    CallbackQueryHandler(back_to_menu, pattern="^back_to_menu$")
-                ],
-                states={
-                    SELECTING_TOPIC: [CallbackQueryHandler(button_callback)],
-                    WRITING_MESSAGE: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, receive_message),
-                        MessageHandler(filters.PHOTO, receive_message),
-                        MessageHandler(filters.Document.ALL, receive_message),
-                        MessageHandler(filters.VOICE, receive_message),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    CONFIRM_ANONYMITY: [CallbackQueryHandler(button_callback)],
-                    ADMIN_RESPONSE: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_reply),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    BROADCAST_MESSAGE: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_broadcast),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    ADDING_ADMIN: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_new_admin),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    CREATING_TOPIC: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_topic_name),
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_topic_description),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    ADDING_FAQ: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_faq_question),
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, admin_receive_faq_answer),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    SEARCHING_FAQ: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, receive_faq_search),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    ADDING_NOTE: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, receive_note),
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    REASSIGNING_DIALOG: [
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    RATING_RESPONSE: [
-                        CallbackQueryHandler(button_callback)
-                    ],
-                    RECEIVING_RATING_COMMENT: [
-                        MessageHandler(filters.TEXT & ~filters.COMMAND, receive_rating_comment),
-                        CallbackQueryHandler(button_callback)
-                    ]
-                },
-                fallbacks=[
-                    CommandHandler("cancel", cancel_conversation),
-                    CallbackQueryHandler(cancel_conversation, pattern="^cancel_conversation$")
-                ]
-            )
-
-            application.add_handler(conv_handler)
-            application.add_handler(CallbackQueryHandler(button_callback))
+    with capture_errors:
+        try:
+            application = build_application(BOT_TOKEN)
 
             print("✅ Бот запущен и готов к работе! 🚀")
 
             application.run_polling()
 
         except Exception as e:
+            record_error(e)
             print(f"Произошла ошибка при запуске: {e}")
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+"""Per-callback routing cost: the legacy button_callback if/elif chain versus CALLBACK_ROUTES.
+
+The traffic mix weights the callbacks the load benchmark sees most (topic selection,
+anonymity, admin replies) and includes the admin screens that sat at the end of the chain.
+
+Usage: python benchmarks/bench_callback_router.py [--calls 200000]
+"""
+import argparse
+import random
+import time
+
+from harness import load_bot
+
+TRAFFIC = [
+    (("select_topic", 3), 20), (("anon_no",), 15), (("anon_yes",), 5), (("write_message",), 15),
+    (("reply", 18231), 10), (("continue_dialog", 18231), 8), (("back_to_menu",), 8), (("page", 4), 4),
+    (("admin_view_dialog", 18231), 4), (("rate", 5), 3), (("skip_comment",), 2), (("reassign_to", 7), 1),
+    (("remove_faq", 12), 1), (("cancel_rating",), 1), (("admin_slow_queries",), 1), (("toggle_sub", 2), 1),
+    (("faq_no_topic",), 1),
+]
+
+
+def legacy_data(action: str, *args) -> str:
+    return "_".join((action, *map(str, args)))
+
+
+def legacy_dispatch(data: str) -> str:
+    if data == "back_to_menu":
+        return "back_to_menu"
+    elif data == "back_to_admin_menu":
+        return "back_to_admin_menu"
+    elif data == "cancel_conversation":
+        return "cancel_conversation"
+    elif data.startswith("select_topic_"):
+        return "select_topic"
+    elif data.startswith("anon_"):
+        return "confirm_anonymity"
+    elif data.startswith("deflect_solved_"):
+        return "deflect_solved"
+    elif data == "deflect_send":
+        return "deflect_send"
+    elif data.startswith("continue_dialog_"):
+        return "continue_dialog"
+    elif data.startswith("end_dialog_"):
+        return "end_dialog"
+    elif data.startswith("view_dialog_"):
+        return "view_dialog"
+    elif data.startswith("ban_me_"):
+        return "ban_me"
+    elif data.startswith("unban_me_"):
+        return "unban_me"
+    elif data.startswith("admin_view_dialog_"):
+        return "admin_view_dialog"
+    elif data.startswith("page_"):
+        return "admin_page_callback"
+    elif data.startswith("escalate_"):
+        return "escalate_dialog"
+    elif data.startswith("reply_cluster_"):
+        return "admin_reply_cluster_callback"
+    elif data.startswith("reply_"):
+        return "admin_reply_callback"
+    elif data.startswith("close_dialog_"):
+        return "admin_close_dialog"
+    elif data == "admin_panel":
+        return "admin_panel"
+    elif data == "admin_slow_queries":
+        return "admin_slow_queries"
+    elif data == "write_message":
+        return "write_message"
+    elif data == "message_history":
+        return "message_history"
+    elif data == "user_profile":
+        return "user_profile"
+    elif data == "search_faq":
+        return "search_faq_handler"
+    elif data == "admin_all_dialogs":
+        return "admin_all_dialogs"
+    elif data == "admin_search_dialogs":
+        return "admin_search_dialogs"
+    elif data.startswith("dsearch_"):
+        return "dialog_search_page"
+    elif data == "admin_broadcast":
+        return "admin_broadcast"
+    elif data == "admin_manage_admins":
+        return "admin_manage_admins"
+    elif data == "admin_manage_topics":
+        return "admin_manage_topics"
+    elif data == "admin_manage_faq":
+        return "admin_manage_faq"
+    elif data == "admin_view_ratings":
+        return "admin_view_ratings"
+    elif data == "add_admin":
+        return "admin_add_admin"
+    elif data == "remove_admin":
+        return "admin_remove_admin"
+    elif data.startswith("remove_admin_"):
+        return "admin_confirm_remove_admin"
+    elif data == "cancel_remove_admin":
+        return "admin_cancel_remove_admin"
+    elif data == "topic_subscriptions" or data.startswith("toggle_sub_"):
+        return "admin_topic_subscriptions"
+    elif data == "add_topic":
+        return "admin_add_topic"
+    elif data == "remove_topic":
+        return "admin_remove_topic"
+    elif data.startswith("remove_topic_"):
+        return "admin_confirm_remove_topic"
+    elif data == "cancel_remove_topic":
+        return "admin_cancel_remove_topic"
+    elif data == "add_faq":
+        return "admin_add_faq"
+    elif data.startswith("faq_topic_") or data == "faq_no_topic":
+        return "admin_save_faq"
+    elif data == "cancel_add_faq":
+        return "admin_save_faq"
+    elif data == "remove_faq":
+        return "admin_remove_faq"
+    elif data.startswith("remove_faq_"):
+        return "admin_confirm_remove_faq"
+    elif data == "cancel_faq_search":
+        return "cancel_faq_search"
+    elif data.startswith("add_note_"):
+        return "admin_add_note"
+    elif data == "cancel_add_note":
+        return "cancel_add_note"
+    elif data.startswith("reassign_"):
+        return "admin_reassign_dialog"
+    elif data.startswith("reassign_to_"):
+        return "confirm_reassign"
+    elif data == "cancel_reassign":
+        return "cancel_reassign"
+    elif data == "cancel_broadcast":
+        return "admin_cancel_broadcast"
+    elif data.startswith("rate_dialog_"):
+        return "rate_response"
+    elif data.startswith("rate_") or data == "cancel_rating":
+        return "receive_rating"
+    elif data == "skip_comment":
+        return "skip_rating_comment"
+    return None
+
+
+def per_call_ns(func, payloads) -> float:
+    started = time.perf_counter_ns()
+    for data in payloads:
+        func(data)
+    return (time.perf_counter_ns() - started) / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200000)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    rng = random.Random(1)
+    actions, weights = zip(*TRAFFIC)
+    mix = rng.choices(actions, weights, k=args.calls)
+    legacy_payloads = [legacy_data(*action) for action in mix]
+    payloads = [bot.encode_callback(*action) for action in mix]
+    routes = bot.CALLBACK_ROUTES
+    parse = bot.parse_callback_data
+
+    def route(data):
+        action, arguments = parse(data)
+        return routes[(action, len(arguments))], arguments
+
+    def route_uncached(data):
+        action, arguments = parse.__wrapped__(data)
+        return routes[(action, len(arguments))], arguments
+
+    def legacy_with_parse(data):
+        return legacy_dispatch(data), int(data.split("_")[-1]) if data[-1].isdigit() else None
+
+    unknown = [f"{bot.CALLBACK_VERSION}:nope:{i}" for i in range(args.calls // 10)]
+    rows = [
+        ("if/elif chain", per_call_ns(legacy_dispatch, legacy_payloads)),
+        ("if/elif chain + int(split)", per_call_ns(legacy_with_parse, legacy_payloads)),
+        ("router (lru_cache warm)", per_call_ns(route, payloads)),
+        ("router (no cache)", per_call_ns(route_uncached, payloads)),
+        ("router rejects unknown", per_call_ns(parse.__wrapped__, unknown)),
+    ]
+    worst = max(len(bot.encode_callback(action, *[2 ** 62] * arity).encode()) for action, arity in routes)
+    width = max(len(name) for name, _ in rows) + 2
+    print(f"{len(routes)} routes, longest payload with 19-digit args: {worst} bytes (limit {bot.CALLBACK_DATA_LIMIT})")
+    print("name".ljust(width) + "ns/callback".rjust(14))
+    for name, value in rows:
+        print(name.ljust(width) + f"{value:14.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""Time the data-access functions against a synthetic feedback.db at production-scale volumes.
+
+The database is generated once per (--messages, --seed) and reused, so runs on different
+commits measure the same data; init_db() still migrates it on import. Results are written
+as JSON and can be compared with a previous run.
+
+Usage: python benchmarks/bench_db.py [--messages 1000000] [--repeat 20] [--output results.json]
+       python benchmarks/bench_db.py --compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from harness import BENCH_ADMIN_ID, compare_reports, git_revision, load_bot, measure, print_table
+
+ADMINS = 25
+FAQ_ENTRIES = 5000
+CHUNK = 50000
+TEXTS = [
+    "Не проходит оплата картой, пишет что банк отклонил операцию",
+    "Как изменить адрес доставки в уже оформленном заказе?",
+    "Приложение вылетает при открытии раздела с историей заказов",
+    "Не приходит код подтверждения по SMS уже второй день",
+    "Хочу вернуть товар, но кнопка возврата неактивна",
+    "Списали деньги дважды за одну подписку",
+    "Курьер не приехал в согласованный интервал доставки",
+    "Промокод не применяется к товарам со скидкой",
+]
+REPLIES = [
+    "Здравствуйте! Передали вопрос в профильный отдел.",
+    "Проверили заказ, деньги вернутся в течение трех рабочих дней.",
+    "Пожалуйста, обновите приложение до последней версии.",
+    "Уточните, пожалуйста, номер заказа.",
+]
+FAQ_QUERIES = ["оплата картой", "возврат заказа", "доставка", "промокод"]
+STATUS_WEIGHTS = {"new": 2, "in_progress": 3, "resolved": 45, "closed": 50}
+PRIORITY_WEIGHTS = {"low": 15, "normal": 70, "high": 12, "urgent": 3}
+
+
+def timestamp(start: datetime, seconds: float) -> str:
+    return (start + timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def chunks(rows, size: int = CHUNK):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def populate(messages: int, seed: int):
+    rng = random.Random(seed)
+    users = max(1000, messages // 20)
+    start = datetime.now() - timedelta(days=730)
+    span = 730 * 86400
+    statuses, status_weights = zip(*STATUS_WEIGHTS.items())
+    priorities, priority_weights = zip(*PRIORITY_WEIGHTS.items())
+    admin_ids = [BENCH_ADMIN_ID] + list(range(900001, 900001 + ADMINS - 1))
+
+    conn = sqlite3.connect('feedback.db')
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
+        ((user_id, f"user{user_id}", f"Имя{user_id}", f"Фамилия{user_id}")
+         for user_id in list(range(100000, 100000 + users)) + admin_ids)
+    )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO admins (admin_id, username, added_by) VALUES (?, ?, ?)",
+        ((admin_id, f"admin{admin_id}", BENCH_ADMIN_ID) for admin_id in admin_ids)
+    )
+    cursor.execute("SELECT topic_id FROM topics")
+    topic_ids = [row[0] for row in cursor.fetchall()]
+
+    # A few heavy users carry a long history, the rest follow a power law.
+    senders = rng.choices(range(100000, 100000 + users), [1 / (rank + 1) ** 0.8 for rank in range(users)], k=messages)
+    message_rows = []
+    for message_id, user_id in enumerate(senders, 1):
+        sent = message_id / messages * span
+        message_rows.append((
+            message_id,
+            user_id,
+            rng.choice(topic_ids),
+            f"{rng.choice(TEXTS)} (заказ {rng.randrange(10 ** 7)})",
+            timestamp(start, sent),
+            rng.random() < 0.9,
+            rng.choices(statuses, status_weights)[0],
+            rng.choices(priorities, priority_weights)[0],
+            rng.random() < 0.1,
+            rng.choice(admin_ids),
+            message_id,
+            timestamp(start, sent + rng.random() * 86400)
+        ))
+    for batch in chunks(message_rows):
+        cursor.executemany('''
+            INSERT INTO messages (message_id, user_id, topic_id, message_text, timestamp, is_read, status,
+                                  priority, is_anonymous, assigned_admin_id, cluster_id, last_activity)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+
+    def replies():
+        for message_id, _, _, _, sent, *_ in message_rows:
+            for _ in range(rng.choice((0, 1, 1, 2, 3))):
+                yield message_id, rng.choice(admin_ids), rng.choice(REPLIES), sent
+
+    def history():
+        for message_id, _, _, _, sent, _, status, *_ in message_rows:
+            path = ["new", "in_progress", status] if status in ("resolved", "closed") else ["new", status]
+            for step in dict.fromkeys(path):
+                yield message_id, step, rng.choice(admin_ids), sent
+
+    def ratings():
+        for _, user_id, _, _, sent, _, status, *_ in message_rows:
+            if status in ("resolved", "closed") and rng.random() < 0.2:
+                yield user_id, rng.choice(admin_ids), rng.randint(1, 5), None, sent
+
+    for batch in chunks(replies()):
+        cursor.executemany("INSERT INTO replies (message_id, admin_id, reply_text, timestamp) VALUES (?, ?, ?, ?)", batch)
+    for batch in chunks(history()):
+        cursor.executemany(
+            "INSERT INTO message_status_history (message_id, status, admin_id, timestamp) VALUES (?, ?, ?, ?)", batch
+        )
+    for batch in chunks(ratings()):
+        cursor.executemany(
+            "INSERT INTO ratings (user_id, admin_id, rating, comments, timestamp) VALUES (?, ?, ?, ?, ?)", batch
+        )
+    cursor.execute('''
+        INSERT INTO dialog_fts (body, message_id)
+        SELECT replace(replace(message_text, 'ё', 'е'), 'Ё', 'Е'), message_id FROM messages
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def populate_faq(seed: int):
+    # init_db() recreates the faq table on every start, so it is seeded after the final import.
+    rng = random.Random(seed)
+    conn = sqlite3.connect('feedback.db')
+    topic_ids = [row[0] for row in conn.execute("SELECT topic_id FROM topics")]
+    conn.executemany(
+        "INSERT INTO faq (question, answer, topic_id, keywords) VALUES (?, ?, ?, ?)",
+        ((f"{rng.choice(TEXTS)}?", f"{rng.choice(REPLIES)} {rng.choice(REPLIES)}", rng.choice(topic_ids),
+          ", ".join(rng.sample(FAQ_QUERIES, 2))) for _ in range(FAQ_ENTRIES))
+    )
+    conn.commit()
+    conn.close()
+
+
+def counts() -> dict:
+    conn = sqlite3.connect('feedback.db')
+    result = {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("users", "messages", "replies", "message_status_history", "dialog_events", "ratings", "faq")
+    }
+    conn.close()
+    return result
+
+
+def heaviest_user() -> int:
+    conn = sqlite3.connect('feedback.db')
+    user_id = conn.execute(
+        "SELECT user_id FROM messages GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()[0]
+    conn.close()
+    return user_id
+
+
+def run(args) -> dict:
+    workdir = args.workdir or os.path.join(tempfile.gettempdir(), f"livebot-bench-db-{args.messages}-{args.seed}")
+    fresh = not os.path.exists(os.path.join(workdir, "feedback.db"))
+    started = time.perf_counter()
+    bot = load_bot(workdir)
+    if fresh:
+        populate(args.messages, args.seed)
+        print(f"generated {workdir}/feedback.db in {time.perf_counter() - started:.0f} s")
+        bot = reload_bot(bot)
+    else:
+        print(f"reusing {workdir}/feedback.db")
+    populate_faq(args.seed)
+
+    rng = random.Random(args.seed)
+    total = bot.get_total_messages_count()
+    heavy_user = heaviest_user()
+    ids = [rng.randint(1, total) for _ in range(args.repeat)]
+    repeat = args.repeat
+    benchmarks = []
+    for page in (1, 10, 100, 1000, 10000):
+        benchmarks.append((f"get_all_messages page={page}", bot.get_all_messages, (page,), repeat))
+    benchmarks += [
+        ("get_user_messages heavy page=1", bot.get_user_messages, (heavy_user, 1), repeat),
+        ("get_user_messages heavy page=50", bot.get_user_messages, (heavy_user, 50), repeat),
+        ("get_user_messages typical page=1", bot.get_user_messages, (100000 + total // 40, 1), repeat),
+        ("get_message_details", lambda: bot.get_message_details(ids[rng.randrange(len(ids))]), (), repeat),
+        ("get_message_status_history", lambda: bot.get_message_status_history(ids[rng.randrange(len(ids))]), (), repeat),
+        ("get_dialog_events latest", lambda: bot.get_dialog_events(ids[rng.randrange(len(ids))]), (), repeat),
+        ("get_dialog_events older", lambda: bot.get_dialog_events(ids[rng.randrange(len(ids))], before=2 ** 62), (), repeat),
+        ("get_ratings admin", bot.get_ratings, (BENCH_ADMIN_ID,), repeat),
+        ("get_ratings all", bot.get_ratings, (), max(3, repeat // 5)),
+        ("get_total_messages_count", bot.get_total_messages_count, (), repeat),
+    ]
+    for query in FAQ_QUERIES:
+        benchmarks.append((f"search_faq {query}", bot.search_faq, (query,), repeat))
+
+    def quota_usage_cold():
+        bot.quota_service.counters.clear()
+        bot.quota_service.usage(heavy_user, f"priority:{bot.PRIORITY_URGENT}")
+
+    benchmarks += [
+        ("quota usage (cold cache)", quota_usage_cold, (), repeat),
+        ("quota usage (warm cache)", bot.quota_service.usage, (heavy_user, f"priority:{bot.PRIORITY_URGENT}"), repeat),
+    ]
+
+    results = {}
+    for name, func, func_args, times in benchmarks:
+        func(*func_args)
+        results[name] = measure(func, *func_args, repeat=times)
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "messages": args.messages,
+            "seed": args.seed,
+            "rows": counts()
+        },
+        "results": results
+    }
+
+
+def reload_bot(bot):
+    # Module-level caches (SLA heap, workload index, FAQ matcher) are built at import,
+    # so re-import once the data is in place to measure a warmed-up process.
+    del sys.modules[bot.__name__]
+    import LiveBot
+    return LiveBot
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{after['meta']['messages']} messages, sqlite {after['meta']['sqlite']}")
+    compare_reports(before, after)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="directory holding the generated feedback.db")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    output = os.path.abspath(args.output) if args.output else None
+    report = run(args)
+    print(json.dumps(report["meta"]["rows"]))
+    print_table(list(report["results"].items()), columns=("p50_ms", "p95_ms", "max_ms"))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
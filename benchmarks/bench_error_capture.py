@@ -0,0 +1,97 @@
+"""Per-call overhead of the legacy suppress_stderr swap versus the capture_errors object.
+
+Usage: python benchmarks/bench_error_capture.py [--calls 200000]
+"""
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from harness import load_bot
+
+
+@contextmanager
+def legacy_suppress_stderr():
+    with open(os.devnull, 'w') as devnull:
+        old_stderr = sys.stderr
+        sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stderr = old_stderr
+
+
+def per_call_ns(func, calls: int) -> float:
+    started = time.perf_counter_ns()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter_ns() - started) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200000)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    capture_errors = bot.capture_errors
+
+    def bare():
+        pass
+
+    def legacy():
+        with legacy_suppress_stderr():
+            pass
+
+    def captured():
+        with capture_errors:
+            pass
+
+    def legacy_failing():
+        with legacy_suppress_stderr():
+            try:
+                raise ValueError("boom")
+            except Exception:
+                pass
+
+    def captured_failing():
+        with capture_errors:
+            try:
+                raise ValueError("boom")
+            except Exception:
+                bot.record_error()
+
+    def legacy_db():
+        with legacy_suppress_stderr():
+            conn = bot.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM admins WHERE admin_id = ?", (1,))
+            cursor.fetchone()
+            conn.close()
+
+    def captured_db():
+        with capture_errors:
+            conn = bot.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM admins WHERE admin_id = ?", (1,))
+            cursor.fetchone()
+            conn.close()
+
+    baseline = per_call_ns(bare, args.calls)
+    rows = [
+        ("suppress_stderr (happy path)", per_call_ns(legacy, args.calls) - baseline),
+        ("capture_errors (happy path)", per_call_ns(captured, args.calls) - baseline),
+        ("suppress_stderr (caught error)", per_call_ns(legacy_failing, args.calls // 10) - baseline),
+        ("capture_errors (caught error)", per_call_ns(captured_failing, args.calls // 10) - baseline),
+        ("suppress_stderr + DB lookup", per_call_ns(legacy_db, args.calls // 50)),
+        ("capture_errors + DB lookup", per_call_ns(captured_db, args.calls // 50)),
+    ]
+    width = max(len(name) for name, _ in rows) + 2
+    print("name".ljust(width) + "ns/call".rjust(12))
+    for name, value in rows:
+        print(name.ljust(width) + f"{value:12.0f}")
+
+
+if __name__ == '__main__':
+    main()
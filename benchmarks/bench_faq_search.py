@@ -0,0 +1,84 @@
+"""Compare the FTS5 FAQ search with the legacy LIKE scan.
+
+Usage: python benchmarks/bench_faq_search.py [--entries 50000] [--repeat 30]
+"""
+import argparse
+import random
+import sqlite3
+
+from harness import load_bot, measure, print_table
+
+RU_WORDS = [
+    "оплата", "заказ", "доставка", "карта", "возврат", "пароль", "аккаунт", "подписка",
+    "ошибка", "приложение", "телефон", "адрес", "курьер", "скидка", "промокод", "чек",
+    "сервис", "поддержка", "тариф", "счет", "баланс", "уведомление", "регистрация", "вход"
+]
+EN_WORDS = [
+    "payment", "order", "delivery", "card", "refund", "password", "account", "subscription",
+    "error", "app", "phone", "address", "courier", "discount", "promo", "receipt"
+]
+QUERIES = ["оплата картой", "возврат заказа", "пароль", "доставка курьером", "refund", "promo code"]
+
+
+def legacy_search(query: str):
+    conn = sqlite3.connect('feedback.db')
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT f.faq_id, f.question, f.answer, COALESCE(t.topic_name, 'Без темы') as topic_name
+        FROM faq f
+        LEFT JOIN topics t ON f.topic_id = t.topic_id
+        WHERE f.question LIKE ?
+           OR f.answer LIKE ?
+           OR (f.keywords IS NOT NULL AND f.keywords LIKE ?)
+    ''', (f"%{query}%", f"%{query}%", f"%{query}%"))
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def build_vocabulary(rng: random.Random, size: int = 8000):
+    syllables = [c + v for c in "бвгдзклмнпрстфхцчшщ" for v in "аеиоуыэюя"] + [c + v for c in "bdfgklmnprstvz" for v in "aeiou"]
+    vocabulary = set(RU_WORDS + EN_WORDS)
+    while len(vocabulary) < size:
+        vocabulary.add("".join(rng.choices(syllables, k=rng.randint(2, 4))))
+    vocabulary = sorted(vocabulary)
+    rng.shuffle(vocabulary)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return vocabulary, weights
+
+
+def populate(entries: int, seed: int = 42):
+    rng = random.Random(seed)
+    words, weights = build_vocabulary(rng)
+    rows = []
+    for _ in range(entries):
+        question = " ".join(rng.choices(words, weights, k=rng.randint(4, 9))).capitalize() + "?"
+        answer = " ".join(rng.choices(words, weights, k=rng.randint(15, 40))).capitalize() + "."
+        keywords = ", ".join(rng.choices(words, weights, k=3))
+        rows.append((question, answer, rng.randint(1, 7), keywords))
+    conn = sqlite3.connect('feedback.db')
+    conn.executemany("INSERT INTO faq (question, answer, topic_id, keywords) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    populate(args.entries)
+    print(f"FAQ entries: {args.entries}")
+
+    rows = []
+    for query in QUERIES:
+        rows.append((f"like  {query}", measure(legacy_search, query, repeat=args.repeat)))
+        rows.append((f"fts5  {query}", measure(bot.search_faq, query, limit=args.limit, repeat=args.repeat)))
+    print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Compare the in-memory trigram FAQ matcher with the legacy LIKE query on typo queries.
+
+Usage: python benchmarks/bench_faq_trigram.py [--entries 5000] [--queries 200]
+"""
+import argparse
+import random
+import time
+
+from bench_faq_search import legacy_search, populate
+from harness import load_bot, measure, print_table
+
+
+def add_typo(rng: random.Random, word: str) -> str:
+    if len(word) < 4:
+        return word
+    position = rng.randrange(1, len(word) - 1)
+    kind = rng.choice(("swap", "replace", "drop"))
+    if kind == "swap":
+        return word[:position - 1] + word[position] + word[position - 1] + word[position + 1:]
+    if kind == "replace":
+        return word[:position] + rng.choice("аеиоуыяeaio") + word[position + 1:]
+    return word[:position] + word[position + 1:]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    populate(args.entries)
+    started = time.perf_counter()
+    bot.load_faq_matcher()
+    print(f"FAQ entries: {args.entries}, index build: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    rng = random.Random(7)
+    rows = bot.search_faq("")
+    samples = []
+    for item in rng.sample(rows, min(args.queries, len(rows))):
+        words = item['question'].rstrip("?").split()
+        start = rng.randrange(max(1, len(words) - 2))
+        samples.append((item['faq_id'], " ".join(add_typo(rng, w) for w in words[start:start + 3])))
+
+    like_hits = sum(any(row[0] == faq_id for row in legacy_search(text)) for faq_id, text in samples)
+    trigram_hits = sum(any(doc_id == faq_id for doc_id, _ in bot.faq_matcher.search(text, limit=10))
+                       for faq_id, text in samples)
+    print(f"recall@10 on {len(samples)} typo queries: like {like_hits / len(samples):.0%}, "
+          f"trigram {trigram_hits / len(samples):.0%}")
+
+    texts = [text for _, text in samples]
+    print_table([
+        ("like", measure(lambda: legacy_search(rng.choice(texts)), repeat=50)),
+        ("trigram", measure(lambda: bot.faq_matcher.search(rng.choice(texts)), repeat=len(texts))),
+        ("trigram + rows", measure(lambda: bot.match_faq(rng.choice(texts)), repeat=len(texts)))
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""End-to-end load benchmark: simulated users and admins drive the real handlers against FakeBotApi.
+
+Each user runs /start -> write_message -> select_topic -> anon_no -> message (text, photo or an album
+of ALBUM_SIZE photos, which the bot buffers for MEDIA_GROUP_WINDOW and stores as one dialog). Album
+captions are unique so that no album is folded into a duplicate cluster and each one is forwarded.
+Admins answer each new dialog once, from the first alert that reaches them, with reply:<id> followed by a text reply.
+Fails if a user step exceeds STEP_CALL_BUDGETS, if any update goes over the bot's API_CALL_BUDGET,
+if any call is rejected with 400 (no-op edits, second answers to a callback), if a callback is
+not answered exactly once, if an album is not stored as a single dialog with MAX_ATTACHMENTS photos
+and forwarded with one sendMediaGroup call, or if the rate limiter strikes or bans any user.
+
+Usage: python benchmarks/bench_load.py [--users 500] [--admins 3] [--concurrency 100]
+                                       [--latency-ms 5] [--jitter-ms 5] [--rate-limit-ratio 0.0]
+                                       [--record updates.jsonl.gz]
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from collections import defaultdict
+
+from fake_bot_api import FakeBotApi
+from harness import BENCH_ADMIN_ID, load_bot, print_table, summarize
+
+USER_ID_BASE = 100000
+ADMIN_ID_BASE = 900000
+STEP_TIMEOUT = 30
+# More items than both MAX_ATTACHMENTS and the new_dialog rate-limit burst.
+ALBUM_SIZE = 8
+# Upper bound on API calls to the user's chat per step of the user flow (answer + edit for
+# callbacks); the last step also receives the admin's reply. Admin chats get alerts at any
+# moment, so admin steps are held to the bot's own API_CALL_BUDGET instead.
+STEP_CALL_BUDGETS = {
+    "start": 1,
+    "write_message": 2,
+    "select_topic": 2,
+    "confirm_anonymity": 2,
+    "receive_message": 2,
+}
+MESSAGES = [
+    "Не проходит оплата картой, пишет что банк отклонил операцию",
+    "Как изменить адрес доставки в уже оформленном заказе?",
+    "Приложение вылетает при открытии раздела с историей заказов",
+    "Не приходит код подтверждения по SMS уже второй день",
+    "Хочу вернуть товар, но кнопка возврата неактивна",
+    "Списали деньги дважды за одну подписку",
+]
+
+
+class LoadGenerator:
+    def __init__(self, api: FakeBotApi, rng: random.Random, bot):
+        self.api = api
+        self.rng = rng
+        self.bot = bot
+        self.message_id = 1
+        self.kinds = {}
+        self.timeouts = 0
+        self.callbacks = 0
+        self.albums = 0
+        self.step_calls = defaultdict(list)
+        self.open_steps = {}
+        self.pending = {}
+        self.admin_queues = defaultdict(asyncio.Queue)
+        self.answered = set()
+        api.listeners.append(self.on_bot_message)
+
+    def on_bot_message(self, method: str, chat_id: int, message: dict):
+        if chat_id not in self.admin_queues:
+            return
+        for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+            for button in row:
+                parsed = self.bot.parse_callback_data(button.get("callback_data", ""))
+                if parsed and parsed[0] == "reply" and method == "sendMessage" and parsed[1][0] not in self.answered:
+                    self.answered.add(parsed[1][0])
+                    self.admin_queues[chat_id].put_nowait(parsed[1][0])
+
+    def user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def next_message_id(self) -> int:
+        self.message_id += 1
+        return self.message_id
+
+    def close_step(self, chat_id: int):
+        if chat_id in self.open_steps:
+            kind, calls = self.open_steps.pop(chat_id)
+            self.step_calls[kind].append(self.api.chat_calls[chat_id] - calls)
+
+    async def send(self, kind: str, user_id: int, *payloads: dict):
+        # A step owns every call made to its chat until the next step starts, which for
+        # user flows covers follow-up messages from admins too.
+        self.close_step(user_id)
+        self.open_steps[user_id] = (kind, self.api.chat_calls[user_id])
+        events = []
+        for payload in payloads:
+            update_id = self.api.push_update(payload)
+            self.kinds[update_id] = kind
+            events.append(self.pending.setdefault(update_id, asyncio.Event()))
+        try:
+            await asyncio.wait_for(asyncio.gather(*(event.wait() for event in events)), STEP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+
+    def processed(self, update_id: int) -> str:
+        if update_id in self.pending:
+            self.pending.pop(update_id).set()
+        return self.kinds.pop(update_id, "other")
+
+    def user_message(self, user_id: int) -> dict:
+        return {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+            "from": self.user(user_id)
+        }
+
+    def photo(self, user_id: int, prefix: str = "photo") -> list:
+        return [{"file_id": f"{prefix}-{user_id}", "file_unique_id": f"u-{prefix}-{user_id}", "width": 640, "height": 480}]
+
+    async def message(self, kind: str, user_id: int, text: str = None, photo: bool = False):
+        message = self.user_message(user_id)
+        if photo:
+            message["photo"] = self.photo(user_id)
+            message["caption"] = text
+        else:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self.send(kind, user_id, {"message": message})
+
+    async def album(self, kind: str, user_id: int, text: str, size: int = ALBUM_SIZE):
+        self.albums += 1
+        payloads = []
+        for index in range(size):
+            message = self.user_message(user_id)
+            message.update(media_group_id=f"album-{user_id}", photo=self.photo(user_id, f"album{index}"))
+            if index == 0:
+                message["caption"] = text
+            payloads.append({"message": message})
+        await self.send(kind, user_id, *payloads)
+
+    async def callback(self, kind: str, user_id: int, action: str, *args: int):
+        anchor = self.api.last_message.get(user_id) or {
+            "message_id": self.next_message_id(), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "text": "-"
+        }
+        self.callbacks += 1
+        await self.send(kind, user_id, {
+            "callback_query": {
+                "id": str(self.next_message_id()),
+                "from": self.user(user_id),
+                "chat_instance": str(user_id),
+                "data": self.bot.encode_callback(action, *args),
+                "message": anchor
+            }
+        })
+
+    async def user_flow(self, user_id: int, topic_ids: list):
+        await self.message("start", user_id, "/start")
+        await self.callback("write_message", user_id, "write_message")
+        await self.callback("select_topic", user_id, "select_topic", self.rng.choice(topic_ids))
+        await self.callback("confirm_anonymity", user_id, "anon_no")
+        text = f"{self.rng.choice(MESSAGES)} (заказ {self.rng.randrange(10 ** 6)})"
+        roll = self.rng.random()
+        if roll < 0.1:
+            caption = "Фото " + " ".join(f"{self.rng.getrandbits(32):08x}" for _ in range(4))
+            await self.album("receive_message", user_id, caption)
+        else:
+            await self.message("receive_message", user_id, text, photo=roll < 0.3)
+
+    async def admin_flow(self, admin_id: int, done: asyncio.Event):
+        queue = self.admin_queues[admin_id]
+        while not (done.is_set() and queue.empty()):
+            try:
+                message_id = await asyncio.wait_for(queue.get(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            await self.callback("admin_reply_callback", admin_id, "reply", message_id)
+            await self.message("admin_receive_reply", admin_id, f"Здравствуйте! Проверили обращение #{message_id}.")
+
+
+async def run(args):
+    api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_limit_ratio, seed=args.seed)
+    base_url = await api.start()
+    config = {"UPDATE_RECORD_PATH": os.path.abspath(args.record)} if args.record else {}
+    bot = load_bot(BOT_API_BASE_URL=base_url, ASSIGNMENT_ENABLED=True, SLA_CHECK_INTERVAL=3600, **config)
+    admin_ids = [BENCH_ADMIN_ID] + [ADMIN_ID_BASE + i for i in range(1, args.admins)]
+    for admin_id in admin_ids[1:]:
+        bot.add_admin(admin_id, BENCH_ADMIN_ID, f"admin{admin_id}")
+    topic_ids = [topic['topic_id'] for topic in bot.get_topics() if topic['topic_name'] != "Срочный запрос"]
+
+    application = bot.build_application(bot.BOT_TOKEN)
+    samples = defaultdict(list)
+    generator = LoadGenerator(api, random.Random(args.seed), bot)
+    for admin_id in admin_ids:
+        generator.admin_queues[admin_id]
+    process_update = application.process_update
+
+    async def timed_process_update(update):
+        started = time.perf_counter()
+        try:
+            await process_update(update)
+        finally:
+            kind = generator.processed(getattr(update, "update_id", None))
+            samples[kind].append((time.perf_counter() - started) * 1000)
+
+    application.process_update = timed_process_update
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    for job in application.job_queue.jobs():
+        job.schedule_removal()
+    await application.updater.start_polling(poll_interval=0.0, timeout=1)
+
+    calls_before = api.api_calls()
+    done = asyncio.Event()
+    limiter = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id):
+        async with limiter:
+            await generator.user_flow(user_id, topic_ids)
+
+    admins = [asyncio.create_task(generator.admin_flow(admin_id, done)) for admin_id in admin_ids]
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(USER_ID_BASE + i) for i in range(args.users)))
+    # Albums are stored and forwarded once their buffering window closes.
+    while bot.media_groups:
+        await asyncio.sleep(0.1)
+    done.set()
+    await asyncio.gather(*admins)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+
+    all_samples = [value for values in samples.values() for value in values]
+    updates = len(all_samples)
+    print(f"users: {args.users}, admins: {len(admin_ids)}, latency: {args.latency_ms}+{args.jitter_ms} ms, "
+          f"429 ratio: {args.rate_limit_ratio}")
+    print(f"updates: {updates}, elapsed: {elapsed:.1f} s, throughput: {updates / elapsed:.1f} updates/s")
+    print(f"API calls per update: {(api.api_calls() - calls_before) / max(updates, 1):.2f}, "
+          f"429 injected: {api.rate_limited}, step timeouts: {generator.timeouts}")
+    print()
+    rows = [(kind, summarize(values)) for kind, values in sorted(samples.items())]
+    rows.append(("all updates", summarize(all_samples)))
+    print_table(rows, columns=("count", "p50_ms", "p95_ms", "p99_ms"))
+    print()
+    print("API calls by method:")
+    for method, count in api.calls.most_common():
+        print(f"  {method}: {count}")
+    for chat_id in list(generator.open_steps):
+        generator.close_step(chat_id)
+    print()
+    print("API calls per step on the user's chat (max / budget):")
+    over = []
+    for kind, budget in STEP_CALL_BUDGETS.items():
+        worst = max(generator.step_calls[kind], default=0)
+        print(f"  {kind}: {worst} / {budget}")
+        if worst > budget:
+            over.append(f"{kind} made {worst} calls, budget {budget}")
+    exceeded = {dict(labels)['handler']: count for (name, labels), count in bot.metrics.counters.items()
+                if name == "api_budget_exceeded"}
+    print(f"updates over API_CALL_BUDGET={bot.API_CALL_BUDGET}: {exceeded or 'none'}")
+    if exceeded:
+        over.append(f"updates over API_CALL_BUDGET by handler: {exceeded}")
+    conn = bot.get_connection()
+    dialogs, attachments = conn.execute(
+        "SELECT COUNT(DISTINCT message_id), COUNT(*) FROM attachments WHERE file_id LIKE 'album%'"
+    ).fetchone()
+    conn.close()
+    print(f"albums: {generator.albums}, stored as {dialogs} dialogs with {attachments} attachments, "
+          f"forwarded with {api.calls['sendMediaGroup']} sendMediaGroup calls")
+    if (dialogs, attachments) != (generator.albums, generator.albums * min(ALBUM_SIZE, bot.MAX_ATTACHMENTS)):
+        over.append(f"{generator.albums} albums stored as {dialogs} dialogs with {attachments} attachments")
+    if api.calls["sendMediaGroup"] != generator.albums:
+        over.append(f"{generator.albums} albums forwarded with {api.calls['sendMediaGroup']} sendMediaGroup calls")
+    # Admins are exempt, so only users who earned strikes were actually throttled.
+    limits = bot.rate_limiter.report()
+    if limits["offenders"] or limits["bans_total"]:
+        over.append(f"rate limiter struck {limits['offenders']} users and banned {limits['bans_total']}")
+    if api.rejected:
+        over.append(f"calls rejected with 400: {dict(api.rejected)}")
+    if not args.rate_limit_ratio and api.calls["answerCallbackQuery"] != generator.callbacks:
+        over.append(f"{generator.callbacks} callbacks answered {api.calls['answerCallbackQuery']} times")
+    if over:
+        raise SystemExit("API call budget violated:\n  " + "\n  ".join(over))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--admins", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="also record the generated updates, for replay_updates.py")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
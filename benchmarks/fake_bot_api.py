@@ -0,0 +1,253 @@
+"""Local stand-in for the Telegram Bot API used by the load and replay benchmarks.
+
+Serves POST /bot<token>/<method> over keep-alive HTTP/1.1 with configurable latency and
+429 injection. Like the real API it rejects edits that change nothing and second answers to
+the same callback query with 400, and it counts calls per chat so flows can be held to a budget.
+Point the bot at it with the BOT_API_BASE_URL config option.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl
+
+BOT_USER = {
+    "id": 999000,
+    "is_bot": True,
+    "first_name": "LiveBot",
+    "username": "livebot_bench_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False
+}
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "sendVoice", "sendVideo"}
+EDIT_METHODS = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption"}
+UNTHROTTLED_METHODS = {"getUpdates", "getMe", "deleteWebhook"}
+REASONS = {200: "OK", 400: "Bad Request", 429: "Too Many Requests"}
+
+
+def decode_value(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_body(content_type: str, body: bytes) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                params[name] = "<file>"
+            else:
+                params[name] = decode_value(part.get_payload(decode=True).decode())
+        return params
+    return {key: decode_value(value) for key, value in parse_qsl(body.decode(), keep_blank_values=True)}
+
+
+class FakeBotApi:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit_ratio: float = 0.0,
+                 retry_after: int = 1, seed: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.updates: deque = deque()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.update_ready: asyncio.Event = None
+        self.calls = Counter()
+        self.chat_calls = Counter()
+        self.rejected = Counter()
+        self.rate_limited = 0
+        self.query_chats = {}
+        self.answered = set()
+        self.contents = {}
+        self.activity = Counter()
+        self.waiters = {}
+        self.last_message = {}
+        self.listeners = []
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.update_ready = asyncio.Event()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/bot"
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def push_update(self, payload: dict) -> int:
+        update_id = payload.setdefault("update_id", self.next_update_id)
+        query = payload.get("callback_query")
+        if query:
+            self.query_chats[query["id"]] = query["from"]["id"]
+        self.next_update_id = max(self.next_update_id, update_id) + 1
+        self.updates.append(payload)
+        self.update_ready.set()
+        return update_id
+
+    async def wait_for_activity(self, chat_id: int, seen: int, timeout: float) -> bool:
+        if self.activity[chat_id] > seen:
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(chat_id, []).append((seen, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def touch(self, chat_id: int):
+        self.activity[chat_id] += 1
+        pending = self.waiters.get(chat_id)
+        if not pending:
+            return
+        remaining = []
+        for seen, future in pending:
+            if self.activity[chat_id] > seen:
+                if not future.done():
+                    future.set_result(True)
+            else:
+                remaining.append((seen, future))
+        if remaining:
+            self.waiters[chat_id] = remaining
+        else:
+            del self.waiters[chat_id]
+
+    def api_calls(self) -> int:
+        return sum(count for method, count in self.calls.items() if method not in UNTHROTTLED_METHODS)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = path.rstrip("/").rsplit("/", 1)[-1]
+                params = parse_body(headers.get("content-type", ""), body)
+                status, payload = await self.dispatch(method, params)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                    "Connection: keep-alive\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    def reject(self, method: str, description: str):
+        self.rejected[method] += 1
+        return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {description}"}
+
+    async def dispatch(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self.get_updates(params)}
+        if method not in UNTHROTTLED_METHODS:
+            self.chat_calls[params.get("chat_id") or self.query_chats.get(str(params.get("callback_query_id")))] += 1
+        if method not in UNTHROTTLED_METHODS:
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+            if self.rate_limit_ratio and self.rng.random() < self.rate_limit_ratio:
+                self.rate_limited += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}
+                }
+        if method == "answerCallbackQuery":
+            query_id = str(params.get("callback_query_id"))
+            if query_id in self.answered:
+                return self.reject(method, "query is too old and response timeout expired or query ID is invalid")
+            self.answered.add(query_id)
+        if method == "editMessageText":
+            content = (str(params.get("text")), params.get("reply_markup"))
+            if self.contents.get((params.get("chat_id"), params.get("message_id"))) == content:
+                return self.reject(method, "message is not modified: specified new message content and reply "
+                                           "markup are exactly the same as a current content and reply markup "
+                                           "of the message")
+        return 200, {"ok": True, "result": self.result(method, params)}
+
+    async def get_updates(self, params: dict) -> list:
+        offset = params.get("offset") or 0
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and params.get("timeout"):
+            self.update_ready.clear()
+            try:
+                await asyncio.wait_for(self.update_ready.wait(), params["timeout"])
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)[:params.get("limit") or 100]
+
+    def message(self, chat_id: int, params: dict, message_id: int = None) -> dict:
+        if message_id is None:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER
+        }
+        if "text" in params:
+            message["text"] = str(params["text"])
+        if "caption" in params:
+            message["caption"] = str(params["caption"])
+        if "photo" in params:
+            message["photo"] = [{"file_id": str(params["photo"]), "file_unique_id": "bench", "width": 1, "height": 1}]
+        if isinstance(params.get("reply_markup"), dict):
+            message["reply_markup"] = params["reply_markup"]
+        return message
+
+    def result(self, method: str, params: dict):
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChat":
+            return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}", "username": f"user{chat_id}"}
+        if method in SEND_METHODS or method in EDIT_METHODS:
+            message = self.message(chat_id, params, params.get("message_id") if method in EDIT_METHODS else None)
+            self.last_message[chat_id] = message
+            self.contents[(chat_id, message["message_id"])] = (message.get("text"), params.get("reply_markup"))
+            self.touch(chat_id)
+            for listener in self.listeners:
+                listener(method, chat_id, message)
+            return message
+        if method == "sendMediaGroup":
+            media = params.get("media") or []
+            messages = [self.message(chat_id, {"caption": item.get("caption", "")}) for item in media]
+            self.touch(chat_id)
+            return messages
+        return True
@@ -0,0 +1,80 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = "123456:BENCHMARK"
+BENCH_ADMIN_ID = 1
+
+
+def load_bot(workdir: str = None, **config):
+    workdir = workdir or tempfile.mkdtemp(prefix="livebot-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    with open('config.json', 'w') as f:
+        json.dump({"BOT_TOKEN": BENCH_TOKEN, "ADMIN_ID": BENCH_ADMIN_ID, **config}, f)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import LiveBot
+    return LiveBot
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def measure(func, *args, repeat: int = 50, **kwargs) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args, **kwargs)
+        samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples) -> dict:
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) if samples else 0.0,
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": max(samples) if samples else 0.0
+    }
+
+
+def print_table(rows, columns=("p50_ms", "p95_ms", "mean_ms")):
+    width = max(len(name) for name, _ in rows) + 2
+    print("name".ljust(width) + "".join(column.rjust(12) for column in columns))
+    for name, stats in rows:
+        print(name.ljust(width) + "".join(f"{stats[column]:12.3f}" for column in columns))
+
+
+def compare_reports(before: dict, after: dict, column: str = "p50_ms"):
+    print(f"{before['meta']['revision']} -> {after['meta']['revision']}")
+    width = max(len(name) for name in after["results"]) + 2
+    print("name".ljust(width) + f"before {column}".rjust(16) + f"after {column}".rjust(16) + "change".rjust(10))
+    for name, stats in after["results"].items():
+        old = before["results"].get(name)
+        if old is None:
+            print(name.ljust(width) + "-".rjust(16) + f"{stats[column]:16.3f}" + "new".rjust(10))
+            continue
+        change = (stats[column] - old[column]) / old[column] * 100 if old[column] else 0.0
+        print(name.ljust(width) + f"{old[column]:16.3f}{stats[column]:16.3f}" + f"{change:+9.1f}%")
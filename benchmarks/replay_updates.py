@@ -0,0 +1,201 @@
+"""Replay an update stream recorded with UPDATE_RECORD_PATH against FakeBotApi.
+
+Updates are fed at their recorded pace scaled by --speed (0 = as fast as possible). Reports
+per-kind latency plus DB and API cost per update; --compare diffs two runs, e.g. before and
+after a change. Pass --db with a copy of the production feedback.db so recorded message IDs
+resolve the same way they did live.
+
+Usage: python benchmarks/replay_updates.py updates.jsonl.gz [--speed 1] [--db feedback.db] [--output run.json]
+       python benchmarks/replay_updates.py --compare before.json after.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from fake_bot_api import FakeBotApi
+from harness import BENCH_ADMIN_ID, compare_reports, git_revision, load_bot, print_table, summarize
+
+
+def read_recording(path: str):
+    admins, updates = [], []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "admins" in record:
+                admins.extend(record["admins"])
+            else:
+                updates.append((record["t"], record["update"]))
+    return sorted(set(admins)), updates
+
+
+def update_kind(update) -> str:
+    if update.callback_query:
+        return "callback " + re.sub(r":\d+", ":N", update.callback_query.data or "")
+    message = update.effective_message
+    if message is None:
+        return "other"
+    if message.text and message.text.startswith("/"):
+        return "command " + message.text.split()[0]
+    if message.text:
+        return "text"
+    return "media"
+
+
+def metric_totals(bot) -> tuple:
+    update = bot.metrics.by_name("update")
+    db = update["db"].total if "db" in update else 0.0
+    return db, bot.metrics.counters.get(("db_statements", ()), 0), bot.metrics.counters.get(("api_calls", ()), 0)
+
+
+async def replay(args) -> dict:
+    admins, updates = read_recording(args.recording)
+    workdir = tempfile.mkdtemp(prefix="livebot-replay-")
+    if args.db:
+        shutil.copy(args.db, os.path.join(workdir, "feedback.db"))
+    api = FakeBotApi(args.latency_ms / 1000, args.jitter_ms / 1000, seed=args.seed)
+    base_url = await api.start()
+    config = {"BOT_API_BASE_URL": base_url}
+    if args.no_rate_limit:
+        config["RATE_LIMIT_ENABLED"] = False
+    bot = load_bot(workdir, **config)
+    for admin_id in admins:
+        if not bot.is_admin(admin_id):
+            bot.add_admin(admin_id, BENCH_ADMIN_ID)
+
+    application = bot.build_application(bot.BOT_TOKEN)
+    latency = defaultdict(list)
+    db_time = defaultdict(list)
+    db_statements = defaultdict(list)
+    finished = asyncio.Event()
+    processed = 0
+    process_update = application.process_update
+
+    async def timed_process_update(update):
+        nonlocal processed
+        db_before, statements_before, _ = metric_totals(bot)
+        started = time.perf_counter()
+        try:
+            await process_update(update)
+        finally:
+            kind = update_kind(update) if isinstance(update, bot.Update) else "other"
+            db_after, statements_after, _ = metric_totals(bot)
+            latency[kind].append((time.perf_counter() - started) * 1000)
+            db_time[kind].append((db_after - db_before) * 1000)
+            db_statements[kind].append(statements_after - statements_before)
+            processed += 1
+            if processed >= len(updates):
+                finished.set()
+
+    application.process_update = timed_process_update
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    for job in application.job_queue.jobs():
+        job.schedule_removal()
+    await application.updater.start_polling(poll_interval=0.0, timeout=1)
+
+    _, _, api_before = metric_totals(bot)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    first = updates[0][0] if updates else 0.0
+    for update_id, (recorded_at, payload) in enumerate(updates, 1):
+        if args.speed > 0:
+            delay = started + (recorded_at - first) / args.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        api.push_update({**payload, "update_id": update_id})
+    if updates:
+        try:
+            await asyncio.wait_for(finished.wait(), args.drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"timed out with {len(updates) - processed} updates unprocessed")
+    elapsed = loop.time() - started
+    _, _, api_after = metric_totals(bot)
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.stop()
+
+    results = {kind: summarize(samples) for kind, samples in sorted(latency.items())}
+    for kind, samples in db_time.items():
+        results[kind]["db_ms"] = sum(samples) / len(samples)
+        results[kind]["db_stmts"] = sum(db_statements[kind]) / len(samples)
+    all_latency = [value for samples in latency.values() for value in samples]
+    all_db = [value for samples in db_time.values() for value in samples]
+    results["all updates"] = summarize(all_latency)
+    results["all updates"]["db_ms"] = sum(all_db) / max(len(all_db), 1)
+    results["all updates"]["db_stmts"] = sum(map(sum, db_statements.values())) / max(len(all_db), 1)
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "recording": os.path.basename(args.recording),
+            "updates": len(updates),
+            "speed": args.speed,
+            "elapsed_s": elapsed,
+            "api_calls_per_update": (api_after - api_before) / max(len(updates), 1)
+        },
+        "results": results
+    }
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{after['meta']['recording']}: {after['meta']['updates']} updates at {after['meta']['speed']}x")
+    for column in ("p50_ms", "p95_ms", "db_ms"):
+        compare_reports(before, after, column)
+        print()
+    print(f"API calls per update: {before['meta']['api_calls_per_update']:.2f} -> "
+          f"{after['meta']['api_calls_per_update']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recording", nargs="?")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--db", help="feedback.db snapshot to replay against (copied, never modified)")
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--no-rate-limit", action="store_true", help="disable flood control for accelerated replays")
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.recording:
+        parser.error("a recording file is required")
+    args.recording = os.path.abspath(args.recording)
+    args.db = os.path.abspath(args.db) if args.db else None
+    output = os.path.abspath(args.output) if args.output else None
+    report = asyncio.run(replay(args))
+    meta = report["meta"]
+    print(f"{meta['updates']} updates in {meta['elapsed_s']:.1f} s at {meta['speed']}x, "
+          f"{meta['api_calls_per_update']:.2f} API calls per update")
+    print_table(list(report["results"].items()), columns=("count", "p50_ms", "p95_ms", "db_ms", "db_stmts"))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"results written to {output}")
+
+
+if __name__ == '__main__':
+    main()